@@ -61,7 +61,7 @@ class FacilityHistoryAdmin(SimpleHistoryAdmin):
 
 
 class FacilityListItemAdmin(admin.ModelAdmin):
-    exclude = ('processing_results',)
+    exclude = ('legacy_processing_results',)
     readonly_fields = ('facility', 'pretty_processing_results', 'source')
 
     def pretty_processing_results(self, instance):
@@ -1,5 +1,6 @@
 import os
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class ApiConfig(AppConfig):
@@ -8,6 +9,9 @@ class ApiConfig(AppConfig):
     def ready(self):
         # When `SERVER_SOFTWARE` is in the environment, we know that the app
         # has been loaded from gunicorn, not a management command.
-        if os.environ.get('SERVER_SOFTWARE') is not None:
+        # Workers that send match requests to the matcher service do not
+        # need a gazetteer of their own.
+        if os.environ.get('SERVER_SOFTWARE') is not None \
+           and not settings.MATCHER_SOCKET_PATH:
             from .matching import GazetteerCache
             GazetteerCache.get_latest()
@@ -1,11 +1,38 @@
 import boto3
-import json
+import math
 
 from datetime import datetime
-from django.db import connection
+from django.conf import settings
 
 from api.constants import ProcessingAction
-from api.models import FacilityListItem
+from api.models import record_list_processing_result
+
+# AWS Batch array jobs must have between 2 and 10,000 children
+MAX_ARRAY_JOB_SIZE = 10000
+
+# The smallest range of rows processed by each child of an array job when
+# the chunk size is derived from the size of the list
+MIN_ARRAY_CHUNK_SIZE = 25
+
+# Tells each child of an array job how many rows it should process. See the
+# batch_process management command.
+ARRAY_CHUNK_SIZE_VARIABLE = 'BATCH_ARRAY_CHUNK_SIZE'
+
+
+def get_array_chunk_size(row_count):
+    """
+    Determine the number of contiguous rows processed by each child of an
+    array job. BATCH_CHUNK_SIZE is used if it is set. Otherwise the chunk
+    size is chosen so that the list is split into no more than
+    BATCH_MAX_ARRAY_SIZE children.
+    """
+    if settings.BATCH_CHUNK_SIZE > 0:
+        chunk_size = settings.BATCH_CHUNK_SIZE
+    else:
+        chunk_size = max(
+            MIN_ARRAY_CHUNK_SIZE,
+            math.ceil(row_count / max(settings.BATCH_MAX_ARRAY_SIZE, 1)))
+    return max(chunk_size, math.ceil(row_count / MAX_ARRAY_JOB_SIZE))
 
 
 def fetch_batch_queue_arn(client, environment):
@@ -57,17 +84,21 @@ def submit_jobs(environment, facility_list, skip_parse=False):
     job_time = (datetime.utcnow().isoformat()
                 .replace(':', '-').replace('.', '-').replace('T', '-'))
 
-    item_table = FacilityListItem.objects.model._meta.db_table
-    results_column = 'processing_results'
-    source_id_column = 'source_id'
-
-    def submit_job(action, is_array=False, depends_on=None):
+    def submit_job(action, array_size=None, chunk_size=None,
+                   depends_on=None):
         if depends_on is None:
             depends_on = []
         array_properties = {}
-        if is_array:
+        container_overrides = {}
+        if array_size is not None:
             array_properties = {
-                'size': facility_list.source.facilitylistitem_set.count()
+                'size': array_size
+            }
+            container_overrides = {
+                'environment': [{
+                    'name': ARRAY_CHUNK_SIZE_VARIABLE,
+                    'value': str(chunk_size),
+                }]
             }
         job_name = 'list-{0}-{1}-{2}'.format(
             facility_list.id, action, job_time)
@@ -77,6 +108,7 @@ def submit_jobs(environment, facility_list, skip_parse=False):
             jobDefinition=job_def_arn,
             dependsOn=depends_on,
             arrayProperties=array_properties,
+            containerOverrides=container_overrides,
             parameters={
                 'listid': str(facility_list.id),
                 'action': action,
@@ -89,18 +121,8 @@ def submit_jobs(environment, facility_list, skip_parse=False):
                 'Failed to submit job {0}. Response {1}'.format(job_name, job))
 
     def append_processing_result(result_dict):
-        query = ("UPDATE {item_table} "
-                 "SET {results_column} = {results_column} || '{dict_json}' "
-                 "WHERE {source_id_column} = {source_id}")
-        query = query.format(
-            item_table=item_table,
-            results_column=results_column,
-            dict_json=json.dumps(result_dict),
-            source_id_column=source_id_column,
-            source_id=facility_list.source.id
-        )
-        with connection.cursor() as cursor:
-            cursor.execute(query)
+        # A single event is recorded for all of the items in the list
+        record_list_processing_result(facility_list.source, result_dict)
 
     depends_on = None
     job_ids = []
@@ -127,11 +149,17 @@ def submit_jobs(environment, facility_list, skip_parse=False):
 
     # GEOCODE
     started = str(datetime.utcnow())
+    # Each child of the array job geocodes a contiguous range of rows, which
+    # avoids starting a container for every row of a large list
     row_count = facility_list.source.facilitylistitem_set.count()
-    is_array = row_count > 1
-    geocode_job_id = submit_job('geocode',
-                                depends_on=depends_on,
-                                is_array=is_array)
+    chunk_size = get_array_chunk_size(row_count)
+    array_size = math.ceil(row_count / chunk_size)
+    is_array = array_size > 1
+    geocode_job_id = submit_job(
+        'geocode',
+        depends_on=depends_on,
+        array_size=array_size if is_array else None,
+        chunk_size=chunk_size if is_array else None)
     job_ids.append(geocode_job_id)
     depends_on = [{'jobId': geocode_job_id}]
     finished = str(datetime.utcnow())
@@ -141,6 +169,8 @@ def submit_jobs(environment, facility_list, skip_parse=False):
         'job_id': geocode_job_id,
         'error': False,
         'is_array': is_array,
+        'array_size': array_size if is_array else None,
+        'chunk_size': chunk_size if is_array else None,
         'started_at': started,
         'finished_at': finished,
     })
@@ -1,10 +1,17 @@
+from django.conf import settings
 from watchman.decorators import check
+from api.matcher_service import MatcherAction, send_request
 from api.matching import GazetteerCache
 
 
 @check
 def _check_gazetteercache():
-    GazetteerCache.get_latest()
+    if settings.MATCHER_SOCKET_PATH:
+        send_request(settings.MATCHER_SOCKET_PATH,
+                     {'action': MatcherAction.STATUS},
+                     settings.MATCHER_TIMEOUT_IN_SECONDS)
+    else:
+        GazetteerCache.get_latest()
     return {'ok': True}
 
 
@@ -0,0 +1,214 @@
+import random
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from requests.adapters import HTTPAdapter
+
+from api.geocoding import (CACHEABLE_STATUSES,
+                           OVER_QUERY_LIMIT,
+                           UNKNOWN_ERROR,
+                           GeocodingRequestError,
+                           format_geocoding_response,
+                           geocoding_cache_stats,
+                           get_cached_geocoding_response,
+                           make_geocoding_key,
+                           request_geocoding,
+                           set_cached_geocoding_response)
+from api.models import (FacilityListItem,
+                        load_processing_results,
+                        save_processing_events)
+from api.processing import geocode_facility_list_item
+
+# Response statuses that indicate a transient failure worth retrying
+RETRYABLE_STATUSES = (OVER_QUERY_LIMIT, UNKNOWN_ERROR)
+
+
+class TokenBucket(object):
+    """
+    A thread safe rate limiter that allows an average of `rate` calls to
+    `acquire` per second, with bursts of up to `capacity` calls. A `rate` of
+    0 disables the limit.
+    """
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.capacity,
+                    self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def create_geocoding_session(concurrency):
+    """
+    Create a session that keeps up to `concurrency` connections to the
+    geocoding API open so that they can be reused by each request.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def is_retryable_error(error):
+    if isinstance(error, GeocodingRequestError):
+        return error.status_code >= 500 or error.status_code == 429
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def request_geocoding_with_retries(address, country_code, session,
+                                   rate_limiter, max_retries=5,
+                                   backoff=0.5):
+    """
+    Send a geocoding request, waiting for the rate limiter before each
+    attempt. Requests that fail with a 5xx status, a connection error, or an
+    OVER_QUERY_LIMIT or UNKNOWN_ERROR response are retried up to
+    `max_retries` times with exponential backoff.
+
+    Returns:
+    A (data, duration) tuple, as returned by `request_geocoding`. If the
+    retries are exhausted the last response is returned, or the last error is
+    raised.
+    """
+    attempt = 0
+    while True:
+        rate_limiter.acquire()
+        try:
+            data, duration = request_geocoding(address, country_code,
+                                               session=session)
+            if data.get('status') not in RETRYABLE_STATUSES \
+               or attempt >= max_retries:
+                return data, duration
+        except Exception as e:
+            if not is_retryable_error(e) or attempt >= max_retries:
+                raise
+        # Jitter keeps the workers from retrying in lockstep
+        time.sleep(backoff * 2 ** attempt * (1 + random.random()))
+        attempt += 1
+
+
+def geocode_list_items(items, concurrency=8, rate=None, batch_size=100,
+                       session=None, max_retries=5):
+    """
+    Geocode facility list items with up to `concurrency` requests in flight
+    at once. Each distinct address and country is requested once, cached
+    responses are used without sending a request, and the items are saved in
+    batches of `batch_size` with a single query per batch. The outcome for
+    each item is the same as calling `geocode_facility_list_item` on it.
+
+    Requests are sent from worker threads, which do not use the database.
+    Cache lookups, cache writes and item updates are all made from the
+    calling thread.
+
+    Arguments:
+    items (iterable) -- The `FacilityListItem` objects to geocode.
+    concurrency (int) -- The number of requests to send in parallel.
+    rate (float) -- The maximum number of requests per second. Defaults to
+                    GEOCODING_RATE_LIMIT.
+    batch_size (int) -- The number of items saved in each transaction.
+    session -- The HTTP session used to send requests. A pooled session is
+               created if one is not provided.
+    max_retries (int) -- The number of times a failed request is retried.
+
+    Returns:
+    A dict with the number of 'success' and 'failure' items and a list of
+    'errors' messages for items that could not be geocoded at all.
+    """
+    if rate is None:
+        rate = settings.GEOCODING_RATE_LIMIT
+    if session is None:
+        session = create_geocoding_session(concurrency)
+    rate_limiter = TokenBucket(rate)
+    use_cache = settings.GEOCODING_CACHE_MAX_ENTRIES > 0
+    items = list(items)
+    load_processing_results(items)
+
+    result = {
+        'success': 0,
+        'failure': 0,
+        'errors': [],
+    }
+
+    responses = {}
+    futures = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        # Queue a request for every distinct address that is not cached.
+        # The workers start sending requests while the rest of the items are
+        # being looked up.
+        for item in items:
+            if item.status != FacilityListItem.PARSED \
+               or item.geocoded_point is not None:
+                continue
+            key = make_geocoding_key(item.address, item.country_code)
+            if key in responses or key in futures:
+                continue
+            cached = get_cached_geocoding_response(
+                item.address, item.country_code) if use_cache else None
+            if cached is not None:
+                responses[key] = cached[0]
+                geocoding_cache_stats['hits'] += 1
+            else:
+                if use_cache:
+                    geocoding_cache_stats['misses'] += 1
+                futures[key] = executor.submit(
+                    request_geocoding_with_retries, item.address,
+                    item.country_code, session, rate_limiter, max_retries)
+
+        def geocode(address, country_code):
+            key = make_geocoding_key(address, country_code)
+            if key not in responses:
+                data, duration = futures[key].result()
+                if use_cache and data.get('status') in CACHEABLE_STATUSES:
+                    set_cached_geocoding_response(address, country_code,
+                                                  data, duration)
+                responses[key] = data
+            return format_geocoding_response(responses[key], country_code)
+
+        for start in range(0, len(items), batch_size):
+            updated_items = []
+            for item in items[start:start + batch_size]:
+                try:
+                    geocode_facility_list_item(item, geocode=geocode)
+                except ValueError as e:
+                    result['errors'].append(str(e))
+                    result['failure'] += 1
+                    continue
+                updated_items.append(item)
+                if item.status in FacilityListItem.ERROR_STATUSES:
+                    result['failure'] += 1
+                else:
+                    result['success'] += 1
+
+            now = timezone.now()
+            for item in updated_items:
+                item.updated_at = now
+            with transaction.atomic():
+                FacilityListItem.objects.bulk_update(
+                    updated_items,
+                    ['status', 'geocoded_point', 'geocoded_address',
+                     'updated_at'])
+                save_processing_events(updated_items)
+
+    return result
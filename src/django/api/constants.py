@@ -34,6 +34,12 @@ class FacilitiesQueryParams:
     COMBINE_CONTRIBUTORS = 'combine_contributors'
     BOUNDARY = 'boundary'
     PPE = 'ppe'
+    SORT_BY = 'sort_by'
+
+
+class FacilitiesSortBy:
+    NAME = 'name'
+    RELEVANCE = 'relevance'
 
 
 class FacilityListQueryParams:
@@ -0,0 +1,252 @@
+import mercantile
+
+from django.db import connection, transaction
+
+from api.constants import FacilitiesQueryParams
+from api.models import (FacilityGridCell,
+                        FacilityGridCount,
+                        FacilityIndex,
+                        Version,
+                        mark_facility_grid_cells_dirty)
+
+FACILITY_GRID_VERSION = 'facility_grid'
+
+# Query parameters that do not change which facilities are counted
+IGNORED_QUERY_PARAMS = (FacilitiesQueryParams.COMBINE_CONTRIBUTORS,
+                        FacilitiesQueryParams.SORT_BY, 'embed')
+
+
+def get_facility_grid_filter(params):
+    """
+    Determine whether a facilitygrid tile request can be answered by summing
+    `FacilityGridCount` rows, which is the case when the request is either
+    unfiltered or filtered by a single dimension. A facility has only one
+    country but can have several contributors and contributor types, so only
+    a single contributor or contributor type can be summed without counting
+    some facilities more than once.
+
+    Arguments:
+    params (QueryDict) -- The request query parameters.
+
+    Returns:
+    A (dimension, values) tuple, or None if the request cannot be answered
+    from the precomputed counts.
+    """
+    filters = {}
+    for name, values in params.lists():
+        values = [v for v in values if v != '']
+        if len(values) > 0 and name not in IGNORED_QUERY_PARAMS:
+            filters[name] = values
+
+    if len(filters) == 0:
+        return FacilityGridCount.ALL, ['']
+    if len(filters) > 1:
+        return None
+
+    name, values = filters.popitem()
+    if name == FacilitiesQueryParams.COUNTRIES:
+        return FacilityGridCount.COUNTRY, values
+    if len(values) != 1:
+        return None
+    if name == FacilitiesQueryParams.CONTRIBUTORS:
+        return FacilityGridCount.CONTRIBUTOR, values
+    if name == FacilitiesQueryParams.CONTRIBUTOR_TYPES:
+        return FacilityGridCount.CONTRIBUTOR_TYPE, values
+    return None
+
+
+def facility_grid_is_built():
+    return Version.objects.filter(name=FACILITY_GRID_VERSION,
+                                  version__gt=0).exists()
+
+
+def get_precomputed_facility_grid_vector_tile(params, layer, z, x, y):
+    """
+    Create a facilitygrid vector tile from the precomputed cell counts rather
+    than joining a generated hex grid to the facilities.
+
+    Arguments:
+    params (dict) -- Request query parameters.
+    layer (string) -- The name of the tile layer.
+    z (int) -- Zoom level.
+    x (int) -- X (horizontal) position for requested tile on a grid.
+    y (int) -- Y (vertical) position for requested tile on a grid.
+
+    Returns:
+    A vector tile, or None if the tile cannot be created from the precomputed
+    counts because of the filters, the zoom level, or cells in the tile that
+    have not been recounted since their facilities changed.
+    """
+    if z > FacilityGridCell.MAX_ZOOM:
+        return None
+
+    grid_filter = get_facility_grid_filter(params)
+    if grid_filter is None:
+        return None
+    dimension, values = grid_filter
+
+    if not facility_grid_is_built():
+        return None
+
+    xy_bounds = mercantile.xy_bounds(x, y, z)
+    envelope = 'ST_MakeEnvelope({}, {}, {}, {}, 3857)'.format(
+        xy_bounds.left, xy_bounds.bottom, xy_bounds.right, xy_bounds.top)
+
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT EXISTS ('
+            '  SELECT 1 FROM {cells} '
+            '  WHERE zoom = %s AND is_dirty AND geom && {envelope}'
+            ')'.format(cells=FacilityGridCell._meta.db_table,
+                       envelope=envelope),
+            [z])
+        if cursor.fetchone()[0]:
+            return None
+
+        # Match the columns and the wrapping filter of the query in
+        # `get_facility_grid_vector_tile`
+        join_query = (
+            'SELECT '
+            '  ST_AsMVTGeom(ST_Centroid(c.geom), ST_MakeEnvelope('
+            '    {xmin}, {ymin}, {xmax}, {ymax})) AS mvt_geom, '
+            '  SUM(n.count) AS count, '
+            '  ST_XMin(c.wgs84_geom) AS xmin, '
+            '  ST_YMin(c.wgs84_geom) AS ymin, '
+            '  ST_XMax(c.wgs84_geom) AS xmax, '
+            '  ST_YMax(c.wgs84_geom) AS ymax '
+            'FROM ('
+            '  SELECT id, geom, ST_Envelope(ST_Transform(geom, 4326)) '
+            '    AS wgs84_geom '
+            '  FROM {cells} '
+            '  WHERE zoom = %s AND geom && {envelope}'
+            ') AS c '
+            'JOIN {counts} n ON n.cell_id = c.id '
+            'WHERE n.dimension = %s AND n.value = ANY(%s) '
+            '  AND abs(ST_XMax(c.wgs84_geom) - ST_XMin(c.wgs84_geom)) < 180 '
+            'GROUP BY c.id, c.geom, c.wgs84_geom'
+        ).format(
+            xmin=xy_bounds.left, ymin=xy_bounds.bottom,
+            xmax=xy_bounds.right, ymax=xy_bounds.top,
+            cells=FacilityGridCell._meta.db_table,
+            counts=FacilityGridCount._meta.db_table,
+            envelope=envelope)
+
+        cursor.execute(
+            'SELECT ST_AsMVT(q, \'{}\') FROM ({}) AS q'.format(
+                layer, join_query),
+            [z, dimension, values])
+        return cursor.fetchone()[0]
+
+
+@transaction.atomic
+def refresh_facility_grid_cells(batch_size=1000):
+    """
+    Recalculate the counts of up to `batch_size` dirty `FacilityGridCell`
+    rows from the `FacilityIndex`. Rows locked by another worker are skipped.
+    Cells that no longer contain any facilities are deleted.
+
+    Returns:
+    The number of cells that were refreshed.
+    """
+    cells = FacilityGridCell._meta.db_table
+    counts = FacilityGridCount._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT id FROM {cells} WHERE is_dirty ORDER BY id LIMIT %s '
+            'FOR UPDATE SKIP LOCKED'.format(cells=cells),
+            [batch_size])
+        cell_ids = [row[0] for row in cursor.fetchall()]
+        if len(cell_ids) == 0:
+            return 0
+
+        cursor.execute(
+            'DELETE FROM {counts} WHERE cell_id = ANY(%s)'.format(
+                counts=counts),
+            [cell_ids])
+
+        # Facilities are found with a bounding box search and then assigned
+        # with `hexgrid_cell` so that a facility on the edge of two cells is
+        # only counted in one of them
+        cursor.execute(
+            'WITH members AS ('
+            '  SELECT d.id AS cell_id, f.id AS facility_id, f.country_code, '
+            '    f.contributors, f.contrib_types '
+            '  FROM {cells} d '
+            '  JOIN {index} f ON f.location && ST_Transform(d.geom, 4326) '
+            '  CROSS JOIN LATERAL hexgrid_cell('
+            '    %s / power(2::float, d.zoom + %s), '
+            '    ST_X(ST_Transform(f.location, 3857)), '
+            '    ST_Y(ST_Transform(f.location, 3857))) AS c '
+            '  WHERE d.id = ANY(%s) '
+            '    AND c.x_index = d.x_index '
+            '    AND c.y_index = d.y_index '
+            '    AND c.is_offset = d.is_offset'
+            ') '
+            'INSERT INTO {counts} (cell_id, dimension, value, count) '
+            'SELECT cell_id, dimension, value, COUNT(DISTINCT facility_id) '
+            'FROM ('
+            '  SELECT cell_id, facility_id, %s AS dimension, \'\' AS value '
+            '  FROM members '
+            '  UNION ALL '
+            '  SELECT cell_id, facility_id, %s, country_code FROM members '
+            '  UNION ALL '
+            '  SELECT cell_id, facility_id, %s, contributor::text '
+            '  FROM members CROSS JOIN unnest(contributors) AS contributor '
+            '  UNION ALL '
+            '  SELECT cell_id, facility_id, %s, contrib_type '
+            '  FROM members CROSS JOIN unnest(contrib_types) AS contrib_type'
+            ') AS v '
+            'WHERE value IS NOT NULL '
+            'GROUP BY cell_id, dimension, value'.format(
+                cells=cells, counts=counts,
+                index=FacilityIndex._meta.db_table),
+            [FacilityGridCell.WORLD_WIDTH, FacilityGridCell.ZOOM_FACTOR,
+             cell_ids, FacilityGridCount.ALL, FacilityGridCount.COUNTRY,
+             FacilityGridCount.CONTRIBUTOR,
+             FacilityGridCount.CONTRIBUTOR_TYPE])
+
+        cursor.execute(
+            'DELETE FROM {cells} d WHERE d.id = ANY(%s) AND NOT EXISTS ('
+            '  SELECT 1 FROM {counts} n WHERE n.cell_id = d.id'
+            ')'.format(cells=cells, counts=counts),
+            [cell_ids])
+        cursor.execute(
+            'UPDATE {cells} SET is_dirty = false WHERE id = ANY(%s)'.format(
+                cells=cells),
+            [cell_ids])
+    return len(cell_ids)
+
+
+def refresh_facility_grid(batch_size=1000):
+    """
+    Refresh dirty cells until there are none left.
+
+    Returns:
+    The number of cells that were refreshed.
+    """
+    total = 0
+    while True:
+        count = refresh_facility_grid_cells(batch_size)
+        total += count
+        if count < batch_size:
+            return total
+
+
+def build_facility_grid(batch_size=1000):
+    """
+    Rebuild every cell of the facility grid from the `FacilityIndex`. Tiles
+    are created with the spatial join until the build is complete.
+
+    Returns:
+    The number of cells that were built.
+    """
+    Version.objects.update_or_create(name=FACILITY_GRID_VERSION,
+                                     defaults={'version': 0})
+    with connection.cursor() as cursor:
+        cursor.execute('TRUNCATE {}, {}'.format(
+            FacilityGridCount._meta.db_table,
+            FacilityGridCell._meta.db_table))
+    mark_facility_grid_cells_dirty()
+    total = refresh_facility_grid(batch_size)
+    Version.objects.filter(name=FACILITY_GRID_VERSION).update(version=1)
+    return total
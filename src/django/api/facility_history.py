@@ -1,11 +1,12 @@
-from django.db.models import F
+from django.db.models import Q
 from django.core.exceptions import ObjectDoesNotExist
 
 from api.constants import ProcessingAction, FacilityHistoryActions
 from api.models import (FacilityMatch,
                         FacilityClaim,
                         FacilityListItem,
-                        FacilityList)
+                        FacilityList,
+                        load_processing_results)
 from api.helpers import prefix_a_an
 
 
@@ -236,6 +237,22 @@ def maybe_get_move_action_time_from_processing_results(item):
     return next(iter(move_processing_times), None)
 
 
+def get_matches_with_processing_action(matches, action):
+    """
+    Returns:
+    A list of the matches whose list item has a processing result with the
+    action. The processing results of the items are loaded together.
+    """
+    items = FacilityListItem.objects.filter(
+        Q(legacy_processing_results__contains=[{'action': action}])
+        | Q(processingevent__action=action))
+    matches = list(matches
+                   .filter(facility_list_item__in=items.values('id'))
+                   .select_related('facility_list_item'))
+    load_processing_results([m.facility_list_item for m in matches])
+    return matches
+
+
 def processing_results_has_split_action_for_oar_id(list_item, facility_id):
     return facility_id in [
         r.get('previous_facility_oar_id', None)
@@ -338,12 +355,8 @@ def create_facility_history_list(entries, facility_id, user=None):
             )
         }
         for m
-        in FacilityMatch
-        .objects
-        .annotate(
-            processing_results=F('facility_list_item__processing_results'))
-        .extra(
-            where=['processing_results @> \'[{"action": "split_facility"}]\''])
+        in get_matches_with_processing_action(
+            FacilityMatch.objects.all(), ProcessingAction.SPLIT_FACILITY)
         if processing_results_has_split_action_for_oar_id(
             m.facility_list_item,
             facility_id,
@@ -362,17 +375,13 @@ def create_facility_history_list(entries, facility_id, user=None):
             )
         }
         for m
-        in FacilityMatch
-        .objects
-        .filter(status__in=[
-            FacilityMatch.CONFIRMED,
-            FacilityMatch.AUTOMATIC,
-            FacilityMatch.MERGED,
-        ])
-        .annotate(
-            processing_results=F('facility_list_item__processing_results'))
-        .extra(
-            where=['processing_results @> \'[{"action": "move_facility"}]\''])
+        in get_matches_with_processing_action(
+            FacilityMatch.objects.filter(status__in=[
+                FacilityMatch.CONFIRMED,
+                FacilityMatch.AUTOMATIC,
+                FacilityMatch.MERGED,
+            ]),
+            ProcessingAction.MOVE_FACILITY)
         if processing_results_has_move_action_for_oar_id(
             m.facility_list_item,
             facility_id,
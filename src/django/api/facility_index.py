@@ -0,0 +1,273 @@
+import re
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+from django.db import connection, connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from api.models import (Facility,
+                        FacilityIndex,
+                        FacilityMatch,
+                        get_facility_index_data,
+                        mark_facility_grid_cells_dirty,
+                        write_facility_index)
+
+SHADOW_SUFFIX = '_shadow'
+
+
+def get_shadow_table_name():
+    return FacilityIndex._meta.db_table + SHADOW_SUFFIX
+
+
+def get_shadow_index_name(name):
+    # Postgres truncates identifiers to 63 characters
+    return name[:63 - len(SHADOW_SUFFIX)] + SHADOW_SUFFIX
+
+
+def get_chunk_ranges(chunk_size):
+    """
+    Partition the facility IDs into contiguous ranges.
+
+    Arguments:
+    chunk_size -- The maximum number of facilities in each range.
+
+    Returns:
+    A list of (start, end) tuples, where `start` is inclusive and `end` is
+    exclusive. The `end` of the last range is None.
+    """
+    ids = Facility.objects.order_by('id').values_list('id', flat=True)
+    starts = list(ids[::chunk_size]) if chunk_size > 0 else []
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def build_chunk(table, start, end):
+    """
+    Write the index rows for the facilities with IDs in [start, end) to
+    `table` in a single transaction.
+
+    Returns:
+    The number of rows written.
+    """
+    filters = {'facility_id__gte': start}
+    if end is not None:
+        filters['facility_id__lt'] = end
+    with transaction.atomic():
+        return write_facility_index(get_facility_index_data(**filters),
+                                    facility_ids=[], table=table)
+
+
+def get_index_definitions(table):
+    """
+    Returns:
+    A list of (name, definition, is_primary) tuples for the indexes on
+    `table`.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT i.relname, pg_get_indexdef(x.indexrelid), x.indisprimary '
+            'FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid '
+            'WHERE x.indrelid = %s::regclass',
+            [table])
+        return cursor.fetchall()
+
+
+def create_shadow_index(cursor, name, definition, is_primary):
+    """
+    Copy an index on the live table to the shadow table, using a name that
+    can be renamed to the original once the live table has been dropped.
+    """
+    shadow = get_shadow_table_name()
+    shadow_name = get_shadow_index_name(name)
+    definition = re.sub(
+        r'INDEX \S+ ON \S+ ',
+        'INDEX {} ON {} '.format(shadow_name, shadow),
+        definition,
+        count=1)
+    cursor.execute(definition)
+    if is_primary:
+        cursor.execute(
+            'ALTER TABLE {} ADD CONSTRAINT {} '
+            'PRIMARY KEY USING INDEX {}'.format(
+                shadow, shadow_name, shadow_name))
+
+
+def create_shadow_table():
+    live = FacilityIndex._meta.db_table
+    shadow = get_shadow_table_name()
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS {}'.format(shadow))
+        cursor.execute(
+            'CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(
+                shadow, live))
+        # The primary key is created up front because the chunks are written
+        # with `ON CONFLICT (id)`, which requires a unique index on id
+        for name, definition, is_primary in get_index_definitions(live):
+            if is_primary:
+                create_shadow_index(cursor, name, definition, is_primary)
+
+
+def create_shadow_indexes():
+    """
+    Copy the secondary indexes on the live table to the shadow table. They are
+    created after the table is filled, which is much faster than maintaining
+    them during the inserts.
+    """
+    live = FacilityIndex._meta.db_table
+    with connection.cursor() as cursor:
+        for name, definition, is_primary in get_index_definitions(live):
+            if not is_primary:
+                create_shadow_index(cursor, name, definition, is_primary)
+
+
+def get_changed_facility_ids(since):
+    """
+    Returns:
+    The IDs of facilities whose index rows may have changed after `since`.
+    """
+    source = 'facility_list_item__source'
+    match_filter = (Q(updated_at__gte=since)
+                    | Q(**{source + '__updated_at__gte': since})
+                    | Q(**{source + '__contributor__updated_at__gte': since}))
+    return set(Facility.objects
+               .filter(updated_at__gte=since)
+               .values_list('id', flat=True)) \
+        | set(FacilityMatch.objects
+              .filter(match_filter)
+              .values_list('facility_id', flat=True))
+
+
+def get_moved_facility_ids(live, shadow):
+    """
+    Returns:
+    The IDs of the facilities whose location differs between the two index
+    tables, including the facilities that are only in one of them.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT COALESCE(l.id, s.id) '
+            'FROM {live} l FULL OUTER JOIN {shadow} s ON l.id = s.id '
+            'WHERE l.id IS NULL OR s.id IS NULL '
+            '  OR NOT ST_OrderingEquals(l.location, s.location)'.format(
+                live=live, shadow=shadow))
+        return set(row[0] for row in cursor.fetchall())
+
+
+def swap_shadow_table(started_at):
+    """
+    Replace the live table with the shadow table in a single transaction.
+
+    Writes to the live table are blocked while the facilities that changed
+    during the rebuild are reindexed into the shadow table and the grid
+    cells of the facilities whose location changed are marked dirty, but
+    reads are only blocked for the brief moment it takes to rename the
+    tables.
+
+    Arguments:
+    started_at -- The time at which the rebuild started.
+
+    Returns:
+    The number of facilities that were reindexed to catch up with changes.
+    """
+    live = FacilityIndex._meta.db_table
+    shadow = get_shadow_table_name()
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'LOCK TABLE {} IN EXCLUSIVE MODE'.format(live))
+
+            changed_ids = get_changed_facility_ids(started_at)
+            if len(changed_ids) > 0:
+                write_facility_index(
+                    get_facility_index_data(facility_id__in=changed_ids),
+                    facility_ids=changed_ids, table=shadow)
+            cursor.execute(
+                'DELETE FROM {shadow} s WHERE NOT EXISTS ('
+                '  SELECT 1 FROM {facility} f WHERE f.id = s.id'
+                ')'.format(shadow=shadow,
+                           facility=Facility._meta.db_table))
+
+            # Both the cells of the previous locations and the cells of the
+            # new locations need to be recounted
+            dirty_ids = list(
+                get_moved_facility_ids(live, shadow) | set(changed_ids))
+            if len(dirty_ids) > 0:
+                mark_facility_grid_cells_dirty(dirty_ids)
+                mark_facility_grid_cells_dirty(dirty_ids, table=shadow)
+
+            index_names = [name for name, _, _ in get_index_definitions(live)]
+            cursor.execute('DROP TABLE {}'.format(live))
+            cursor.execute(
+                'ALTER TABLE {} RENAME TO {}'.format(shadow, live))
+            for name in index_names:
+                cursor.execute('ALTER INDEX {} RENAME TO {}'.format(
+                    get_shadow_index_name(name), name))
+
+    # ANALYZE does not block reads, but it runs after the commit so that the
+    # rename is not held up by it
+    with connection.cursor() as cursor:
+        cursor.execute('ANALYZE {}'.format(live))
+    return len(changed_ids)
+
+
+def rebuild_facility_index(chunk_size=5000, workers=1, stdout=None):
+    """
+    Rebuild the entire `FacilityIndex` into a shadow table one chunk of
+    facilities at a time, then swap it in for the live table. Each chunk is
+    written in its own transaction, so no lock is held for the duration of the
+    rebuild, and readers continue to see the previous index until the swap.
+
+    Arguments:
+    chunk_size -- The number of facilities to index per transaction.
+    workers -- The number of processes to use to build chunks in parallel.
+    stdout -- An optional stream to which progress is written.
+
+    Returns:
+    The number of rows written to the new index.
+    """
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    started_at = timezone.now()
+    start_time = time.monotonic()
+    create_shadow_table()
+    try:
+        ranges = get_chunk_ranges(chunk_size)
+        table = get_shadow_table_name()
+        total = 0
+
+        def report(i):
+            elapsed = time.monotonic() - start_time
+            log('Indexed chunk {} of {} ({} rows, {:.0f} rows/s)'.format(
+                i + 1, len(ranges), total,
+                total / elapsed if elapsed > 0 else 0))
+
+        if workers > 1:
+            # The worker processes must open their own connections rather
+            # than sharing the one inherited from this process
+            connections.close_all()
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(build_chunk, table, start, end)
+                           for start, end in ranges]
+                for i, future in enumerate(futures):
+                    total += future.result()
+                    report(i)
+        else:
+            for i, (start, end) in enumerate(ranges):
+                total += build_chunk(table, start, end)
+                report(i)
+
+        log('Creating indexes...')
+        create_shadow_indexes()
+        caught_up = swap_shadow_table(started_at)
+        log('Swapped in new index. Reindexed {} facilities changed during '
+            'the rebuild. Total {} rows in {:.1f}s'.format(
+                caught_up, total, time.monotonic() - start_time))
+        return total
+    except Exception:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'DROP TABLE IF EXISTS {}'.format(get_shadow_table_name()))
+        raise
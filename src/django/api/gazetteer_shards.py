@@ -0,0 +1,209 @@
+import io
+import multiprocessing
+import pickle
+
+from collections import Counter, defaultdict
+
+import dedupe
+
+# The shard holding the canonical records of the countries that have fewer
+# records than the minimum shard size, and of countries that were not indexed
+# when the shards were built
+SHARED_SHARD = ''
+
+# The sharded gazetteer read by pool workers. It is set before the pool is
+# forked so that the workers use the indexes in the memory they inherit from
+# the parent rather than a pickled copy.
+_pool_gazetteer = None
+
+
+def _match_shard(task):
+    key, messy, threshold, n_matches = task
+    shard = _pool_gazetteer.shards[key]
+    # Pool workers are not allowed to start processes of their own
+    shard.num_cores = 1
+    try:
+        return shard.match(messy, threshold=threshold, n_matches=n_matches,
+                           generator=False)
+    except dedupe.core.BlockingError:
+        return None
+
+
+class ShardedGazetteer:
+    """
+    A set of gazetteers that share one trained model, each of which indexes
+    the canonical records of a single country or of a group of countries with
+    few records. Country is compared as an exact field, so a messy record is
+    only scored against the shard of its own country. This bounds the
+    blocking candidates and the size of each index, lets the shards of a
+    multi-country list be scored in parallel and means that a change to a
+    facility only updates the index of its shard.
+
+    Implements the parts of the `dedupe.Gazetteer` interface used by
+    `GazetteerCache` and `match_items`.
+
+    Arguments:
+    model_settings -- The output of `Gazetteer.writeSettings` for the trained
+                      model, used to create each shard.
+    shards -- A dict of indexed `dedupe.StaticGazetteer` objects keyed by
+              shard key.
+    shard_keys -- A dict of shard keys keyed by clean country value.
+                  Countries that are not present use `SHARED_SHARD`.
+    record_shards -- A dict of shard keys keyed by canonical record ID.
+    processes -- The number of processes used to score the shards of a
+                 match. Shards are scored in this process if it is 1.
+    """
+    def __init__(self, model_settings, shards, shard_keys, record_shards,
+                 processes=1):
+        self.model_settings = model_settings
+        self.shards = shards
+        self.shard_keys = shard_keys
+        self.record_shards = record_shards
+        self.processes = processes
+
+    @classmethod
+    def build(cls, gazetteer, canonical, min_shard_size, processes=1):
+        """
+        Create and index the shards of a trained gazetteer.
+
+        Arguments:
+        gazetteer -- A trained `dedupe.Gazetteer`. It is not indexed.
+        canonical -- A dict of canonical records, as returned by
+                     `get_canonical_items`.
+        min_shard_size -- Countries with fewer canonical records than this
+                          share a shard.
+        processes -- See `ShardedGazetteer`.
+        """
+        model_settings = io.BytesIO()
+        gazetteer.writeSettings(model_settings)
+        counts = Counter(record['country'] for record in canonical.values())
+        shard_keys = {country: country for country, count in counts.items()
+                      if count >= min_shard_size}
+        sharded = cls(model_settings.getvalue(), {}, shard_keys, {},
+                      processes=processes)
+        sharded.index(canonical)
+        return sharded
+
+    def get_shard_key(self, record):
+        return self.shard_keys.get(record['country'], SHARED_SHARD)
+
+    def _group_by_shard(self, data):
+        groups = defaultdict(dict)
+        for key, record in data.items():
+            groups[self.get_shard_key(record)][key] = record
+        return groups
+
+    def index(self, data):
+        """
+        Add canonical records to the indexes of their shards, creating the
+        shards that do not exist yet.
+        """
+        for shard_key, records in self._group_by_shard(data).items():
+            if shard_key not in self.shards:
+                self.shards[shard_key] = dedupe.StaticGazetteer(
+                    io.BytesIO(self.model_settings))
+            self.shards[shard_key].index(records)
+            for key in records:
+                self.record_shards[key] = shard_key
+
+    def _route(self, messy):
+        # Records of countries without a shard cannot have any matches
+        return {shard_key: records for shard_key, records
+                in self._group_by_shard(messy).items()
+                if shard_key in self.shards}
+
+    def threshold(self, messy, recall_weight=1.5):
+        """
+        Returns:
+        The lowest of the thresholds computed by the shards of the messy
+        records, or None if none of the records have a shard.
+        """
+        thresholds = [self.shards[shard_key].threshold(
+                          records, recall_weight=recall_weight)
+                      for shard_key, records in self._route(messy).items()]
+        return min(thresholds) if len(thresholds) > 0 else None
+
+    def _match_in_pool(self, routed, threshold, n_matches):
+        global _pool_gazetteer
+        # The largest shards are started first so that the smaller ones fill
+        # in the remaining time
+        tasks = sorted(
+            ((shard_key, records, threshold, n_matches)
+             for shard_key, records in routed.items()),
+            key=lambda task: -len(task[1]))
+        _pool_gazetteer = self
+        try:
+            context = multiprocessing.get_context('fork')
+            with context.Pool(min(self.processes, len(tasks))) as pool:
+                return zip([task[0] for task in tasks],
+                           pool.map(_match_shard, tasks))
+        finally:
+            _pool_gazetteer = None
+
+    def _match_in_process(self, routed, threshold, n_matches):
+        for shard_key, records in routed.items():
+            try:
+                yield shard_key, self.shards[shard_key].match(
+                    records, threshold=threshold, n_matches=n_matches,
+                    generator=False)
+            except dedupe.core.BlockingError:
+                yield shard_key, None
+
+    def match(self, messy, threshold=0.5, n_matches=1, generator=False):
+        """
+        Score the messy records against the shards of their countries.
+
+        Returns:
+        The match clusters of all the shards, in the format returned by
+        `Gazetteer.match`. Raises `dedupe.core.BlockingError` if none of the
+        shards could block the records.
+        """
+        routed = self._route(messy)
+        if self.processes > 1 and len(routed) > 1:
+            shard_results = self._match_in_pool(routed, threshold, n_matches)
+        else:
+            shard_results = self._match_in_process(routed, threshold,
+                                                   n_matches)
+
+        results = []
+        is_blocked = False
+        for shard_key, clusters in shard_results:
+            if clusters is None:
+                continue
+            is_blocked = True
+            for cluster in clusters:
+                # A facility whose country changed stays in the index of its
+                # previous shard, where its old values would still match
+                cluster = [((messy_id, canon_id), score)
+                           for (messy_id, canon_id), score in cluster
+                           if self.record_shards.get(canon_id) == shard_key]
+                if len(cluster) > 0:
+                    results.append(cluster)
+
+        if not is_blocked and len(routed) > 0:
+            raise dedupe.core.BlockingError(
+                'None of the shards could block the records')
+        return iter(results) if generator else results
+
+    def writeSettings(self, file_obj, index=False):
+        """
+        Write the shards in the format read by `read_settings`.
+        """
+        shard_keys = list(self.shards.keys())
+        pickle.dump({
+            'model_settings': self.model_settings,
+            'shard_keys': self.shard_keys,
+            'record_shards': self.record_shards,
+            'shards': shard_keys,
+        }, file_obj, protocol=pickle.HIGHEST_PROTOCOL)
+        for shard_key in shard_keys:
+            self.shards[shard_key].writeSettings(file_obj, index=index)
+
+    @classmethod
+    def read_settings(cls, file_obj, processes=1):
+        header = pickle.load(file_obj)
+        shards = {}
+        for shard_key in header['shards']:
+            shards[shard_key] = dedupe.StaticGazetteer(file_obj)
+        return cls(header['model_settings'], shards, header['shard_keys'],
+                   header['record_shards'], processes=processes)
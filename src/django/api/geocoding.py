@@ -1,10 +1,37 @@
+import hashlib
+import json
+import time
+
+from collections import Counter
+from datetime import timedelta
+
 from django.conf import settings
+from django.db import connection
+from django.db.models import Count, F, Sum
+from django.utils import timezone
 
 import requests
 
+from api.models import GeocodingCacheEntry
+
 
+OK = "OK"
 ZERO_RESULTS = "ZERO_RESULTS"
-GEOCODING_URL = "https://maps.googleapis.com/maps/api/geocode/json"
+OVER_QUERY_LIMIT = "OVER_QUERY_LIMIT"
+UNKNOWN_ERROR = "UNKNOWN_ERROR"
+
+# Other statuses, like OVER_QUERY_LIMIT, are transient and are not cached
+CACHEABLE_STATUSES = (OK, ZERO_RESULTS)
+
+# Eviction runs after every EVICTION_INTERVAL entries are added rather than
+# after every insert
+EVICTION_INTERVAL = 100
+
+# Hit and miss counts for the current process, and the number of
+# milliseconds that hits saved compared to the original requests. The
+# `geocoding_cache_stats` management command reports the hits recorded on
+# the stored entries, which are shared by all processes.
+geocoding_cache_stats = Counter()
 
 
 def create_geocoding_params(address, country_code):
@@ -46,16 +73,207 @@ def validate_country_code(data, country_code):
     raise ValueError("Geocoding results did not match provided country code.")
 
 
-def geocode_address(address, country_code):
+class GeocodingRequestError(ValueError):
+    def __init__(self, status_code):
+        super(GeocodingRequestError, self).__init__(
+            'Geocoding request failed with status {}'.format(status_code))
+        self.status_code = status_code
+
+
+def normalize_geocoding_address(address):
+    return ' '.join(address.lower().split())
+
+
+def make_geocoding_key(address, country_code):
+    data = '{}|{}'.format(country_code.upper(),
+                          normalize_geocoding_address(address))
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def request_geocoding(address, country_code, session=requests):
+    """
+    Send a request to the geocoding API.
+
+    Arguments:
+    address (str) -- The address to geocode.
+    country_code (str) -- The country to which results are restricted.
+    session -- The `requests` module or a `requests.Session` used to send the
+               request.
+
+    Returns:
+    A (data, duration) tuple of the response payload and the time taken by
+    the request in milliseconds.
+    """
     params = create_geocoding_params(address, country_code)
-    r = requests.get(GEOCODING_URL, params=params)
+    started = time.monotonic()
+    r = session.get(settings.GEOCODING_API_URL, params=params)
 
     if r.status_code != 200:
-        raise ValueError("Geocoding request failed with status"
-                         .format(r.status_code))
+        raise GeocodingRequestError(r.status_code)
+
+    duration = int((time.monotonic() - started) * 1000)
+    return r.json(), duration
+
+
+def get_cached_geocoding_response(address, country_code):
+    """
+    Fetch an unexpired cached response and record the access.
+
+    Returns:
+    A (data, duration) tuple, or None if there is no unexpired entry.
+    """
+    expired_at = timezone.now() - timedelta(
+        days=settings.GEOCODING_CACHE_TTL_IN_DAYS)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {} SET hits = hits + 1, last_accessed_at = %s '
+            'WHERE key = %s AND created_at > %s '
+            'RETURNING response, duration'.format(
+                GeocodingCacheEntry._meta.db_table),
+            [timezone.now(), make_geocoding_key(address, country_code),
+             expired_at])
+        return cursor.fetchone()
+
+
+def set_cached_geocoding_response(address, country_code, data, duration):
+    """
+    Store a response, replacing any expired entry for the same address and
+    country code and counting the request as a miss, and periodically evict
+    expired and least recently used entries.
+    """
+    results = data.get('results', [])
+    geocoded_address = results[0].get('formatted_address') \
+        if len(results) > 0 else None
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {table} '
+            '  (key, address, country_code, result_count, geocoded_address, '
+            '   response, duration, hits, misses, created_at, '
+            '   last_accessed_at) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, 0, 1, %s, %s) '
+            'ON CONFLICT (key) DO UPDATE SET '
+            '  result_count = EXCLUDED.result_count, '
+            '  geocoded_address = EXCLUDED.geocoded_address, '
+            '  response = EXCLUDED.response, '
+            '  duration = EXCLUDED.duration, '
+            '  misses = {table}.misses + 1, '
+            '  created_at = EXCLUDED.created_at, '
+            '  last_accessed_at = EXCLUDED.last_accessed_at '
+            'RETURNING id'.format(table=GeocodingCacheEntry._meta.db_table),
+            [make_geocoding_key(address, country_code),
+             normalize_geocoding_address(address), country_code.upper(),
+             len(results), geocoded_address, json.dumps(data), duration,
+             now, now])
+        entry_id = cursor.fetchone()[0]
+    if entry_id % EVICTION_INTERVAL == 0:
+        evict_geocoding_cache(settings.GEOCODING_CACHE_MAX_ENTRIES,
+                              settings.GEOCODING_CACHE_TTL_IN_DAYS)
+
+
+def evict_geocoding_cache(max_entries, ttl_in_days):
+    """
+    Delete entries older than `ttl_in_days` and then the least recently used
+    entries until there are no more than `max_entries`.
+
+    Returns:
+    The number of entries deleted.
+    """
+    table = GeocodingCacheEntry._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM {} WHERE created_at <= %s'.format(table),
+            [timezone.now() - timedelta(days=ttl_in_days)])
+        deleted = cursor.rowcount
+        cursor.execute(
+            'DELETE FROM {table} WHERE id IN ('
+            '  SELECT id FROM {table} '
+            '  ORDER BY last_accessed_at DESC, id DESC OFFSET %s'
+            ')'.format(table=table),
+            [max_entries])
+        return deleted + cursor.rowcount
+
+
+def get_geocoding_response(address, country_code):
+    """
+    Return the geocoding API response for an address, from the cache if the
+    same normalized address and country code have been geocoded before. The
+    cache is bypassed if GEOCODING_CACHE_MAX_ENTRIES is 0.
+    """
+    if settings.GEOCODING_CACHE_MAX_ENTRIES <= 0:
+        data, _ = request_geocoding(address, country_code)
+        return data
+
+    started = time.monotonic()
+    cached = get_cached_geocoding_response(address, country_code)
+    if cached is not None:
+        data, duration = cached
+        lookup_duration = int((time.monotonic() - started) * 1000)
+        geocoding_cache_stats['hits'] += 1
+        geocoding_cache_stats['saved_ms'] += max(duration - lookup_duration,
+                                                 0)
+        return data
+
+    geocoding_cache_stats['misses'] += 1
+    data, duration = request_geocoding(address, country_code)
+    if data.get('status') in CACHEABLE_STATUSES:
+        set_cached_geocoding_response(address, country_code, data, duration)
+    return data
+
+
+def get_geocoding_cache_summary():
+    """
+    Returns:
+    A dict with the number of cached entries, the number of requests they
+    have saved, the hit rate of lookups of their addresses, and the total
+    duration of the saved requests in seconds.
+    """
+    summary = GeocodingCacheEntry.objects.aggregate(
+        entries=Count('id'), hits=Sum('hits'), misses=Sum('misses'),
+        saved_ms=Sum(F('hits') * F('duration')))
+    hits = summary['hits'] or 0
+    misses = summary['misses'] or 0
+    return {
+        'entries': summary['entries'],
+        'hits': hits,
+        'misses': misses,
+        'hit_rate': hits / (hits + misses) if hits + misses > 0 else 0,
+        'saved_seconds': (summary['saved_ms'] or 0) / 1000,
+    }
+
+
+def clear_geocoding_cache():
+    GeocodingCacheEntry.objects.all().delete()
+
+
+def geocode_address(address, country_code):
+    data = get_geocoding_response(address, country_code)
+    return format_geocoding_response(data, country_code)
+
+
+def make_memoized_geocoder(geocode=geocode_address):
+    """
+    Wrap a geocoding function so that addresses that normalize to the same
+    geocoding key are only geocoded once. Failed requests are not remembered.
+
+    Arguments:
+    geocode -- A function with the same signature as `geocode_address`.
+
+    Returns:
+    A function with the same signature as `geocode_address`.
+    """
+    responses = {}
+
+    def memoized_geocode(address, country_code):
+        key = make_geocoding_key(address, country_code)
+        if key not in responses:
+            responses[key] = geocode(address, country_code)
+        return responses[key]
+
+    return memoized_geocode
 
-    data = r.json()
 
+def format_geocoding_response(data, country_code):
     if data["status"] == ZERO_RESULTS or len(data["results"]) == 0:
         return format_no_geocode_results(data)
 
@@ -1,5 +1,7 @@
 import re
 
+from unidecode import unidecode
+
 CONSONANT_SOUND = re.compile(r'''
 one(![ir])
 ''', re.IGNORECASE | re.VERBOSE)
@@ -20,3 +22,23 @@ def prefix_a_an(value):
     if not CONSONANT_SOUND.match(value) and VOWEL_SOUND.match(value):
         return 'An {}'.format(value)
     return 'A {}'.format(value)
+
+
+def clean(column):
+    """
+    Remove punctuation and excess whitespace from a value before using it to
+    find matches. This should be the same function used when developing the
+    training data read from training.json as part of train_gazetteer.
+    """
+    column = unidecode(column)
+    column = re.sub('\n', ' ', column)
+    column = re.sub('-', '', column)
+    column = re.sub('/', ' ', column)
+    column = re.sub("'", '', column)
+    column = re.sub(",", '', column)
+    column = re.sub(":", ' ', column)
+    column = re.sub(' +', ' ', column)
+    column = column.strip().strip('"').strip("'").lower().strip()
+    if not column:
+        column = None
+    return column
@@ -0,0 +1,41 @@
+import logging
+import time
+
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+
+@contextmanager
+def instrument_queries(label):
+    """
+    Log the SQL, parameters and duration of every query executed within the
+    block, followed by a summary. Does nothing unless QUERY_INSTRUMENTATION is
+    enabled.
+
+    Arguments:
+    label (string) -- Included in each log message to identify the block.
+    """
+    if not settings.QUERY_INSTRUMENTATION:
+        yield
+        return
+
+    durations = []
+
+    def log_query(execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = (time.monotonic() - started) * 1000
+            durations.append(duration)
+            logger.info('{} query {:.1f}ms: {} {}'.format(
+                label, duration, sql, params))
+
+    with connection.execute_wrapper(log_query):
+        yield
+    logger.info('{}: {} queries, {:.1f}ms'.format(
+        label, len(durations), sum(durations)))
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api.models import Facility, FacilityListItem
+
+
+class Command(BaseCommand):
+    help = ('Store the clean name and address of the facilities and list '
+            'items that were saved before the clean columns were added. '
+            'History records are not written.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            help='The number of rows updated by each query',
+            default=1000,
+        )
+
+    def backfill(self, model, batch_size):
+        missing = model.objects.filter(
+            Q(clean_name__isnull=True) | Q(clean_address__isnull=True))
+        count = 0
+        last_id = None
+        while True:
+            batch = missing.order_by('id')
+            if last_id is not None:
+                batch = batch.filter(id__gt=last_id)
+            batch = list(batch.only('id', 'name', 'address')[:batch_size])
+            if len(batch) == 0:
+                return count
+            for instance in batch:
+                instance.set_clean_fields()
+            model.objects.bulk_update(
+                batch, ['clean_name', 'clean_address'])
+            count += len(batch)
+            last_id = batch[-1].id
+            self.stdout.write('Updated {} {} rows'.format(
+                count, model._meta.object_name))
+
+    def handle(self, *args, **options):
+        for model in (Facility, FacilityListItem):
+            count = self.backfill(model, options['batch_size'])
+            self.stdout.write('Backfilled {} {} rows'.format(
+                count, model._meta.object_name))
@@ -1,15 +1,22 @@
 import os
 import sys
 
+from functools import partial
+
 from django.core.management.base import BaseCommand
 from django.db import transaction
 
+from api.aws_batch import ARRAY_CHUNK_SIZE_VARIABLE
+from api.concurrent_geocoding import geocode_list_items
 from api.constants import ProcessingAction
+from api.geocoding import make_memoized_geocoder
 from api.models import FacilityList, FacilityListItem
 from api.matching import match_facility_list_items
 from api.processing import (parse_facility_list_item,
+                            parse_facility_list_items,
                             geocode_facility_list_item,
-                            save_match_details)
+                            save_match_details,
+                            save_match_details_in_bulk)
 from api.mail import notify_facility_list_complete
 
 LINE_ITEM_ACTIONS = {
@@ -22,11 +29,18 @@ LIST_ACTIONS = set([ProcessingAction.MATCH, ProcessingAction.NOTIFY_COMPLETE])
 VALID_ACTIONS = list(LINE_ITEM_ACTIONS.keys()) + list(LIST_ACTIONS)
 
 
+def get_array_chunk_size():
+    return int(os.environ.get(ARRAY_CHUNK_SIZE_VARIABLE) or 1)
+
+
 class Command(BaseCommand):
     help = 'Run an action on all items in a facility list. If ' \
            'AWS_BATCH_JOB_ARRAY_INDEX environment variable is set, will ' \
-           'process those items whose row_index matches it. Otherwise, will ' \
-           'process all items for the given facility list.'
+           'process those items whose row_index matches it, or, if ' \
+           'BATCH_ARRAY_CHUNK_SIZE is also set, the contiguous range of ' \
+           'that many rows starting at AWS_BATCH_JOB_ARRAY_INDEX * ' \
+           'BATCH_ARRAY_CHUNK_SIZE. Otherwise, will process all items for ' \
+           'the given facility list.'
 
     def add_arguments(self, parser):
         # Create a group of arguments explicitly labeled as required,
@@ -39,6 +53,17 @@ class Command(BaseCommand):
         group.add_argument('-l', '--list-id',
                            required=True,
                            help='The id of the facility list to process.')
+        parser.add_argument('--bulk',
+                            action='store_true',
+                            help='When matching, save matches, facilities, '
+                                 'and item results with bulk queries and '
+                                 'update the facility index once at the end.')
+        parser.add_argument('--concurrency',
+                            type=int,
+                            default=1,
+                            help='When geocoding, the number of geocoding '
+                                 'requests to send in parallel. Items are '
+                                 'saved in batches when greater than 1.')
 
     def handle(self, *args, **options):
         action = options['action']
@@ -53,6 +78,10 @@ class Command(BaseCommand):
 
         if action in LINE_ITEM_ACTIONS.keys():
             process = LINE_ITEM_ACTIONS[action]
+        if action == ProcessingAction.GEOCODE:
+            # Rows of the list that repeat an address are geocoded once
+            process = partial(geocode_facility_list_item,
+                              geocode=make_memoized_geocoder())
 
         # Crash if invalid list_id specified
         try:
@@ -62,19 +91,34 @@ class Command(BaseCommand):
                               'No facility list with id {}.'.format(list_id))
             sys.exit(1)
 
-        if action in LINE_ITEM_ACTIONS.keys():
+        # Chunks of rows are geocoded with a single pooled session and saved
+        # in batches, even without concurrency
+        is_chunked = get_array_chunk_size() > 1
+        if action == ProcessingAction.GEOCODE \
+           and (options['concurrency'] > 1 or is_chunked):
+            self.geocode_items_concurrently(facility_list,
+                                            options['concurrency'])
+        elif action == ProcessingAction.PARSE:
+            self.parse_items(facility_list)
+        elif action in LINE_ITEM_ACTIONS.keys():
             self.process_items(facility_list, action, process)
         elif action == ProcessingAction.MATCH:
             facility_list = FacilityList.objects.get(id=list_id)
-            total_item_count = \
-                facility_list.source.facilitylistitem_set.count()
+            # Items that reused the facility of an item of a replaced list
+            # were completed when they were parsed
+            total_item_count = facility_list.source.facilitylistitem_set \
+                .exclude(status__in=FacilityListItem.COMPLETE_STATUSES) \
+                .count()
 
             result = match_facility_list_items(facility_list)
             success_count = len(result['processed_list_item_ids'])
             fail_count = total_item_count - success_count
 
             with transaction.atomic():
-                save_match_details(result)
+                if options['bulk']:
+                    save_match_details_in_bulk(result)
+                else:
+                    save_match_details(result)
 
             if success_count > 0:
                 self.stdout.write(
@@ -89,15 +133,38 @@ class Command(BaseCommand):
         elif action == ProcessingAction.NOTIFY_COMPLETE:
             notify_facility_list_complete(list_id)
 
-    def process_items(self, facility_list, action, process):
-        row_index = os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX')
-        if row_index:
-            items = FacilityListItem.objects.filter(
+    def get_items(self, facility_list):
+        array_index = os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX')
+        if array_index:
+            chunk_size = get_array_chunk_size()
+            start = int(array_index) * chunk_size
+            return FacilityListItem.objects.filter(
                 source=facility_list.source,
-                row_index=row_index)
-        else:
-            items = FacilityListItem.objects.filter(
-                source=facility_list.source)
+                row_index__gte=start,
+                row_index__lt=start + chunk_size).order_by('row_index')
+        return FacilityListItem.objects.filter(source=facility_list.source)
+
+    def parse_items(self, facility_list):
+        result = parse_facility_list_items(facility_list,
+                                           self.get_items(facility_list))
+        for error in result['errors']:
+            self.stderr.write('Value Error: {}'.format(error))
+        self.write_result(ProcessingAction.PARSE, result)
+        if result['reused'] > 0:
+            self.stdout.write(
+                '{}: {} reused from the replaced list, {} with a '
+                'facility'.format(ProcessingAction.PARSE, result['reused'],
+                                  result['reused_matches']))
+
+    def geocode_items_concurrently(self, facility_list, concurrency):
+        result = geocode_list_items(self.get_items(facility_list),
+                                    concurrency=concurrency)
+        for error in result['errors']:
+            self.stderr.write('Value Error: {}'.format(error))
+        self.write_result(ProcessingAction.GEOCODE, result)
+
+    def process_items(self, facility_list, action, process):
+        items = self.get_items(facility_list)
 
         result = {
             'success': 0,
@@ -134,6 +201,9 @@ class Command(BaseCommand):
                 self.stderr.write('Value Error: {}'.format(e))
                 result['failure'] += 1
 
+        self.write_result(action, result)
+
+    def write_result(self, action, result):
         # Print successes
         if result['success'] > 0:
             self.stdout.write(
@@ -0,0 +1,101 @@
+import random
+import sys
+
+from datetime import datetime
+
+import mercantile
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.http import QueryDict
+
+from api.facility_grid import get_precomputed_facility_grid_vector_tile
+from api.models import FacilityGridCell, FacilityIndex
+from api.tiler import get_joined_facility_grid_vector_tile
+
+
+def percentile(durations, percent):
+    durations = sorted(durations)
+    index = min(len(durations) - 1,
+                int(round(percent / 100 * (len(durations) - 1))))
+    return durations[index]
+
+
+class Command(BaseCommand):
+    help = ('Report p50 and p99 facilitygrid tile latency when joining a '
+            'generated hex grid to the facilities and when summing the '
+            'precomputed cell counts.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n',
+            '--samples',
+            type=int,
+            default=100,
+            help='The number of tiles to render at each zoom level',
+        )
+        parser.add_argument(
+            '-z',
+            '--zooms',
+            type=int,
+            nargs='+',
+            default=[2, 5, 8, 11],
+            help='The zoom levels to sample',
+        )
+        parser.add_argument(
+            '-q',
+            '--query',
+            default='',
+            help='A tile query string, e.g. "countries=CN"',
+        )
+
+    def measure(self, render, tiles):
+        durations = []
+        for z, x, y in tiles:
+            started = datetime.now()
+            render(z, x, y)
+            durations.append(
+                (datetime.now() - started).total_seconds() * 1000)
+        return durations
+
+    def report(self, label, durations):
+        self.stdout.write('  {}: p50 {:.1f}ms, p99 {:.1f}ms'.format(
+            label, percentile(durations, 50), percentile(durations, 99)))
+
+    def handle(self, *args, **options):
+        params = QueryDict(options['query'])
+        locations = list(FacilityIndex.objects.values_list(
+            'location', flat=True)[:10000])
+        if len(locations) == 0:
+            self.stderr.write('There are no indexed facilities')
+            sys.exit(1)
+
+        def joined(z, x, y):
+            get_joined_facility_grid_vector_tile(
+                params, 'facilitygrid', z, x, y)
+            # The joined query creates a temporary table that would otherwise
+            # exist until the connection is closed
+            with connection.cursor() as cursor:
+                cursor.execute('DROP TABLE IF EXISTS hex_grid')
+
+        def precomputed(z, x, y):
+            tile = get_precomputed_facility_grid_vector_tile(
+                params, 'facilitygrid', z, x, y)
+            if tile is None:
+                raise Exception(
+                    'Tile {}/{}/{} cannot be created from the precomputed '
+                    'counts. Run refresh_facility_grid and check that the '
+                    'query can be precomputed.'.format(z, x, y))
+
+        for z in options['zooms']:
+            if z > FacilityGridCell.MAX_ZOOM:
+                self.stderr.write('Skipping zoom {}, which is above the '
+                                  'facility grid maximum'.format(z))
+                continue
+            tiles = [(z, tile.x, tile.y) for tile in (
+                mercantile.tile(location.x, location.y, z)
+                for location in random.choices(locations,
+                                               k=options['samples']))]
+            self.stdout.write('Zoom {} ({} tiles)'.format(z, len(tiles)))
+            self.report('Joined', self.measure(joined, tiles))
+            self.report('Precomputed', self.measure(precomputed, tiles))
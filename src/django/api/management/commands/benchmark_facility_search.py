@@ -0,0 +1,154 @@
+import random
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.http import QueryDict
+from faker import Faker
+
+from api.constants import FacilitiesQueryParams
+from api.models import FacilityIndex
+from api.management.commands.makefixtures import COUNTRY_CODES
+
+TRIGRAM_INDEXES = ('api_facilityindex_name_trgm',
+                   'api_facilityindex_id_trgm',
+                   'api_facilityindex_ppe_trgm')
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_free_text_filter(query):
+    """
+    The original `q` filter, which matches a substring of the OAR ID and
+    cannot use an index. Kept here as the baseline for the benchmark.
+    """
+    return (Q(name__icontains=query)
+            | Q(id__icontains=query)
+            | Q(ppe__icontains=query))
+
+
+class Command(BaseCommand):
+    help = ('Fill the facility index with synthetic rows and compare the '
+            'latency of free text facility searches with and without the '
+            'trigram indexes. All changes are rolled back when the command '
+            'finishes, but the facility index is locked while it runs, so it '
+            'should not be run against a production database.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-r',
+            '--rows',
+            type=int,
+            default=1000000,
+            help='The number of synthetic facilities to add to the index',
+        )
+        parser.add_argument(
+            '-n',
+            '--samples',
+            type=int,
+            default=20,
+            help='The number of searches to run for each kind of query',
+        )
+
+    def insert_rows(self, count):
+        # Names are drawn from a pool of fake company names, like the ones
+        # generated by makefixtures, with a number appended to keep them
+        # distinct. OAR IDs follow the country and date prefix layout
+        # produced by make_oar_id.
+        fake = Faker()
+        names = [fake.company().upper() for _ in range(5000)]
+        products = ['MASKS', 'GLOVES', 'GOWNS', 'FACE SHIELDS', '']
+        countries = sorted(set(COUNTRY_CODES.values()))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'INSERT INTO api_facilityindex '
+                '  (id, name, country_code, location, contrib_types, '
+                '   contributors, lists, ppe) '
+                'SELECT '
+                '  country || \'2021\' '
+                '    || lpad((i %% 365 + 1)::text, 3, \'0\') '
+                '    || upper(substr(md5(i::text), 1, 6)), '
+                '  names[1 + i %% array_length(names, 1)] || \' \' || i, '
+                '  country, '
+                '  ST_SetSRID(ST_MakePoint('
+                '    random() * 360 - 180, random() * 170 - 85), 4326), '
+                '  \'{}\', \'{}\', \'{}\', '
+                '  products[1 + i %% array_length(products, 1)] '
+                'FROM generate_series(1, %s) AS i, '
+                '  (SELECT %s::text[] AS countries, %s::text[] AS names, '
+                '    %s::text[] AS products) AS p, '
+                '  LATERAL (SELECT countries[1 + i %% array_length('
+                '    countries, 1)] AS country) AS c '
+                'ON CONFLICT DO NOTHING',
+                [count, countries, names, products])
+            cursor.execute('ANALYZE api_facilityindex')
+        return names
+
+    def get_queries(self, names, samples):
+        ids = list(FacilityIndex.objects.order_by('?').values_list(
+            'id', flat=True)[:samples])
+        words = [random.choice(name.split()) for name in
+                 random.sample(names, samples)]
+        return {
+            'Name word': words,
+            'Name prefix (3 chars)': [w[:3] for w in words],
+            'Full OAR ID': ids,
+            'OAR ID prefix': [id[:6] for id in ids],
+        }
+
+    def measure(self, search, queries):
+        durations = []
+        for query in queries:
+            started = datetime.now()
+            # Count and fetch the first page, as the facilities list does
+            queryset = search(query)
+            queryset.count()
+            list(queryset.order_by('name').values_list('id', flat=True)[:50])
+            durations.append(
+                (datetime.now() - started).total_seconds() * 1000)
+        durations.sort()
+        return (durations[len(durations) // 2],
+                durations[int(round(0.99 * (len(durations) - 1)))])
+
+    def handle(self, *args, **options):
+        def search(query):
+            params = QueryDict(mutable=True)
+            params[FacilitiesQueryParams.Q] = query
+            return FacilityIndex.objects.filter_by_query_params(params)
+
+        def legacy_search(query):
+            return FacilityIndex.objects.filter(
+                legacy_free_text_filter(query))
+
+        try:
+            with transaction.atomic():
+                started = datetime.now()
+                names = self.insert_rows(options['rows'])
+                self.stdout.write('Inserted {} rows in {}'.format(
+                    options['rows'], datetime.now() - started))
+                queries = self.get_queries(names, options['samples'])
+
+                results = {}
+                for label, values in queries.items():
+                    results[label] = [self.measure(search, values)]
+
+                with connection.cursor() as cursor:
+                    for index in TRIGRAM_INDEXES:
+                        cursor.execute('DROP INDEX {}'.format(index))
+                for label, values in queries.items():
+                    results[label].append(
+                        self.measure(legacy_search, values))
+
+                for label, (indexed, legacy) in results.items():
+                    self.stdout.write(
+                        '{}: indexed p50 {:.1f}ms p99 {:.1f}ms, '
+                        'legacy p50 {:.1f}ms p99 {:.1f}ms'.format(
+                            label, indexed[0], indexed[1],
+                            legacy[0], legacy[1]))
+                raise Rollback()
+        except Rollback:
+            self.stdout.write('Rolled back the synthetic rows')
@@ -0,0 +1,84 @@
+import tracemalloc
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.db.models import Q
+from django.test.utils import CaptureQueriesContext
+
+from api.helpers import clean
+from api.models import Facility, FacilityListItem, FacilityMatch
+from api.matching import (get_canonical_items,
+                          get_messy_items_for_training,
+                          match_to_extended_facility_id)
+
+
+def get_canonical_items_one_query_per_match():
+    """
+    The original canonical loader, which reads the facility and item of each
+    confirmed match with their own queries. Kept here as the baseline for the
+    benchmark.
+    """
+    facility_set = Facility.objects.all().extra(
+        select={'country': 'country_code'}).values(
+            'id', 'country', 'name', 'address')
+    items = {str(i['id']):
+             {k: clean(i[k]) for k in i if k != 'id'}
+             for i in facility_set}
+    items.update({match_to_extended_facility_id(m): {
+        'country': clean(m.facility_list_item.country_code),
+        'name': clean(m.facility_list_item.name),
+        'address': clean(m.facility_list_item.address),
+    } for m in FacilityMatch.objects.filter(status=FacilityMatch.CONFIRMED)})
+    return items
+
+
+def get_messy_items_for_training_in_python(mod_factor=5):
+    """
+    The original training loader, which reads every eligible item and keeps
+    one in `mod_factor` of them. Kept here as the baseline for the benchmark.
+    """
+    facility_list_item_set = FacilityListItem.objects.exclude(
+        Q(status=FacilityListItem.UPLOADED)
+        | Q(status=FacilityListItem.ERROR)
+        | Q(status=FacilityListItem.ERROR_PARSING)
+        | Q(status=FacilityListItem.ERROR_GEOCODING)
+        | Q(status=FacilityListItem.ERROR_MATCHING)
+    ).extra(
+            select={'country': 'country_code'}).values(
+                'id', 'country', 'name', 'address')
+    records = [record for (i, record) in enumerate(facility_list_item_set)
+               if i % mod_factor == 0]
+    return {str(i['id']): {k: clean(i[k]) for k in i if k != 'id'}
+            for i in records}
+
+
+class Command(BaseCommand):
+    help = ('Report the number of queries, time and peak memory used to load '
+            'the canonical and training items of a gazetteer rebuild, '
+            'comparing the original loaders with the streaming loaders.')
+
+    def measure(self, label, load_canonical, load_messy):
+        tracemalloc.start()
+        started = datetime.now()
+        with CaptureQueriesContext(connection) as queries:
+            with transaction.atomic():
+                canonical = load_canonical()
+                messy = load_messy()
+        duration = datetime.now() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        self.stdout.write(
+            '{}: {} canonical items, {} training items, {} queries, {}, '
+            'peak memory {:.1f} MB'.format(
+                label, len(canonical), len(messy), len(queries), duration,
+                peak / 1024 / 1024))
+
+    def handle(self, *args, **options):
+        self.measure('Before (query per match, sampled in Python)',
+                     get_canonical_items_one_query_per_match,
+                     get_messy_items_for_training_in_python)
+        self.measure('After (joined and streamed, sampled in the database)',
+                     get_canonical_items,
+                     get_messy_items_for_training)
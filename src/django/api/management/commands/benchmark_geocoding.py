@@ -0,0 +1,65 @@
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.concurrent_geocoding import (TokenBucket,
+                                      create_geocoding_session,
+                                      request_geocoding_with_retries)
+
+
+class Command(BaseCommand):
+    help = ('Measure the throughput of geocoding requests at several levels '
+            'of concurrency. Requests are sent to GEOCODING_API_URL, which '
+            'should be pointed at the geocoding_stub_server command rather '
+            'than the Google API. The geocoding cache is not used.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-n',
+            '--requests',
+            type=int,
+            default=500,
+            help='The number of requests to send at each level',
+        )
+        parser.add_argument(
+            '-c',
+            '--concurrency',
+            type=int,
+            nargs='+',
+            default=[1, 4, 8, 16, 32],
+            help='The levels of concurrency to measure',
+        )
+        parser.add_argument(
+            '-r',
+            '--rate',
+            type=float,
+            default=0,
+            help='The maximum number of requests per second. 0 disables the '
+                 'limit',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write('Sending requests to {}'.format(
+            settings.GEOCODING_API_URL))
+        for concurrency in options['concurrency']:
+            session = create_geocoding_session(concurrency)
+            rate_limiter = TokenBucket(options['rate'])
+            addresses = ['{} Benchmark Street {}'.format(i, time.time())
+                         for i in range(options['requests'])]
+            started = time.monotonic()
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = [
+                    executor.submit(request_geocoding_with_retries, address,
+                                    'US', session, rate_limiter)
+                    for address in addresses]
+                for future in futures:
+                    future.result()
+            elapsed = time.monotonic() - started
+            self.stdout.write(
+                'Concurrency {}: {} requests in {:.1f}s '
+                '({:.1f} requests/s)'.format(
+                    concurrency, len(addresses), elapsed,
+                    len(addresses) / elapsed))
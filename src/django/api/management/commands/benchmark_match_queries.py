@@ -0,0 +1,84 @@
+import sys
+
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+from api.models import Facility, FacilityList
+from api.matching import (GazetteerCache,
+                          MatchDefaults,
+                          filter_matches_to_existing_facilities,
+                          get_messy_items_from_facility_list,
+                          normalize_extended_facility_id)
+
+
+def filter_matches_one_query_per_result(results):
+    """
+    The original match result post-processing, which checks the existence of
+    each matched facility with its own query. Kept here as the baseline for
+    the benchmark.
+    """
+    for matches in results:
+        for (messy_id, canon_id), score in matches:
+            facility_exists = Facility \
+                .objects \
+                .filter(pk=normalize_extended_facility_id(canon_id)) \
+                .exists()
+            if facility_exists:
+                yield (messy_id, canon_id, score)
+
+
+class Command(BaseCommand):
+    help = ('Report the number of queries and time used to post-process '
+            'gazetteer match results for a facility list, comparing one '
+            'query per result with chunked set-based queries.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('-l', '--list-id',
+                            required=True,
+                            help='The id of the facility list to match.')
+
+    def measure(self, label, filter_results, results):
+        started = datetime.now()
+        with CaptureQueriesContext(connection) as queries:
+            filtered = list(filter_results(results))
+        duration = datetime.now() - started
+        self.stdout.write('{}: {} results, {} queries, {}'.format(
+            label, len(filtered), len(queries), duration))
+        return filtered
+
+    def handle(self, *args, **options):
+        list_id = options['list_id']
+        try:
+            facility_list = FacilityList.objects.get(pk=list_id)
+        except FacilityList.DoesNotExist:
+            self.stderr.write('Validation Error: '
+                              'No facility list with id {}.'.format(list_id))
+            sys.exit(1)
+
+        messy = get_messy_items_from_facility_list(facility_list)
+        if len(messy.keys()) == 0:
+            self.stderr.write('List {} has no geocoded items.'.format(
+                list_id))
+            sys.exit(1)
+
+        gazetteer = GazetteerCache.get_latest()
+        gazetteer.threshold(messy, recall_weight=MatchDefaults.RECALL_WEIGHT)
+        # Materialize the results so that both strategies post-process the
+        # same matches and only the existence checks are measured
+        results = gazetteer.match(
+            messy, threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+            n_matches=None, generator=False)
+
+        self.stdout.write('List {}: {} items, {} match clusters'.format(
+            list_id, len(messy.keys()), len(results)))
+        before = self.measure('Before (query per result)',
+                              filter_matches_one_query_per_result, results)
+        after = self.measure('After (chunked)',
+                             filter_matches_to_existing_facilities, results)
+
+        if before != after:
+            self.stderr.write('Filtered results differ')
+            sys.exit(1)
@@ -0,0 +1,40 @@
+from datetime import datetime
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.matching import (GazetteerCache,
+                          get_peak_memory_mb,
+                          write_gazetteer_snapshot)
+
+
+class Command(BaseCommand):
+    help = ('Train and index a gazetteer and write it to disk so that web '
+            'and batch processes can load it instead of training their own.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--path',
+            help=('The file to which the snapshot will be written. Defaults '
+                  'to the GAZETTEER_SNAPSHOT_PATH setting.'),
+            default=None,
+        )
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.GAZETTEER_SNAPSHOT_PATH
+        if not path:
+            raise CommandError('Specify --path or set '
+                               'GAZETTEER_SNAPSHOT_PATH')
+
+        started = datetime.now()
+        gazetteer, facility_version, match_version = \
+            GazetteerCache.build_gazetteer()
+        header = write_gazetteer_snapshot(
+            gazetteer, facility_version, match_version, path)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Wrote gazetteer snapshot to {} (facility version {}, match '
+            'version {}) in {}, peak memory {:.0f} MB'.format(
+                path, header['facility_version'], header['match_version'],
+                datetime.now() - started, get_peak_memory_mb())))
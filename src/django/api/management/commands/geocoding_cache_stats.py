@@ -0,0 +1,38 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.geocoding import (clear_geocoding_cache,
+                           evict_geocoding_cache,
+                           get_geocoding_cache_summary)
+
+
+class Command(BaseCommand):
+    help = ('Report the size of the geocoding cache and the requests and '
+            'time it has saved')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--evict',
+            action='store_true',
+            help='Delete expired and excess entries before reporting',
+        )
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Delete all cached responses after reporting',
+        )
+
+    def handle(self, *args, **options):
+        if options['evict']:
+            deleted = evict_geocoding_cache(
+                settings.GEOCODING_CACHE_MAX_ENTRIES,
+                settings.GEOCODING_CACHE_TTL_IN_DAYS)
+            self.stdout.write('Evicted {} entries'.format(deleted))
+        summary = get_geocoding_cache_summary()
+        self.stdout.write(
+            '{entries} cached responses, {hits} requests saved, '
+            '{misses} requests sent, {hit_rate:.1%} hit rate, '
+            '{saved_seconds:.1f}s of request time saved'.format(**summary))
+        if options['clear']:
+            clear_geocoding_cache()
+            self.stdout.write('Cleared the geocoding cache')
@@ -0,0 +1,111 @@
+import hashlib
+import json
+import random
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from django.core.management.base import BaseCommand
+
+
+def make_stub_response(address, country_code):
+    """
+    Build a geocoding API response with a single result at a point derived
+    from a hash of the address, so that repeated requests for the same
+    address return the same result.
+    """
+    digest = hashlib.md5(address.encode('utf-8')).digest()
+    lat = digest[0] / 255 * 160 - 80
+    lng = digest[1] / 255 * 360 - 180
+    return {
+        'status': 'OK',
+        'results': [{
+            'formatted_address': address,
+            'geometry': {
+                'location': {'lat': lat, 'lng': lng},
+                'location_type': 'APPROXIMATE',
+            },
+            'address_components': [{
+                'long_name': country_code,
+                'short_name': country_code,
+                'types': ['country', 'political'],
+            }],
+            'types': ['street_address'],
+        }],
+    }
+
+
+class Command(BaseCommand):
+    help = ('Run an HTTP server that imitates the geocoding API, so that the '
+            'throughput of batch geocoding can be measured without sending '
+            'requests to Google. Set GEOCODING_API_URL to '
+            'http://<host>:<port>/ to send geocoding requests to it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--port',
+            type=int,
+            default=8090,
+            help='The port on which to listen',
+        )
+        parser.add_argument(
+            '--latency',
+            type=int,
+            default=150,
+            help='The time taken to answer each request, in milliseconds',
+        )
+        parser.add_argument(
+            '--over-query-limit-rate',
+            type=float,
+            default=0,
+            help='The fraction of requests answered with OVER_QUERY_LIMIT',
+        )
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0,
+            help='The fraction of requests answered with a 503 status',
+        )
+
+    def handle(self, *args, **options):
+        latency = options['latency'] / 1000
+        over_query_limit_rate = options['over_query_limit_rate']
+        error_rate = options['error_rate']
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                time.sleep(latency)
+                roll = random.random()
+                if roll < error_rate:
+                    self.send_response(503)
+                    self.end_headers()
+                    return
+
+                if roll < error_rate + over_query_limit_rate:
+                    data = {'status': 'OVER_QUERY_LIMIT', 'results': []}
+                else:
+                    params = parse_qs(urlparse(self.path).query)
+                    address = params.get('address', [''])[0]
+                    components = params.get('components', ['country:'])[0]
+                    data = make_stub_response(
+                        address, components.split(':')[-1])
+
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer(('', options['port']), Handler)
+        self.stdout.write('Serving stub geocoding responses on port {}'.format(
+            options['port']))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.server_close()
@@ -1,5 +1,6 @@
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
+from api.facility_index import rebuild_facility_index
 from api.models import index_facilities
 
 
@@ -8,7 +9,36 @@ class Command(BaseCommand):
 
     def add_arguments(self, parser):
         parser.add_argument('facility_ids', type=str, nargs='*')
+        parser.add_argument(
+            '-c',
+            '--chunked',
+            action='store_true',
+            help=('Rebuild the whole index into a shadow table in chunks and '
+                  'swap it in when complete'),
+        )
+        parser.add_argument(
+            '-s',
+            '--chunk-size',
+            type=int,
+            default=5000,
+            help='The number of facilities to index per chunk',
+        )
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            default=1,
+            help='The number of processes used to build chunks',
+        )
 
     def handle(self, *args, **options):
         facility_ids = options.get('facility_ids', [])
-        index_facilities(facility_ids)
+        if options['chunked']:
+            if len(facility_ids) > 0:
+                raise CommandError(
+                    'Facility IDs cannot be specified with --chunked')
+            rebuild_facility_index(chunk_size=options['chunk_size'],
+                                   workers=options['workers'],
+                                   stdout=self.stdout)
+        else:
+            index_facilities(facility_ids)
@@ -0,0 +1,77 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from api.models import FacilityIndexQueue, index_facilities
+
+
+def process_queue_batch(batch_size):
+    """
+    Remove up to `batch_size` entries from the `FacilityIndexQueue` and
+    reindex the corresponding facilities in the same transaction. Rows locked
+    by another worker are skipped so that multiple workers can drain the queue
+    concurrently, and if reindexing fails the entries are left in the queue.
+
+    Arguments:
+    batch_size -- The maximum number of queue entries to process.
+
+    Returns:
+    The number of facilities that were reindexed.
+    """
+    table = FacilityIndexQueue._meta.db_table
+    with transaction.atomic():
+        with connection.cursor() as cursor:
+            cursor.execute(
+                ('DELETE FROM {table} WHERE id IN ('
+                 '  SELECT id FROM {table} ORDER BY id LIMIT %s '
+                 '  FOR UPDATE SKIP LOCKED'
+                 ') RETURNING facility_id').format(table=table),
+                [batch_size])
+            facility_ids = [row[0] for row in cursor.fetchall()]
+        if len(facility_ids) > 0:
+            index_facilities(facility_ids)
+    return len(facility_ids)
+
+
+class Command(BaseCommand):
+    help = ('Reindex the facilities that have been added to the facility '
+            'index queue.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=500,
+            help='The number of queued facilities to reindex per transaction',
+        )
+        parser.add_argument(
+            '-w',
+            '--watch',
+            action='store_true',
+            help='Keep polling the queue instead of exiting once it is empty',
+        )
+        parser.add_argument(
+            '-i',
+            '--interval',
+            type=float,
+            default=5,
+            help='The number of seconds to wait between polls when watching',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        while True:
+            total = 0
+            while True:
+                count = process_queue_batch(batch_size)
+                total += count
+                if count < batch_size:
+                    break
+            if total > 0:
+                self.stdout.write(
+                    'Reindexed {} queued facilities'.format(total))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
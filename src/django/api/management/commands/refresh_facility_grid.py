@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.facility_grid import build_facility_grid, refresh_facility_grid
+
+
+class Command(BaseCommand):
+    help = ('Recalculate the precomputed facility counts of the facilitygrid '
+            'tile layer for cells whose facilities have changed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-r',
+            '--rebuild',
+            action='store_true',
+            help='Rebuild every cell rather than only the changed cells',
+        )
+        parser.add_argument(
+            '-b',
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='The number of cells to refresh per transaction',
+        )
+        parser.add_argument(
+            '-w',
+            '--watch',
+            action='store_true',
+            help='Keep polling for changed cells instead of exiting',
+        )
+        parser.add_argument(
+            '-i',
+            '--interval',
+            type=float,
+            default=5,
+            help='The number of seconds to wait between polls when watching',
+        )
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        if options['rebuild']:
+            count = build_facility_grid(batch_size)
+            self.stdout.write('Built {} facility grid cells'.format(count))
+
+        while True:
+            count = refresh_facility_grid(batch_size)
+            if count > 0:
+                self.stdout.write(
+                    'Refreshed {} facility grid cells'.format(count))
+            if not options['watch']:
+                break
+            time.sleep(options['interval'])
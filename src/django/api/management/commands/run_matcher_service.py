@@ -0,0 +1,76 @@
+import dedupe
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api.matcher_service import (MatcherAction,
+                                 MatcherError,
+                                 MatcherServer,
+                                 MatcherServiceError,
+                                 serialize_matches)
+from api.matching import (GazetteerCache,
+                          NoCanonicalRecordsError,
+                          match_with_gazetteer)
+
+
+def handle_match(request):
+    try:
+        return {'matches': serialize_matches(match_with_gazetteer(
+            request['messy'],
+            gazetteer_threshold=request['gazetteer_threshold'],
+            recall_weight=request['recall_weight']))}
+    except NoCanonicalRecordsError:
+        raise MatcherServiceError(MatcherError.NO_CANONICAL_RECORDS)
+    except dedupe.core.BlockingError as e:
+        raise MatcherServiceError(MatcherError.BLOCKING, str(e))
+
+
+def handle_status(request):
+    try:
+        GazetteerCache.get_latest()
+    except NoCanonicalRecordsError:
+        pass
+    return {
+        'facility_version': GazetteerCache._facility_version,
+        'match_version': GazetteerCache._match_version,
+    }
+
+
+class Command(BaseCommand):
+    help = ('Hold a single trained and indexed gazetteer in memory and answer '
+            'match requests from the other processes on the host over a Unix '
+            'socket. Set MATCHER_SOCKET_PATH in the web and batch processes '
+            'to send their match requests to it.')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '-p',
+            '--path',
+            help=('The path of the socket. Defaults to the '
+                  'MATCHER_SOCKET_PATH setting.'),
+            default=None,
+        )
+
+    def handle(self, *args, **options):
+        path = options['path'] or settings.MATCHER_SOCKET_PATH
+        if not path:
+            raise CommandError('Specify --path or set MATCHER_SOCKET_PATH')
+
+        # Load or train the gazetteer before accepting requests so that the
+        # first request does not time out
+        status = handle_status({})
+        self.stdout.write('Loaded gazetteer (facility version {}, match '
+                          'version {})'.format(status['facility_version'],
+                                               status['match_version']))
+
+        server = MatcherServer(path, {
+            MatcherAction.MATCH: handle_match,
+            MatcherAction.STATUS: handle_status,
+        })
+        self.stdout.write('Listening on {}'.format(path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
@@ -0,0 +1,75 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api.models import FacilityList
+from api.pipeline import run_pipeline
+
+
+class Command(BaseCommand):
+    help = ('Parse, geocode and match the items in one or more facility '
+            'lists and notify their contributors, using a local pool of '
+            'processes rather than AWS Batch jobs.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('list_ids', type=int, nargs='+')
+        parser.add_argument(
+            '-w',
+            '--workers',
+            type=int,
+            default=4,
+            help='The number of processes used to parse and geocode items',
+        )
+        parser.add_argument(
+            '-s',
+            '--chunk-size',
+            type=int,
+            default=100,
+            help='The number of items parsed and geocoded by each task',
+        )
+        parser.add_argument(
+            '-m',
+            '--match-batch-size',
+            type=int,
+            default=1000,
+            help='The number of geocoded items matched at once',
+        )
+        parser.add_argument(
+            '-c',
+            '--concurrency',
+            type=int,
+            default=4,
+            help='The number of geocoding requests each worker sends in '
+                 'parallel',
+        )
+        parser.add_argument(
+            '--bulk',
+            action='store_true',
+            help='Save matches, facilities, and item results with bulk '
+                 'queries',
+        )
+        parser.add_argument(
+            '--skip-notify',
+            action='store_true',
+            help='Do not send the list completion emails',
+        )
+
+    def handle(self, *args, **options):
+        facility_lists = list(FacilityList.objects
+                              .filter(id__in=options['list_ids'])
+                              .select_related('source'))
+        missing_ids = set(options['list_ids']) - \
+            set(facility_list.id for facility_list in facility_lists)
+        if len(missing_ids) > 0:
+            raise CommandError('No facility lists with ids {}'.format(
+                ', '.join(str(i) for i in sorted(missing_ids))))
+
+        statuses = run_pipeline(
+            facility_lists,
+            workers=options['workers'],
+            chunk_size=options['chunk_size'],
+            match_batch_size=options['match_batch_size'],
+            geocode_concurrency=options['concurrency'],
+            bulk=options['bulk'],
+            notify=not options['skip_notify'],
+            stdout=self.stdout)
+        for status, count in sorted(statuses.items()):
+            self.stdout.write('{}: {}'.format(status, count))
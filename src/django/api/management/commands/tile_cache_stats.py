@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from api.tile_cache import clear_tile_cache, get_tile_cache_summary
+
+
+class Command(BaseCommand):
+    help = 'Report the size and hit count of the server side tile cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--clear',
+            action='store_true',
+            help='Delete all cached tiles after reporting',
+        )
+
+    def handle(self, *args, **options):
+        summary = get_tile_cache_summary()
+        self.stdout.write(
+            '{entries} cached tiles, {size} bytes, {hits} hits'.format(
+                **summary))
+        if options['clear']:
+            clear_tile_cache()
+            self.stdout.write('Cleared the tile cache')
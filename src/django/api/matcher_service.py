@@ -0,0 +1,219 @@
+import json
+import logging
+import os
+import socket
+import socketserver
+import struct
+import time
+import traceback
+
+import numpy
+
+from django.db import close_old_connections
+
+logger = logging.getLogger(__name__)
+
+# Each message is a JSON document preceded by its length in bytes as a 4 byte
+# big-endian unsigned integer
+MESSAGE_LENGTH = struct.Struct('!I')
+
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+# The number of seconds to wait before trying to connect again when the
+# connection backlog of the service is full
+CONNECT_RETRY_INTERVAL = 0.01
+
+
+class MatcherAction:
+    MATCH = 'match'
+    STATUS = 'status'
+
+
+class MatcherError:
+    NO_CANONICAL_RECORDS = 'no_canonical_records'
+    BLOCKING = 'blocking'
+    FAILED = 'failed'
+
+
+class MatcherServiceError(Exception):
+    def __init__(self, error, message=''):
+        super(MatcherServiceError, self).__init__(message or error)
+        self.error = error
+
+
+def _receive_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(min(size - len(data), 65536))
+        if not chunk:
+            raise ConnectionError('The matcher connection was closed')
+        data.extend(chunk)
+    return bytes(data)
+
+
+def send_message(sock, message):
+    data = json.dumps(message).encode('utf-8')
+    sock.sendall(MESSAGE_LENGTH.pack(len(data)) + data)
+
+
+def receive_message(sock):
+    (size,) = MESSAGE_LENGTH.unpack(
+        _receive_exactly(sock, MESSAGE_LENGTH.size))
+    if size > MAX_MESSAGE_SIZE:
+        raise ValueError('Matcher message of {} bytes is too large'.format(
+            size))
+    return json.loads(_receive_exactly(sock, size).decode('utf-8'))
+
+
+def connect(path, timeout):
+    """
+    Connect to the matcher service, waiting for up to `timeout` seconds for
+    room in its connection backlog. A socket with a timeout is non-blocking,
+    so connecting to a Unix socket whose backlog is full fails immediately
+    rather than waiting for the service to accept a connection.
+
+    Returns:
+    A connected socket.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(path)
+            return sock
+        except BlockingIOError:
+            sock.close()
+            if time.monotonic() >= deadline:
+                raise socket.timeout(
+                    'The matcher service did not accept the connection')
+            time.sleep(CONNECT_RETRY_INTERVAL)
+        except BaseException:
+            sock.close()
+            raise
+
+
+def send_request(path, request, timeout):
+    """
+    Send a request to the matcher service and wait for the response.
+
+    Arguments:
+    path -- The path of the Unix socket on which the service listens.
+    request -- A JSON serializable dict with an `action` key.
+    timeout -- The number of seconds to wait for the service to connect and
+               for each read of the response.
+
+    Returns:
+    The response dict.
+
+    Raises:
+    socket.timeout if the service does not respond in time, OSError if it
+    cannot be reached and MatcherServiceError if it could not handle the
+    request.
+    """
+    with connect(path, timeout) as sock:
+        send_message(sock, request)
+        response = receive_message(sock)
+    if 'error' in response:
+        raise MatcherServiceError(response['error'],
+                                  response.get('message', ''))
+    return response
+
+
+def request_matches(path, messy, gazetteer_threshold, recall_weight,
+                    timeout):
+    """
+    Ask the matcher service to score items with its gazetteer.
+
+    Arguments:
+    path -- The path of the Unix socket on which the service listens.
+    messy -- A dictionary of clean field values keyed by item identifier.
+    gazetteer_threshold -- The minimum score of the returned matches.
+    recall_weight -- Passed to `Gazetteer.threshold`.
+    timeout -- The number of seconds to wait for the service.
+
+    Returns:
+    A list of match clusters in the format returned by `Gazetteer.match`.
+    """
+    response = send_request(path, {
+        'action': MatcherAction.MATCH,
+        'messy': messy,
+        'gazetteer_threshold': gazetteer_threshold,
+        'recall_weight': recall_weight,
+    }, timeout)
+    # Scores are returned to callers as numpy floats, as they are when the
+    # gazetteer is used in process
+    return [[((messy_id, canon_id), numpy.float64(score))
+             for (messy_id, canon_id, score) in cluster]
+            for cluster in response['matches']]
+
+
+def serialize_matches(results):
+    return [[[messy_id, canon_id, float(score)]
+             for (messy_id, canon_id), score in cluster]
+            for cluster in results]
+
+
+class MatcherRequestHandler(socketserver.BaseRequestHandler):
+    """
+    Read a single request from the connection and write the response. The
+    server is not threaded, so the gazetteer is only ever used by one request
+    at a time.
+    """
+    def handle(self):
+        try:
+            request = receive_message(self.request)
+        except (ConnectionError, ValueError) as e:
+            logger.warning('Invalid matcher request: {}'.format(e))
+            return
+
+        close_old_connections()
+        try:
+            response = self.server.handle_request_message(request)
+        except MatcherServiceError as e:
+            response = {'error': e.error, 'message': str(e)}
+        except Exception as e:
+            logger.error('Matcher request failed: {}'.format(
+                traceback.format_exc()))
+            response = {'error': MatcherError.FAILED, 'message': str(e)}
+        finally:
+            close_old_connections()
+
+        try:
+            send_message(self.request, response)
+        except OSError as e:
+            # The client gave up waiting
+            logger.warning('Could not send matcher response: {}'.format(e))
+
+
+class MatcherServer(socketserver.UnixStreamServer):
+    """
+    Serve match requests on a Unix socket.
+
+    Arguments:
+    path -- The path of the socket. An existing socket file is replaced.
+    handlers -- A dict of functions keyed by `MatcherAction`. Each is called
+                with the request dict and returns the response dict.
+    """
+    # Requests are handled one at a time, so the connections of every process
+    # that sends a request while one is being handled wait in the backlog
+    request_queue_size = socket.SOMAXCONN
+
+    def __init__(self, path, handlers):
+        if os.path.exists(path):
+            os.remove(path)
+        self.handlers = handlers
+        super(MatcherServer, self).__init__(path, MatcherRequestHandler)
+
+    def handle_request_message(self, request):
+        handler = self.handlers.get(request.get('action'))
+        if handler is None:
+            raise MatcherServiceError(
+                MatcherError.FAILED,
+                'Unknown action {}'.format(request.get('action')))
+        return handler(request)
+
+    def server_close(self):
+        super(MatcherServer, self).server_close()
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
@@ -1,17 +1,24 @@
 import dedupe
+import json
 import logging
+import mmap
 import os
-import re
+import pickle
+import psycopg2
+import random
+import resource
+import socket
 import sys
+import threading
 import traceback
 
 from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 from django.conf import settings
 from django.contrib.postgres.search import TrigramSimilarity
-from django.db import transaction
-from django.db.models import Q, Max
-from unidecode import unidecode
+from django.db import connection, transaction
+from django.db.models import Q, Max, Value
+from django.db.models.functions import Lower, Mod, NullIf, Trim
 
 from api.models import (Facility,
                         FacilityList,
@@ -19,6 +26,11 @@ from api.models import (Facility,
                         FacilityMatch,
                         HistoricalFacility,
                         HistoricalFacilityMatch)
+from api.gazetteer_shards import ShardedGazetteer
+from api.helpers import clean
+from api.matcher_service import (MatcherError,
+                                 MatcherServiceError,
+                                 request_matches)
 
 logger = logging.getLogger(__name__)
 
@@ -36,26 +48,6 @@ def _try_reporting_error_to_rollbar(extra_data=dict):
             str(extra_data), traceback.format_exc()))
 
 
-def clean(column):
-    """
-    Remove punctuation and excess whitespace from a value before using it to
-    find matches. This should be the same function used when developing the
-    training data read from training.json as part of train_gazetteer.
-    """
-    column = unidecode(column)
-    column = re.sub('\n', ' ', column)
-    column = re.sub('-', '', column)
-    column = re.sub('/', ' ', column)
-    column = re.sub("'", '', column)
-    column = re.sub(",", '', column)
-    column = re.sub(":", ' ', column)
-    column = re.sub(' +', ' ', column)
-    column = column.strip().strip('"').strip("'").lower().strip()
-    if not column:
-        column = None
-    return column
-
-
 def match_detail_to_extended_facility_id(facility_id, match_id):
     return '{}_MATCH-{}'.format(facility_id, match_id)
 
@@ -82,6 +74,47 @@ def normalize_extended_facility_id(facility_id):
         return facility_id.split('_')[0]
 
 
+# The number of rows fetched from the server-side cursor at a time when
+# loading items for the gazetteer
+ITEM_LOAD_CHUNK_SIZE = 2000
+
+
+def iter_clean_items(queryset, id_fields=('id',), prefix=''):
+    """
+    Stream the clean field values of `Facility` or `FacilityListItem` records
+    from the stored clean columns with a server-side cursor. The values of
+    records whose clean columns have not been stored yet are cleaned as they
+    are read.
+
+    Arguments:
+    queryset -- A QuerySet of the records, or of a model related to them.
+    id_fields -- The fields that identify each record.
+    prefix -- The lookup path from the model of the QuerySet to the records,
+              e.g. 'facility_list_item__'. Empty if the QuerySet is of the
+              records themselves.
+
+    Returns:
+    A generator of (ids, record) tuples where ids is a tuple of the values of
+    `id_fields` and record is a dictionary of clean field values keyed by
+    field name (country, name, address).
+    """
+    # The equivalent of passing a two character country code through `clean`
+    country = NullIf(Lower(Trim(prefix + 'country_code')), Value(''))
+    rows = queryset.annotate(clean_country=country).values_list(
+        *id_fields, 'clean_country',
+        *[prefix + field for field in ('clean_name', 'clean_address',
+                                       'name', 'address')])
+    id_count = len(id_fields)
+    for row in rows.iterator(chunk_size=ITEM_LOAD_CHUNK_SIZE):
+        (country, clean_name, clean_address, name, address) = row[id_count:]
+        yield row[:id_count], {
+            'country': country,
+            'name': clean(name) if clean_name is None else clean_name or None,
+            'address': (clean(address) if clean_address is None
+                        else clean_address or None),
+        }
+
+
 def get_canonical_items():
     """
     Fetch all `Facility` items and create a dictionary suitable for use by a
@@ -92,32 +125,30 @@ def get_canonical_items():
     of clean field values keyed by field name (country, name, address). A
     "clean" value is one which has been passed through the `clean` function.
     """
-    facility_set = Facility.objects.all().extra(
-        select={'country': 'country_code'}).values(
-            'id', 'country', 'name', 'address')
-
-    items = {str(i['id']):
-             {k: clean(i[k]) for k in i if k != 'id'}
-             for i in facility_set}
-
-    confirmed_items = {match_to_extended_facility_id(m): {
-        'country': clean(m.facility_list_item.country_code),
-        'name': clean(m.facility_list_item.name),
-        'address': clean(m.facility_list_item.address),
-    } for m in FacilityMatch.objects.filter(status=FacilityMatch.CONFIRMED)}
-
-    items.update(confirmed_items)
+    items = {str(id): record
+             for (id,), record in iter_clean_items(Facility.objects.all())}
+
+    # The values of the item of each confirmed match are read in the same
+    # query as the match
+    confirmed_matches = iter_clean_items(
+        FacilityMatch.objects.filter(status=FacilityMatch.CONFIRMED),
+        id_fields=('id', 'facility_id'), prefix='facility_list_item__')
+    for (match_id, facility_id), record in confirmed_matches:
+        items[match_detail_to_extended_facility_id(
+            str(facility_id), str(match_id))] = record
 
     return items
 
 
-def get_messy_items_from_facility_list(facility_list):
+def get_messy_items_from_facility_list(facility_list, item_ids=None):
     """
     Fetch all `FacilityListItem` objects that belong to the specified
     `FacilityList` and create a dictionary suitable for use by a Dedupe model.
 
     Arguments:
     facility_list -- A `FacilityList`.
+    item_ids -- An optional list of `FacilityListItem` IDs. If specified, only
+                these items are fetched.
 
     Returns:
     A dictionary. The key is the `FacilityListItem` ID. The value is a
@@ -127,11 +158,11 @@ def get_messy_items_from_facility_list(facility_list):
     """
     facility_list_item_set = facility_list.source.facilitylistitem_set.filter(
         Q(status=FacilityListItem.GEOCODED)
-        | Q(status=FacilityListItem.GEOCODED_NO_RESULTS)).extra(
-            select={'country': 'country_code'}).values(
-                'id', 'country', 'name', 'address')
-    return {str(i['id']): {k: clean(i[k]) for k in i if k != 'id'}
-            for i in facility_list_item_set}
+        | Q(status=FacilityListItem.GEOCODED_NO_RESULTS))
+    if item_ids is not None:
+        facility_list_item_set = facility_list_item_set.filter(id__in=item_ids)
+    return {str(id): record
+            for (id,), record in iter_clean_items(facility_list_item_set)}
 
 
 def get_messy_items_for_training(mod_factor=5):
@@ -142,7 +173,8 @@ def get_messy_items_for_training(mod_factor=5):
     Arguments:
     mod_factor -- Used to partition a subset of `FacilityListItem` records. The
                   larger the value, the fewer records will be contained in the
-                  subset.
+                  subset. Records are selected by the database, using the
+                  remainder of their ID.
 
     Returns:
     A dictionary. The key is the `FacilityListItem` ID. The value is a
@@ -156,13 +188,9 @@ def get_messy_items_for_training(mod_factor=5):
         | Q(status=FacilityListItem.ERROR_PARSING)
         | Q(status=FacilityListItem.ERROR_GEOCODING)
         | Q(status=FacilityListItem.ERROR_MATCHING)
-    ).extra(
-            select={'country': 'country_code'}).values(
-                'id', 'country', 'name', 'address')
-    records = [record for (i, record) in enumerate(facility_list_item_set)
-               if i % mod_factor == 0]
-    return {str(i['id']): {k: clean(i[k]) for k in i if k != 'id'}
-            for i in records}
+    ).annotate(sample=Mod('id', mod_factor)).filter(sample=0)
+    return {str(id): record
+            for (id,), record in iter_clean_items(facility_list_item_set)}
 
 
 def train_gazetteer(messy, canonical, model_settings=None, should_index=False):
@@ -205,6 +233,125 @@ def train_gazetteer(messy, canonical, model_settings=None, should_index=False):
     return gazetteer
 
 
+def get_peak_memory_mb():
+    """
+    Returns:
+    The peak resident set size of this process in megabytes.
+    """
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# Incremented whenever the layout of the gazetteer snapshot file changes so
+# that a process never tries to load a snapshot written by incompatible code.
+GAZETTEER_SNAPSHOT_FORMAT_VERSION = 2
+
+
+def get_gazetteer_match_processes():
+    """
+    Returns:
+    The number of processes used to score the shards of a sharded gazetteer.
+    """
+    return settings.GAZETTEER_MATCH_PROCESSES or os.cpu_count() or 1
+
+
+def build_sharded_gazetteer(gazetteer, canonical):
+    """
+    Index the canonical items in a `ShardedGazetteer` that uses the model of
+    a trained gazetteer. Countries with fewer than GAZETTEER_SHARD_MIN_SIZE
+    items share a shard.
+    """
+    index_start = datetime.now()
+    logger.info('Indexing shards started')
+    sharded = ShardedGazetteer.build(
+        gazetteer, canonical, settings.GAZETTEER_SHARD_MIN_SIZE,
+        processes=get_gazetteer_match_processes())
+    logger.info('Indexing {} shards finished ({})'.format(
+        len(sharded.shards), datetime.now() - index_start))
+    return sharded
+
+
+def write_gazetteer_snapshot(gazetteer, facility_version, match_version,
+                             path):
+    """
+    Persist a trained and indexed gazetteer to disk so that it can be loaded
+    by another process without retraining or reindexing.
+
+    The file contains a pickled header followed by the output of
+    `Gazetteer.writeSettings` with `index=True`, which includes the blocking
+    predicate indices and the blocked canonical records. The file is written
+    to a temporary path and then moved into place so that readers never see a
+    partially written snapshot.
+
+    Arguments:
+    gazetteer -- A trained and indexed `dedupe.Gazetteer` or
+                 `ShardedGazetteer`.
+    facility_version -- The `HistoricalFacility` `history_id` high-water mark
+                        of the data indexed by the gazetteer.
+    match_version -- The `HistoricalFacilityMatch` `history_id` high-water
+                     mark of the data indexed by the gazetteer.
+    path -- The destination file path.
+    """
+    header = {
+        'format_version': GAZETTEER_SNAPSHOT_FORMAT_VERSION,
+        'facility_version': facility_version,
+        'match_version': match_version,
+        'created_at': str(datetime.utcnow()),
+        'code_version': settings.GIT_COMMIT,
+        'sharded': isinstance(gazetteer, ShardedGazetteer),
+    }
+    temp_path = '{}.{}.tmp'.format(path, os.getpid())
+    with open(temp_path, 'wb') as f:
+        pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+        gazetteer.writeSettings(f, index=True)
+    os.replace(temp_path, path)
+    return header
+
+
+def _read_gazetteer_snapshot_header(f):
+    header = pickle.load(f)
+    if header.get('format_version') != GAZETTEER_SNAPSHOT_FORMAT_VERSION:
+        raise ValueError('Unsupported gazetteer snapshot format {}'.format(
+            header.get('format_version')))
+    return header
+
+
+def read_gazetteer_snapshot_header(path):
+    """
+    Read the header of a snapshot written by `write_gazetteer_snapshot`
+    without loading the gazetteer.
+
+    Returns:
+    The snapshot header dictionary. Raises a `ValueError` if the snapshot was
+    written with an incompatible format.
+    """
+    with open(path, 'rb') as f:
+        return _read_gazetteer_snapshot_header(f)
+
+
+def read_gazetteer_snapshot(path):
+    """
+    Load a gazetteer written by `write_gazetteer_snapshot`. The file is memory
+    mapped so that the pickled settings and index are read directly from the
+    page cache rather than being copied into an intermediate buffer.
+
+    Returns:
+    A tuple of the snapshot header dictionary and a `dedupe.StaticGazetteer`,
+    or a `ShardedGazetteer` if the snapshot was written from one.
+    Raises a `ValueError` if the snapshot was written with an incompatible
+    format.
+    """
+    with open(path, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            header = _read_gazetteer_snapshot_header(mm)
+            if header['sharded']:
+                gazetteer = ShardedGazetteer.read_settings(
+                    mm, processes=get_gazetteer_match_processes())
+            else:
+                gazetteer = dedupe.StaticGazetteer(mm)
+    return header, gazetteer
+
+
 class MatchDefaults:
     AUTOMATIC_THRESHOLD = 0.8
     GAZETTEER_THRESHOLD = 0.5
@@ -215,13 +362,172 @@ class NoCanonicalRecordsError(Exception):
     pass
 
 
+# The number of gazetteer match results that are checked against the database
+# with a single query
+MATCH_RESULT_CHUNK_SIZE = 1000
+
+
+def filter_matches_to_existing_facilities(
+        results, chunk_size=MATCH_RESULT_CHUNK_SIZE):
+    """
+    Drop gazetteer match results that refer to facilities that no longer
+    exist.
+
+    The gazetteer matcher obtained from the GazetteerCache may have
+    encountered an exception raised by Dedupe while unindexing records and
+    could therefore return matches for facility IDs that no longer exist due
+    to merging or deleting. Rather than checking each result individually,
+    results are collected into chunks and each chunk is checked with a single
+    query.
+
+    Arguments:
+    results -- An iterable of gazetteer match clusters, each of which is a
+               sequence of ((messy_id, canon_id), score) tuples, as returned
+               by `Gazetteer.match`.
+    chunk_size -- The maximum number of results checked per query.
+
+    Returns:
+    A generator of (messy_id, canon_id, score) tuples for results that refer
+    to an existing `Facility`, in the order in which they were produced by
+    the gazetteer.
+    """
+    def existing(chunk):
+        facility_ids = {normalize_extended_facility_id(canon_id)
+                        for (_, canon_id, _) in chunk}
+        existing_ids = set(Facility
+                           .objects
+                           .filter(id__in=facility_ids)
+                           .values_list('id', flat=True))
+        return [(messy_id, canon_id, score)
+                for (messy_id, canon_id, score) in chunk
+                if normalize_extended_facility_id(canon_id) in existing_ids]
+
+    chunk = []
+    for matches in results:
+        for (messy_id, canon_id), score in matches:
+            chunk.append((messy_id, canon_id, score))
+            if len(chunk) >= chunk_size:
+                yield from existing(chunk)
+                chunk = []
+    if len(chunk) > 0:
+        yield from existing(chunk)
+
+
+def group_duplicate_items(messy):
+    """
+    Group "messy" items that have the same clean field values. The gazetteer
+    scores each item independently of the others, so every item in a group
+    has the same matches.
+
+    Arguments:
+    messy -- A dictionary of clean field values keyed by item identifier, as
+             returned by `get_messy_items_from_facility_list`.
+
+    Returns:
+    A dictionary where the keys are the identifier of the first item of each
+    group and the values are lists of the identifiers of all the items in the
+    group, including the first.
+    """
+    representatives = {}
+    groups = {}
+    for key, values in messy.items():
+        group_key = tuple(sorted(values.items(), key=lambda item: item[0]))
+        representative = representatives.setdefault(group_key, key)
+        groups.setdefault(representative, []).append(key)
+    return groups
+
+
+def match_with_gazetteer(messy,
+                         gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+                         recall_weight=MatchDefaults.RECALL_WEIGHT):
+    """
+    Score "messy" items with the gazetteer held by the `GazetteerCache` of
+    this process.
+
+    Returns:
+    A generator of match clusters, as returned by `Gazetteer.match`.
+    """
+    gazetteer = GazetteerCache.get_latest()
+    gazetteer.threshold(messy, recall_weight=recall_weight)
+    return gazetteer.match(messy, threshold=gazetteer_threshold,
+                           n_matches=None, generator=True)
+
+
+def _request_gazetteer_matches(path, messy, gazetteer_threshold,
+                               recall_weight):
+    timeout = settings.MATCHER_TIMEOUT_IN_SECONDS
+    try:
+        return request_matches(path, messy, gazetteer_threshold,
+                               recall_weight, timeout)
+    except socket.timeout:
+        raise GazetteerCacheTimeoutError(
+            'The matcher service did not respond within {} seconds'.format(
+                timeout))
+    except OSError as e:
+        raise GazetteerCacheTimeoutError(
+            'Could not connect to the matcher service: {}'.format(e))
+    except MatcherServiceError as e:
+        if e.error == MatcherError.NO_CANONICAL_RECORDS:
+            raise NoCanonicalRecordsError()
+        if e.error == MatcherError.BLOCKING:
+            raise dedupe.core.BlockingError(str(e))
+        raise
+
+
+def get_gazetteer_matches(
+        messy,
+        gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
+        recall_weight=MatchDefaults.RECALL_WEIGHT):
+    """
+    Score "messy" items with the gazetteer of the matcher service listening
+    on MATCHER_SOCKET_PATH, which is shared by all the processes on the host.
+    If the setting is empty, the gazetteer of this process is used instead.
+
+    The service handles one request at a time, so the items are sent in
+    requests of at most MATCHER_MAX_REQUEST_ITEMS. This keeps each request
+    within MATCHER_TIMEOUT_IN_SECONDS however long the list is, and lets the
+    requests of other processes be answered between them.
+
+    Returns:
+    An iterable of match clusters, as returned by `Gazetteer.match`.
+
+    Raises:
+    GazetteerCacheTimeoutError if the matcher service cannot be reached or
+    does not respond to a request within MATCHER_TIMEOUT_IN_SECONDS. The
+    errors raised by the gazetteer are raised as they would be in process.
+    """
+    path = settings.MATCHER_SOCKET_PATH
+    if not path:
+        return match_with_gazetteer(messy,
+                                    gazetteer_threshold=gazetteer_threshold,
+                                    recall_weight=recall_weight)
+
+    keys = list(messy.keys())
+    chunk_size = settings.MATCHER_MAX_REQUEST_ITEMS or len(keys) or 1
+    results = []
+    blocking_errors = []
+    starts = range(0, len(keys), chunk_size)
+    for start in starts:
+        chunk = {key: messy[key] for key in keys[start:start + chunk_size]}
+        try:
+            results.extend(_request_gazetteer_matches(
+                path, chunk, gazetteer_threshold, recall_weight))
+        except dedupe.core.BlockingError as e:
+            blocking_errors.append(e)
+    # As in process, blocking only fails if it fails for all of the items
+    if len(starts) > 0 and len(blocking_errors) == len(starts):
+        raise blocking_errors[0]
+    return results
+
+
 def match_items(messy,
                 automatic_threshold=MatchDefaults.AUTOMATIC_THRESHOLD,
                 gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
                 recall_weight=MatchDefaults.RECALL_WEIGHT):
     """
     Attempt to match each of the "messy" items specified with a "canonical"
-    item.
+    item. Items with the same clean field values are only scored once, and
+    each of them is given the matches of the group.
 
     This function reads from but does not update the database.
 
@@ -270,13 +576,14 @@ def match_items(messy,
                 finished.
     """
     started = str(datetime.utcnow())
+    groups = group_duplicate_items(messy)
     if len(messy.keys()) > 0:
         no_geocoded_items = False
+        unique_messy = {key: messy[key] for key in groups}
         try:
-            gazetteer = GazetteerCache.get_latest()
-            gazetteer.threshold(messy, recall_weight=recall_weight)
-            results = gazetteer.match(messy, threshold=gazetteer_threshold,
-                                      n_matches=None, generator=True)
+            results = get_gazetteer_matches(
+                unique_messy, gazetteer_threshold=gazetteer_threshold,
+                recall_weight=recall_weight)
             no_gazetteer_matches = False
         except NoCanonicalRecordsError:
             results = []
@@ -292,18 +599,10 @@ def match_items(messy,
     finished = str(datetime.utcnow())
 
     item_matches = defaultdict(list)
-    for matches in results:
-        for (messy_id, canon_id), score in matches:
-            # The gazetteer matcher obtained from the GazetteerCache may have
-            # encountered an exception raised by Dedupe while unindexing
-            # records and could therefore return matches for facility IDs that
-            # no longer exist due to merging or deleting.
-            facility_exists = Facility \
-                .objects \
-                .filter(pk=normalize_extended_facility_id(canon_id)) \
-                .exists()
-            if facility_exists:
-                item_matches[messy_id].append((canon_id, score))
+    for messy_id, canon_id, score in \
+            filter_matches_to_existing_facilities(results):
+        for member_id in groups[messy_id]:
+            item_matches[member_id].append((canon_id, score))
 
     return {
         'processed_list_item_ids': list(messy.keys()),
@@ -325,7 +624,8 @@ def match_facility_list_items(
         facility_list,
         automatic_threshold=MatchDefaults.AUTOMATIC_THRESHOLD,
         gazetteer_threshold=MatchDefaults.GAZETTEER_THRESHOLD,
-        recall_weight=MatchDefaults.RECALL_WEIGHT):
+        recall_weight=MatchDefaults.RECALL_WEIGHT,
+        item_ids=None):
     """
     Fetch items from the specified `FacilityList` and match them to the current
     list of facilities.
@@ -343,6 +643,8 @@ def match_facility_list_items(
                      1.0 give an equal weight to precision and recall.
                      https://en.wikipedia.org/wiki/Precision_and_recall
                      https://docs.dedupe.io/en/latest/Choosing-a-good-threshold.html
+    item_ids -- An optional list of `FacilityListItem` IDs. If specified, only
+                these items from the list are matched.
 
     Returns:
     See `match_items`.
@@ -351,7 +653,8 @@ def match_facility_list_items(
     if type(facility_list) != FacilityList:
         raise ValueError('Argument must be a FacilityList')
 
-    return match_items(get_messy_items_from_facility_list(facility_list),
+    return match_items(get_messy_items_from_facility_list(facility_list,
+                                                          item_ids=item_ids),
                        automatic_threshold=automatic_threshold,
                        gazetteer_threshold=gazetteer_threshold,
                        recall_weight=recall_weight)
@@ -422,26 +725,22 @@ def text_match_item(country_code, name, threshold=0.5):
                    .order_by('-similarity')
 
 
-def facility_values_to_dedupe_record(facility_dict):
-    """
-    Convert a dictionary with id, country, name, and address keys into a
-    dictionary suitable for training and indexing a Dedupe model.
+# The channel on which the history triggers notify listeners of changes to
+# facilities and facility matches
+GAZETTEER_CHANGES_CHANNEL = 'gazetteer_changes'
 
-    Arguments:
-    facility_dict -- A dict with id, country, name, and address key created
-                     from a `Facility` values query.
+# The key of the Postgres advisory lock held by the process that is building a
+# compacted gazetteer index, so that only one process rebuilds at a time
+GAZETTEER_COMPACTION_LOCK_ID = 6761722
 
-    Returns:
-    A dictionary with the id as the key and a dictionary of fields
-    as the value.
-    """
-    return {
-        str(facility_dict['id']): {
-            "country": clean(facility_dict['country']),
-            "name": clean(facility_dict['name']),
-            "address": clean(facility_dict['address']),
-        }
-    }
+# Each process extends GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS by a random
+# fraction up to this value so that processes started together do not all
+# decide to compact at the same moment
+GAZETTEER_COMPACTION_AGE_JITTER = 0.1
+
+# How long a process waits before trying to compact again after finding that
+# another process holds the compaction lock
+GAZETTEER_COMPACTION_RETRY_INTERVAL_IN_SECONDS = 300
 
 
 class GazetteerCacheTimeoutError(Exception):
@@ -455,15 +754,41 @@ class GazetteerCache:
     removed since the previous call to the `get_latest` class method.
 
     Note that the first time `get_latest` is called it will be slow, as it
-    needs to train a model and index it with all the `Facility` items.
+    needs to train a model and index it with all the `Facility` items. If the
+    GAZETTEER_SNAPSHOT_PATH setting points to a snapshot written by the
+    `build_gazetteer_snapshot` management command, the snapshot is loaded
+    instead and only the history recorded after the snapshot was taken is
+    replayed.
     """
     _gazetter = None
     _facility_version = None
     _match_version = None
+    _listener = None
+    _listener_pid = None
+    # The state used to decide when to compact the index. Tombstones are the
+    # records left in the index after their facility was deleted or merged or
+    # their match was deactivated.
+    _indexed_at = None
+    _record_count = 0
+    _tombstones = 0
+    _age_jitter = 0.0
+    _compaction_retry_at = None
+    _compaction_thread = None
+    _compacted = None
+    _compaction_lock = threading.Lock()
+
+    @staticmethod
+    def build_gazetteer():
+        """
+        Train and index a new gazetteer from the current contents of the
+        database.
 
-    @classmethod
-    def _rebuild_gazetteer(cls):
-        logger.info('Rebuilding gazetteer')
+        Returns:
+        A tuple of the gazetteer and the `HistoricalFacility` and
+        `HistoricalFacilityMatch` `history_id` values that were current when
+        the canonical items were read.
+        """
+        load_start = datetime.now()
         with transaction.atomic():
             db_facility_version = HistoricalFacility.objects.aggregate(
                 max_id=Max('history_id')).get('max_id')
@@ -479,12 +804,251 @@ class GazetteerCache:
             # than a QuerySet so that we can close the transaction as quickly
             # as possible
             messy = get_messy_items_for_training()
+        logger.info(
+            'Loaded {} canonical and {} training items ({}, peak memory '
+            '{:.0f} MB)'.format(len(canonical), len(messy),
+                                datetime.now() - load_start,
+                                get_peak_memory_mb()))
+
+        if settings.SHARDED_GAZETTEER:
+            gazetteer = build_sharded_gazetteer(
+                train_gazetteer(messy, canonical), canonical)
+        else:
+            gazetteer = train_gazetteer(messy, canonical, should_index=True)
+        logger.info('Gazetteer built ({}, peak memory {:.0f} MB)'.format(
+            datetime.now() - load_start, get_peak_memory_mb()))
+        return gazetteer, db_facility_version, db_match_version
 
-        cls._gazetter = train_gazetteer(messy, canonical, should_index=True)
-        cls._facility_version = db_facility_version
-        cls._match_version = db_match_version
+    @classmethod
+    def _load_snapshot(cls):
+        path = getattr(settings, 'GAZETTEER_SNAPSHOT_PATH', None)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            load_start = datetime.now()
+            header, gazetteer = read_gazetteer_snapshot(path)
+            logger.info('Loaded gazetteer snapshot {} created at {} '
+                        '({})'.format(path, header['created_at'],
+                                      datetime.now() - load_start))
+        except Exception:
+            logger.error('Failed to load gazetteer snapshot {}: {}'.format(
+                path, traceback.format_exc()))
+            return None
+
+        cls._gazetter = gazetteer
+        cls._facility_version = header['facility_version']
+        cls._match_version = header['match_version']
+        cls._reset_compaction_state(
+            datetime.fromisoformat(header['created_at']))
+        return cls._gazetter
+
+    @classmethod
+    def _rebuild_gazetteer(cls):
+        logger.info('Rebuilding gazetteer')
+        (cls._gazetter,
+         cls._facility_version,
+         cls._match_version) = cls.build_gazetteer()
+        cls._reset_compaction_state(datetime.utcnow())
         return cls._gazetter
 
+    @classmethod
+    def _reset_compaction_state(cls, indexed_at):
+        cls._indexed_at = indexed_at
+        cls._record_count = Facility.objects.count()
+        cls._tombstones = 0
+        cls._age_jitter = random.uniform(0, GAZETTEER_COMPACTION_AGE_JITTER)
+        cls._compaction_retry_at = None
+
+    @classmethod
+    def _get_compaction_reason(cls):
+        """
+        Returns:
+        A description of the threshold that the index has passed, or None if
+        it does not need to be compacted. Does not query the database.
+        """
+        ratio = settings.GAZETTEER_COMPACTION_TOMBSTONE_RATIO
+        if ratio > 0 and cls._tombstones > 0 \
+           and cls._tombstones >= ratio * max(cls._record_count, 1):
+            return 'tombstones={} records={}'.format(cls._tombstones,
+                                                     cls._record_count)
+        max_age = settings.GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS
+        if max_age > 0 and cls._indexed_at is not None:
+            age = datetime.utcnow() - cls._indexed_at
+            if age.total_seconds() >= \
+               max_age * 3600 * (1 + cls._age_jitter):
+                return 'age={}'.format(age)
+        return None
+
+    @classmethod
+    def _load_newer_snapshot(cls):
+        """
+        Load the snapshot at GAZETTEER_SNAPSHOT_PATH if it was written after
+        the current index was built, which happens when another process has
+        already compacted.
+
+        Returns:
+        A tuple of the gazetteer, its facility and match versions and the time
+        at which the snapshot was created, or None if there is no newer
+        snapshot.
+        """
+        path = getattr(settings, 'GAZETTEER_SNAPSHOT_PATH', None)
+        if not path or not os.path.exists(path):
+            return None
+        try:
+            header = read_gazetteer_snapshot_header(path)
+            created_at = datetime.fromisoformat(header['created_at'])
+            if cls._indexed_at is not None and created_at <= cls._indexed_at:
+                return None
+            header, gazetteer = read_gazetteer_snapshot(path)
+        except Exception:
+            logger.error('Failed to load gazetteer snapshot {}: {}'.format(
+                path, traceback.format_exc()))
+            return None
+        return (gazetteer, header['facility_version'],
+                header['match_version'],
+                datetime.fromisoformat(header['created_at']))
+
+    @classmethod
+    def _build_compacted(cls):
+        """
+        Build a new index while holding the compaction advisory lock and, if
+        GAZETTEER_SNAPSHOT_PATH is set, write it as a snapshot so that the
+        other processes can load it rather than building their own.
+
+        Returns:
+        A tuple of the gazetteer, its facility and match versions and the time
+        at which it was finished, or None if another process holds the lock.
+        """
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_try_advisory_lock(%s)',
+                           [GAZETTEER_COMPACTION_LOCK_ID])
+            if not cursor.fetchone()[0]:
+                return None
+        try:
+            gazetteer, facility_version, match_version = \
+                cls.build_gazetteer()
+            path = getattr(settings, 'GAZETTEER_SNAPSHOT_PATH', None)
+            if path:
+                try:
+                    write_gazetteer_snapshot(gazetteer, facility_version,
+                                             match_version, path)
+                except Exception:
+                    logger.error(
+                        'Failed to write gazetteer snapshot {}: {}'.format(
+                            path, traceback.format_exc()))
+            return (gazetteer, facility_version, match_version,
+                    datetime.utcnow())
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [GAZETTEER_COMPACTION_LOCK_ID])
+
+    @classmethod
+    def _compact(cls, reason):
+        started = datetime.now()
+        logger.info('Gazetteer compaction started ({})'.format(reason))
+        try:
+            compacted = cls._load_newer_snapshot() or cls._build_compacted()
+            if compacted is None:
+                retry_in = GAZETTEER_COMPACTION_RETRY_INTERVAL_IN_SECONDS * \
+                    random.uniform(1, 1 + GAZETTEER_COMPACTION_AGE_JITTER)
+                cls._compaction_retry_at = \
+                    datetime.utcnow() + timedelta(seconds=retry_in)
+                logger.info('Gazetteer compaction postponed, another process '
+                            'is building an index')
+                return
+            with cls._compaction_lock:
+                cls._compacted = compacted
+            logger.info('Gazetteer compaction finished a new index '
+                        '({})'.format(datetime.now() - started))
+        except Exception:
+            logger.error('Gazetteer compaction failed: {}'.format(
+                traceback.format_exc()))
+            _try_reporting_error_to_rollbar({'compaction_reason': reason})
+        finally:
+            # The thread has its own database connection
+            connection.close()
+
+    @classmethod
+    def _maybe_start_compaction(cls):
+        """
+        Start building a new index in a background thread if the current one
+        has too many tombstones or is too old. Matching continues against the
+        current index until the new one is swapped in by `get_latest`.
+
+        Only one process builds at a time. The others load the snapshot it
+        writes to GAZETTEER_SNAPSHOT_PATH, or wait for it to finish before
+        building their own if no snapshot path is set.
+        """
+        if cls._compaction_thread is not None \
+           and cls._compaction_thread.is_alive():
+            return
+        if cls._compacted is not None:
+            return
+        if cls._compaction_retry_at is not None \
+           and datetime.utcnow() < cls._compaction_retry_at:
+            return
+        reason = cls._get_compaction_reason()
+        if reason is None:
+            return
+        cls._compaction_thread = threading.Thread(
+            target=cls._compact, args=(reason,), daemon=True)
+        cls._compaction_thread.start()
+
+    @classmethod
+    def _swap_compacted(cls):
+        """
+        Replace the index with the one built by the compaction thread, if it
+        has finished.
+
+        Returns:
+        True if the index was swapped.
+        """
+        with cls._compaction_lock:
+            compacted = cls._compacted
+            cls._compacted = None
+        if compacted is None:
+            return False
+
+        tombstones = cls._tombstones
+        record_count = cls._record_count
+        (cls._gazetter,
+         cls._facility_version,
+         cls._match_version,
+         indexed_at) = compacted
+        cls._reset_compaction_state(indexed_at)
+        logger.info(
+            'Gazetteer compaction swapped the index: '
+            'dropped_tombstones={} previous_records={} records={} '
+            'facility_version={} match_version={}'.format(
+                tombstones, record_count, cls._record_count,
+                cls._facility_version, cls._match_version))
+        return True
+
+    @staticmethod
+    def _get_facility_dedupe_records(facility_ids):
+        # We use an dictionary comprehension so that we can load
+        # all the data and exit the transaction as soon as possible
+        return {
+            id: {id: record} for (id,), record in
+            iter_clean_items(Facility.objects.filter(id__in=facility_ids))
+        }
+
+    @staticmethod
+    def _get_match_records(match_ids):
+        # We use an dictionary comprehension so that we can load
+        # all the data and exit the transaction as soon as possible
+        return {
+            m['id']: {
+                'facility': m['facility'],
+                'status': m['status'],
+                'is_active': m['is_active'],
+            } for m in
+            FacilityMatch
+            .objects
+            .filter(id__in=match_ids)
+            .values('id', 'facility', 'status', 'is_active')}
+
     @classmethod
     @transaction.atomic
     def _get_new_facility_history(cls):
@@ -510,21 +1074,12 @@ class GazetteerCache:
                 .values('id', 'country', 'name', 'address',
                         'history_type', 'history_id'))
 
-            changed_facility_ids_qs = HistoricalFacility \
-                .objects \
-                .filter(history_id__gt=last_facility_version_id) \
-                .values_list('id', flat=True)
-
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_facility_dedupe_records = {
-                f['id']: facility_values_to_dedupe_record(f) for f in
-                Facility
-                .objects
-                .filter(id__in=changed_facility_ids_qs)
-                .extra(select={'country': 'country_code'})
-                .values('id', 'country', 'name', 'address')
-            }
+            latest_facility_dedupe_records = \
+                cls._get_facility_dedupe_records(
+                    HistoricalFacility
+                    .objects
+                    .filter(history_id__gt=last_facility_version_id)
+                    .values_list('id', flat=True))
 
         return facility_changes, latest_facility_dedupe_records
 
@@ -535,7 +1090,7 @@ class GazetteerCache:
         latest_match_records = {}
         latest_matched_facility_dedupe_records = {}
 
-        db_match_version = HistoricalFacility.objects.aggregate(
+        db_match_version = HistoricalFacilityMatch.objects.aggregate(
             max_id=Max('history_id')).get('max_id')
 
         if db_match_version != cls._match_version:
@@ -553,129 +1108,216 @@ class GazetteerCache:
                 .order_by('history_id')
                 .values('id', 'facility', 'history_type', 'history_id'))
 
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_match_records = {
-                m['id']: {
-                    'facility': m['facility'],
-                    'status': m['status'],
-                    'is_active': m['is_active'],
-                } for m in
-                FacilityMatch
-                .objects
-                .filter(id__in=(
-                    HistoricalFacilityMatch
-                    .objects
-                    .filter(history_id__gt=last_match_version_id)
-                    .values_list('id', flat=True)
-                ))
-                .values('id', 'facility', 'status', 'is_active')}
-
-            # We use an dictionary comprehension so that we can load
-            # all the data and exit the transaction as soon as possible
-            latest_matched_facility_dedupe_records = {
-                f['id']: facility_values_to_dedupe_record(f) for f in
-                Facility
+            latest_match_records = cls._get_match_records(
+                HistoricalFacilityMatch
                 .objects
-                .filter(id__in=(
+                .filter(history_id__gt=last_match_version_id)
+                .values_list('id', flat=True))
+
+            latest_matched_facility_dedupe_records = \
+                cls._get_facility_dedupe_records(
                     HistoricalFacilityMatch
                     .objects
                     .filter(history_id__gt=last_match_version_id)
-                    .values_list('facility', flat=True)
-                ))
-                .extra(select={'country': 'country_code'})
-                .values('id', 'country', 'name', 'address')
-            }
+                    .values_list('facility', flat=True))
 
         return (match_changes, latest_match_records,
                 latest_matched_facility_dedupe_records)
 
     @classmethod
-    def get_latest(cls):
+    def _close_listener(cls):
+        if cls._listener is not None:
+            try:
+                cls._listener.close()
+            except psycopg2.Error:
+                pass
+        cls._listener = None
+
+    @classmethod
+    def _listen(cls):
+        """
+        Open the connection on which change notifications are received, if
+        GAZETTEER_CHANGE_NOTIFICATIONS is set and it is not already open.
+
+        Returns:
+        True if the connection was already open, in which case the pending
+        notifications include every change since the previous call. False if
+        the history tables need to be scanned to catch up.
+        """
+        if not settings.GAZETTEER_CHANGE_NOTIFICATIONS:
+            return False
+
+        # A connection opened before the process was forked belongs to the
+        # parent
+        if cls._listener_pid != os.getpid():
+            cls._listener = None
+        if cls._listener is not None and not cls._listener.closed:
+            return True
+
+        cls._close_listener()
         try:
-            if cls._gazetter is None:
-                return cls._rebuild_gazetteer()
+            listener = psycopg2.connect(
+                **connection.get_connection_params())
+            listener.set_session(autocommit=True)
+            with listener.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(GAZETTEER_CHANGES_CHANNEL))
+            cls._listener = listener
+            cls._listener_pid = os.getpid()
+        except psycopg2.Error:
+            logger.error('Failed to listen for gazetteer changes: {}'.format(
+                traceback.format_exc()))
+        return False
+
+    @classmethod
+    def _receive_changes(cls):
+        """
+        Read the pending change notifications. This does not send a query
+        to the database.
+
+        Returns:
+        A tuple of lists of facility and facility match changes, each
+        ordered by `history_id`, or None if the connection was lost.
+        """
+        try:
+            cls._listener.poll()
+        except psycopg2.Error:
+            logger.warning('Lost the gazetteer change notification '
+                           'connection: {}'.format(traceback.format_exc()))
+            cls._close_listener()
+            return None
 
-            facility_changes, latest_facility_dedupe_records = \
-                cls._get_new_facility_history()
+        facility_changes = []
+        match_changes = []
+        while cls._listener.notifies:
+            change = json.loads(cls._listener.notifies.pop(0).payload)
+            if change.pop('model') == 'facility':
+                facility_changes.append(change)
+            else:
+                match_changes.append(change)
+        facility_changes.sort(key=lambda change: change['history_id'])
+        match_changes.sort(key=lambda change: change['history_id'])
+        return facility_changes, match_changes
 
-            for item in facility_changes:
+    @classmethod
+    def _index_facility_changes(cls, facility_changes,
+                                latest_facility_dedupe_records):
+        for item in facility_changes:
+            # We were previously calling `cls._gazetter.unindex` to
+            # remove records with a `history_type` of `-` but it was
+            # raising exceptions for which we could not determine the
+            # root cause. We have opted to ignore them and filter out
+            # no longer existing records from the match results.
+            if item['history_type'] != '-':
+                # The history record has old field values, so we use the
+                # updated version that we fetched. If we don't have a
+                # record for the ID, it means that the facility has been
+                # deleted. We don't need to index a deleted facility.
+                if item['id'] in latest_facility_dedupe_records:
+                    record = latest_facility_dedupe_records[item['id']]
+                    logger.debug(
+                        'Indexing facility {}'.format(str(record)))
+                    cls._gazetter.index(record)
+                else:
+                    cls._tombstones += 1
+            else:
+                cls._tombstones += 1
+            cls._facility_version = item['history_id']
+
+    @classmethod
+    def _index_match_changes(cls, match_changes, latest_match_records,
+                             latest_matched_facility_dedupe_records):
+        def dedupe_record_for_match_item(item):
+            facility_id = item['facility']
+            key = match_detail_to_extended_facility_id(
+                facility_id, item['id'])
+            """
+            The latest_matched_facility_dedupe_records dictionary looks
+            like this:
+
+            {
+                facility_id: {
+                    facility_id: {
+                        field1: value1,
+                        field2, value2
+                    }
+                }
+            }
+
+            We want to get the inner object and change the key from a real
+            facility ID to a "synthetic" facility ID which we use to index
+            confirmed matches.
+            """
+            value = (
+                latest_matched_facility_dedupe_records
+                [facility_id][facility_id]
+            )
+            return {key: value}
+
+        for item in match_changes:
+            match = (latest_match_records[item['id']]
+                     if item['id'] in latest_match_records
+                     else None)
+            has_facility = (
+                item['facility'] in latest_matched_facility_dedupe_records)
+            is_confirmed_match_with_facility = (
+                match
+                and match['status'] == FacilityMatch.CONFIRMED
+                and has_facility)
+            if is_confirmed_match_with_facility:
                 # We were previously calling `cls._gazetter.unindex` to
                 # remove records with a `history_type` of `-` but it was
                 # raising exceptions for which we could not determine the
                 # root cause. We have opted to ignore them and filter out
                 # no longer existing records from the match results.
                 if item['history_type'] != '-':
-                    # The history record has old field values, so we use the
+                    # The history record has old field values, so we us the
                     # updated version that we fetched. If we don't have a
-                    # record for the ID, it means that the facility has been
-                    # deleted. We don't need to index a deleted facility.
-                    if item['id'] in latest_facility_dedupe_records:
-                        record = latest_facility_dedupe_records[item['id']]
+                    # record for the ID, it means that the facility has
+                    # been deleted. We don't need to index a deleted
+                    # facility.
+                    if match and match['is_active']:
+                        record = dedupe_record_for_match_item(item)
                         logger.debug(
-                            'Indexing facility {}'.format(str(record)))
+                            'Indexing match {}'.format(str(record)))
                         cls._gazetter.index(record)
-                cls._facility_version = item['history_id']
-
-            (match_changes, latest_match_records,
-             latest_matched_facility_dedupe_records) = \
-                cls._get_new_match_history()
-
-            def dedupe_record_for_match_item(item):
-                facility_id = item['facility']
-                key = match_detail_to_extended_facility_id(
-                    facility_id, item['id'])
-                """
-                The latest_matched_facility_dedupe_records dictionary looks
-                like this:
-
-                {
-                    facility_id: {
-                        facility_id: {
-                            field1: value1,
-                            field2, value2
-                        }
-                    }
-                }
+                    else:
+                        cls._tombstones += 1
+                else:
+                    cls._tombstones += 1
+            cls._match_version = item['history_id']
 
-                We want to get the inner object and change the key from a real
-                facility ID to a "synthetic" facility ID which we use to index
-                confirmed matches.
-                """
-                value = (
-                    latest_matched_facility_dedupe_records
-                    [facility_id][facility_id]
-                )
-                return {key: value}
-
-            for item in match_changes:
-                match = (latest_match_records[item['id']]
-                         if item['id'] in latest_match_records
-                         else None)
-                has_facility = (
-                    item['facility'] in latest_matched_facility_dedupe_records)
-                is_confirmed_match_with_facility = (
-                    match
-                    and match['status'] == FacilityMatch.CONFIRMED
-                    and has_facility)
-                if is_confirmed_match_with_facility:
-                    # We were previously calling `cls._gazetter.unindex` to
-                    # remove records with a `history_type` of `-` but it was
-                    # raising exceptions for which we could not determine the
-                    # root cause. We have opted to ignore them and filter out
-                    # no longer existing records from the match results.
-                    if item['history_type'] != '-':
-                        # The history record has old field values, so we us the
-                        # updated version that we fetched. If we don't have a
-                        # record for the ID, it means that the facility has
-                        # been deleted. We don't need to index a deleted
-                        # facility.
-                        if match and match['is_active']:
-                            record = dedupe_record_for_match_item(item)
-                            logger.debug(
-                                'Indexing match {}'.format(str(record)))
-                            cls._gazetter.index(record)
-                    cls._match_version = item['history_id']
+    @classmethod
+    def get_latest(cls):
+        try:
+            is_listening = cls._listen()
+            if cls._gazetter is None:
+                if cls._load_snapshot() is None:
+                    return cls._rebuild_gazetteer()
+
+            changes = cls._receive_changes() if is_listening else None
+            if cls._swap_compacted():
+                # Changes received before the swap were only indexed by the
+                # previous index
+                changes = None
+            if changes is None:
+                cls._index_facility_changes(*cls._get_new_facility_history())
+                cls._index_match_changes(*cls._get_new_match_history())
+            else:
+                facility_changes, match_changes = changes
+                if len(facility_changes) > 0:
+                    cls._index_facility_changes(
+                        facility_changes,
+                        cls._get_facility_dedupe_records(
+                            {c['id'] for c in facility_changes}))
+                if len(match_changes) > 0:
+                    cls._index_match_changes(
+                        match_changes,
+                        cls._get_match_records(
+                            {c['id'] for c in match_changes}),
+                        cls._get_facility_dedupe_records(
+                            {c['facility'] for c in match_changes}))
+
+            cls._maybe_start_compaction()
 
         except Exception:
             extra_info = {
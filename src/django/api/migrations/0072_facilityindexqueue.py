@@ -0,0 +1,24 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0071_add_extended_fields'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityIndexQueue',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('facility_id', models.CharField(editable=False, help_text='The OAR ID of a facility that needs to be reindexed.', max_length=32, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'facility index queue',
+            },
+        ),
+    ]
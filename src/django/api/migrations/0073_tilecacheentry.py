@@ -0,0 +1,41 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0072_facilityindexqueue'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TileCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(editable=False, help_text='A hash of the layer, tile coordinates, cache key and normalized query parameters.', max_length=64, unique=True)),
+                ('cache_key', models.CharField(editable=False, help_text='The tile cache key at the time the tile was rendered.', max_length=100)),
+                ('layer', models.CharField(editable=False, max_length=20)),
+                ('z', models.IntegerField(editable=False)),
+                ('x', models.IntegerField(editable=False)),
+                ('y', models.IntegerField(editable=False)),
+                ('tile', models.BinaryField(editable=False, help_text='The tile bytes. Null if the query had no results.', null=True)),
+                ('size', models.IntegerField(editable=False, help_text='The size of the tile in bytes.')),
+                ('hits', models.IntegerField(default=0, editable=False, help_text='The number of times the entry has been served.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'tile cache entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='tilecacheentry',
+            index=models.Index(fields=['cache_key'], name='api_tilecac_cache_k_a87c78_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='tilecacheentry',
+            index=models.Index(fields=['last_accessed_at'], name='api_tilecac_last_ac_e66b46_idx'),
+        ),
+    ]
@@ -0,0 +1,107 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+import django.contrib.gis.db.models.fields
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Find the cell of the grid drawn by generate_hexgrid that contains a point.
+# The cells in each row pair form two rectangular lattices of cell centers,
+# one offset from the other by half a cell width and three quarters of a cell
+# height. The cell containing a point is the one with the nearest center, which
+# must be one of the four lattice points surrounding it in either lattice.
+create_hexgrid_cell = """
+CREATE OR REPLACE FUNCTION hexgrid_cell(width float, x float, y float)
+RETURNS TABLE(x_index int, y_index int, is_offset boolean) AS $$
+  WITH dims AS (
+    SELECT width / 2 AS b, tan(radians(30)) * width / 2 AS a
+  ), candidates AS (
+    SELECT
+      i, j, k,
+      i * width + k * b AS cx,
+      j * 6 * a + k * 3 * a + 2 * a AS cy
+    FROM dims
+    CROSS JOIN generate_series(0, 1) AS k
+    CROSS JOIN LATERAL generate_series(
+      floor((x - k * b) / width)::int,
+      floor((x - k * b) / width)::int + 1) AS i
+    CROSS JOIN LATERAL generate_series(
+      floor((y - k * 3 * a - 2 * a) / (6 * a))::int,
+      floor((y - k * 3 * a - 2 * a) / (6 * a))::int + 1) AS j
+  )
+  SELECT i, j, k = 1
+  FROM candidates
+  ORDER BY (cx - x) ^ 2 + (cy - y) ^ 2
+  LIMIT 1
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+drop_hexgrid_cell = "DROP FUNCTION hexgrid_cell;"
+
+# Build the same polygon that generate_hexgrid creates for a cell
+create_hexgrid_cell_geom = """
+CREATE OR REPLACE FUNCTION hexgrid_cell_geom(
+  width float, x_index int, y_index int, is_offset boolean,
+  srid int default 3857)
+RETURNS geometry(Polygon) AS $$
+  SELECT ST_SetSRID(ST_MakePolygon(ST_MakeLine(ARRAY[
+    ST_MakePoint(ox, oy),
+    ST_MakePoint(ox + b, oy + a),
+    ST_MakePoint(ox + b, oy + 3 * a),
+    ST_MakePoint(ox, oy + 4 * a),
+    ST_MakePoint(ox - b, oy + 3 * a),
+    ST_MakePoint(ox - b, oy + a),
+    ST_MakePoint(ox, oy)
+  ])), srid)
+  FROM (
+    SELECT
+      b, a,
+      x_index * width + (CASE WHEN is_offset THEN b ELSE 0 END) AS ox,
+      y_index * 6 * a + (CASE WHEN is_offset THEN 3 * a ELSE 0 END) AS oy
+    FROM (
+      SELECT width / 2 AS b, tan(radians(30)) * width / 2 AS a
+    ) AS dims
+  ) AS origin
+$$ LANGUAGE sql IMMUTABLE;
+"""
+
+drop_hexgrid_cell_geom = "DROP FUNCTION hexgrid_cell_geom;"
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0073_tilecacheentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FacilityGridCell',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('zoom', models.IntegerField(editable=False)),
+                ('x_index', models.IntegerField(editable=False, help_text='The column of the cell in the global grid.')),
+                ('y_index', models.IntegerField(editable=False, help_text='The row pair of the cell in the global grid.')),
+                ('is_offset', models.BooleanField(editable=False, help_text='Whether the cell is in the upper row of the pair, which is offset by half a cell width.')),
+                ('geom', django.contrib.gis.db.models.fields.PolygonField(editable=False, help_text='The outline of the cell in web mercator.', srid=3857)),
+                ('is_dirty', models.BooleanField(default=True, help_text='Whether the facilities in the cell have changed since the counts were last calculated.')),
+            ],
+            options={
+                'unique_together': {('zoom', 'x_index', 'y_index', 'is_offset')},
+            },
+        ),
+        migrations.CreateModel(
+            name='FacilityGridCount',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dimension', models.CharField(choices=[('all', 'all'), ('country', 'country'), ('contributor', 'contributor'), ('contributor_type', 'contributor_type')], editable=False, max_length=20)),
+                ('value', models.CharField(blank=True, editable=False, help_text='The country code, contributor ID or contributor type. Empty when the dimension is "all".', max_length=200)),
+                ('count', models.IntegerField(editable=False)),
+                ('cell', models.ForeignKey(editable=False, on_delete=django.db.models.deletion.CASCADE, related_name='counts', to='api.FacilityGridCell')),
+            ],
+            options={
+                'unique_together': {('cell', 'dimension', 'value')},
+            },
+        ),
+        migrations.RunSQL(create_hexgrid_cell, drop_hexgrid_cell),
+        migrations.RunSQL(create_hexgrid_cell_geom, drop_hexgrid_cell_geom),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations
+
+# Django filters with `icontains` as `UPPER("column"::text) LIKE UPPER(%s)`,
+# so the indexes must be on the same expression for Postgres to use them.
+create_trigram_indexes = """
+CREATE INDEX api_facilityindex_name_trgm
+  ON api_facilityindex USING gin (UPPER(name::text) gin_trgm_ops);
+CREATE INDEX api_facilityindex_id_trgm
+  ON api_facilityindex USING gin (UPPER(id::text) gin_trgm_ops);
+CREATE INDEX api_facilityindex_ppe_trgm
+  ON api_facilityindex USING gin (UPPER(ppe::text) gin_trgm_ops);
+"""
+
+drop_trigram_indexes = """
+DROP INDEX api_facilityindex_name_trgm;
+DROP INDEX api_facilityindex_id_trgm;
+DROP INDEX api_facilityindex_ppe_trgm;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0074_facilitygridcell_facilitygridcount'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_trigram_indexes, drop_trigram_indexes),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0075_add_facilityindex_trigram_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GeocodingCacheEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(editable=False, help_text='A hash of the normalized address and country code.', max_length=64, unique=True)),
+                ('address', models.TextField(editable=False, help_text='The normalized address.')),
+                ('country_code', models.CharField(editable=False, help_text='The ISO 3166-1 alpha-2 country code.', max_length=2)),
+                ('result_count', models.IntegerField(editable=False, help_text='The number of results in the response.')),
+                ('geocoded_address', models.TextField(editable=False, help_text='The formatted address of the first result.', null=True)),
+                ('response', django.contrib.postgres.fields.jsonb.JSONField(editable=False, help_text='The response payload.')),
+                ('duration', models.IntegerField(editable=False, help_text='The time taken by the request, in milliseconds.')),
+                ('hits', models.IntegerField(default=0, editable=False, help_text='The number of times the entry has been used.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_accessed_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'geocoding cache entries',
+            },
+        ),
+        migrations.AddIndex(
+            model_name='geocodingcacheentry',
+            index=models.Index(fields=['created_at'], name='api_geocodi_created_836d33_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='geocodingcacheentry',
+            index=models.Index(fields=['last_accessed_at'], name='api_geocodi_last_ac_7ffc98_idx'),
+        ),
+    ]
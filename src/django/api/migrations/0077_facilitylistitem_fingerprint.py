@@ -0,0 +1,22 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0076_geocodingcacheentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='facilitylistitem',
+            name='fingerprint',
+            field=models.CharField(editable=False, help_text='A hash of the raw data and the positions of the parsed columns in the list header. Rows of a replacing list reuse the results of rows of the replaced list with the same fingerprint.', max_length=32, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='facilitylistitem',
+            index=models.Index(fields=['source', 'fingerprint'], name='api_fli_source_fingerprint_idx'),
+        ),
+    ]
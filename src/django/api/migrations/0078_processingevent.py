@@ -0,0 +1,57 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+import django.contrib.postgres.fields.jsonb
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0077_facilitylistitem_fingerprint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProcessingPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(editable=False, help_text='A hash of the JSON encoded value.', max_length=64, unique=True)),
+                ('data', models.BinaryField(editable=False, help_text='The zlib compressed, JSON encoded value.')),
+                ('size', models.IntegerField(editable=False, help_text='The size of the uncompressed value in bytes.')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProcessingEvent',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('action', models.CharField(help_text='The processing action.', max_length=200)),
+                ('started_at', models.DateTimeField(help_text='When the action started.', null=True)),
+                ('finished_at', models.DateTimeField(help_text='When the action finished.', null=True)),
+                ('error', models.NullBooleanField(help_text='Whether the action failed.')),
+                ('data', django.contrib.postgres.fields.jsonb.JSONField(default=dict, help_text='The other details of the result.')),
+                ('payload_field', models.CharField(help_text='The key of the result whose value is the payload.', max_length=200, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('facility_list_item', models.ForeignKey(help_text='The item that was processed.', null=True, on_delete=django.db.models.deletion.CASCADE, to='api.FacilityListItem')),
+                ('payload', models.ForeignKey(help_text='A large value of the result stored separately.', null=True, on_delete=django.db.models.deletion.PROTECT, to='api.ProcessingPayload')),
+                ('source', models.ForeignKey(help_text='The source of the list whose items were all processed, if the event is not for a single item.', null=True, on_delete=django.db.models.deletion.CASCADE, to='api.Source')),
+            ],
+        ),
+        # The existing results are left in place and read through
+        # `FacilityListItem.processing_results` along with the new events
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RenameField(
+                    model_name='facilitylistitem',
+                    old_name='processing_results',
+                    new_name='legacy_processing_results',
+                ),
+                migrations.AlterField(
+                    model_name='facilitylistitem',
+                    name='legacy_processing_results',
+                    field=django.contrib.postgres.fields.jsonb.JSONField(db_column='processing_results', default=list, editable=False, help_text='Diagnostic details logged by background processing before they were recorded as processing events.'),
+                ),
+            ],
+        ),
+    ]
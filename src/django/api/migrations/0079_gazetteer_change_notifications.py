@@ -0,0 +1,62 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations
+
+# Notify processes listening on the gazetteer_changes channel of every history
+# record written for a facility or a facility match. The payload carries the
+# fields that GazetteerCache reads from the history tables, so that listeners
+# can index the changed records without scanning the history.
+create_notify_functions = """
+CREATE OR REPLACE FUNCTION notify_gazetteer_facility_change()
+RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('gazetteer_changes', json_build_object(
+    'model', 'facility',
+    'id', NEW.id,
+    'history_id', NEW.history_id,
+    'history_type', NEW.history_type)::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION notify_gazetteer_facility_match_change()
+RETURNS trigger AS $$
+BEGIN
+  PERFORM pg_notify('gazetteer_changes', json_build_object(
+    'model', 'facility_match',
+    'id', NEW.id,
+    'facility', NEW.facility_id,
+    'history_id', NEW.history_id,
+    'history_type', NEW.history_type)::text);
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER api_historicalfacility_notify_gazetteer
+AFTER INSERT ON api_historicalfacility
+FOR EACH ROW EXECUTE PROCEDURE notify_gazetteer_facility_change();
+
+CREATE TRIGGER api_historicalfacilitymatch_notify_gazetteer
+AFTER INSERT ON api_historicalfacilitymatch
+FOR EACH ROW EXECUTE PROCEDURE notify_gazetteer_facility_match_change();
+"""
+
+drop_notify_functions = """
+DROP TRIGGER api_historicalfacilitymatch_notify_gazetteer
+  ON api_historicalfacilitymatch;
+DROP TRIGGER api_historicalfacility_notify_gazetteer
+  ON api_historicalfacility;
+DROP FUNCTION notify_gazetteer_facility_match_change;
+DROP FUNCTION notify_gazetteer_facility_change;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0078_processingevent'),
+    ]
+
+    operations = [
+        migrations.RunSQL(create_notify_functions, drop_notify_functions),
+    ]
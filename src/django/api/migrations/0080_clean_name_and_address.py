@@ -0,0 +1,43 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0079_gazetteer_change_notifications'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='facility',
+            name='clean_address',
+            field=models.TextField(blank=True, editable=False, help_text='The address as it is compared by the matching process.', null=True),
+        ),
+        migrations.AddField(
+            model_name='facility',
+            name='clean_name',
+            field=models.TextField(blank=True, editable=False, help_text='The name as it is compared by the matching process.', null=True),
+        ),
+        migrations.AddField(
+            model_name='facilitylistitem',
+            name='clean_address',
+            field=models.TextField(blank=True, editable=False, help_text='The address as it is compared by the matching process.', null=True),
+        ),
+        migrations.AddField(
+            model_name='facilitylistitem',
+            name='clean_name',
+            field=models.TextField(blank=True, editable=False, help_text='The name as it is compared by the matching process.', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalfacility',
+            name='clean_address',
+            field=models.TextField(blank=True, editable=False, help_text='The address as it is compared by the matching process.', null=True),
+        ),
+        migrations.AddField(
+            model_name='historicalfacility',
+            name='clean_name',
+            field=models.TextField(blank=True, editable=False, help_text='The name as it is compared by the matching process.', null=True),
+        ),
+    ]
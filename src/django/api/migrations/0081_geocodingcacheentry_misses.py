@@ -0,0 +1,20 @@
+# Generated by Django 2.2.24 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0080_clean_name_and_address'),
+    ]
+
+    operations = [
+        # Every existing entry was added after one uncached request
+        migrations.AddField(
+            model_name='geocodingcacheentry',
+            name='misses',
+            field=models.IntegerField(default=1, editable=False, help_text='The number of times the address was requested from the API because it was not cached or its entry had expired.'),
+            preserve_default=False,
+        ),
+    ]
@@ -1,6 +1,14 @@
+import copy
+import hashlib
+import json
+import re
+import zlib
+
 from collections import defaultdict
+from datetime import datetime
 from itertools import groupby
 
+from django.conf import settings
 from django.contrib.auth.models import (AbstractBaseUser,
                                         BaseUserManager,
                                         PermissionsMixin)
@@ -8,7 +16,8 @@ from django.contrib.gis.db import models as gis_models
 from django.contrib.postgres import fields as postgres
 from django.contrib.postgres.indexes import GinIndex
 from django.contrib.postgres.aggregates.general import ArrayAgg
-from django.db import models, transaction
+from django.contrib.postgres.search import TrigramSimilarity
+from django.db import connection, models, transaction
 from django.db.models import F, Q, CharField
 from django.db.models.signals import post_save
 from django.db.models.functions import Concat
@@ -20,10 +29,11 @@ from simple_history.models import HistoricalRecords
 from waffle import switch_is_active
 
 from api.constants import FeatureGroups
-from api.countries import COUNTRY_CHOICES
+from api.countries import COUNTRY_CHOICES, COUNTRY_NAMES
 from api.oar_id import make_oar_id
-from api.constants import Affiliations, Certifications, FacilitiesQueryParams
-from api.helpers import prefix_a_an
+from api.constants import (Affiliations, Certifications,
+                           FacilitiesQueryParams, FacilitiesSortBy)
+from api.helpers import clean, prefix_a_an
 
 
 class ArrayLength(models.Func):
@@ -35,6 +45,41 @@ class ArrayLength(models.Func):
     function = 'CARDINALITY'
 
 
+DEFERRED_FIELD = object()
+
+
+class IndexedFieldsMixin:
+    """
+    Remembers the values of the fields listed in `INDEXED_FIELDS` as they were
+    when the instance was loaded or last saved so that `post_save` handlers
+    can skip updating the `FacilityIndex` when none of the fields that feed
+    into it have changed. Field names should be attribute names, i.e.
+    `facility_id` rather than `facility` for foreign keys.
+    """
+    INDEXED_FIELDS = ()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.reset_indexed_fields()
+
+    def _get_indexed_values(self):
+        # Read from `__dict__` so that a deferred field is treated as unknown
+        # rather than triggering a query to load it.
+        return {f: copy.copy(self.__dict__.get(f, DEFERRED_FIELD))
+                for f in self.INDEXED_FIELDS}
+
+    def reset_indexed_fields(self):
+        self._original_indexed_values = self._get_indexed_values()
+
+    @property
+    def indexed_fields_changed(self):
+        current = self._get_indexed_values()
+        return any(
+            current[f] is DEFERRED_FIELD
+            or current[f] != self._original_indexed_values[f]
+            for f in self.INDEXED_FIELDS)
+
+
 class Version(models.Model):
     """
     A table storing feature version numbers.
@@ -85,7 +130,7 @@ class EmailAsUsernameUserManager(BaseUserManager):
         return self._create_user(email, password, **extra_fields)
 
 
-class Contributor(models.Model):
+class Contributor(IndexedFieldsMixin, models.Model):
     """
     A participant in or observer of the supply chain that will
     upload facility lists to the registry.
@@ -190,14 +235,22 @@ class Contributor(models.Model):
 
     history = HistoricalRecords()
 
+    INDEXED_FIELDS = ('contrib_type',)
+
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
+        # Only the contributor type is copied into the index, so there is no
+        # need to reindex every facility the contributor has touched when a
+        # profile field is edited.
+        if not kwargs.get('created') and not instance.indexed_fields_changed:
+            return
+        instance.reset_indexed_fields()
         f_ids = Facility.objects \
             .filter(facilitylistitem__source__contributor=instance)\
             .values_list('id', flat=True)
         if len(f_ids) > 0:
-            index_facilities(f_ids)
+            update_facility_index(f_ids)
 
     def __str__(self):
         return '{name} ({id})'.format(**self.__dict__)
@@ -295,7 +348,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         return True
 
 
-class Source(models.Model):
+class Source(IndexedFieldsMixin, models.Model):
     LIST = 'LIST'
     SINGLE = 'SINGLE'
 
@@ -343,6 +396,9 @@ class Source(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    INDEXED_FIELDS = ('contributor_id', 'facility_list_id', 'is_active',
+                      'is_public')
+
     def __init__(self, *args, **kwargs):
         super(Source, self).__init__(*args, **kwargs)
         self.__original_is_active = self.is_active
@@ -372,11 +428,14 @@ class Source(models.Model):
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
+        if not kwargs.get('created') and not instance.indexed_fields_changed:
+            return
+        instance.reset_indexed_fields()
         f_ids = Facility.objects \
                         .filter(facilitylistitem__source=instance) \
                         .values_list('id', flat=True)
         if len(f_ids) > 0:
-            index_facilities(f_ids)
+            update_facility_index(f_ids)
 
     def __str__(self):
         return '{0} ({1})'.format(
@@ -429,6 +488,56 @@ class FacilityList(models.Model):
             return '{0} [NO SOURCE] ({1})'.format(self.name, self.id)
 
 
+class CleanFieldsMixin(models.Model):
+    """
+    Stores the name and address as they are after being passed through
+    `clean`, so that matching can read them without cleaning every row. An
+    empty string means that the value was cleaned to nothing and null means
+    that the clean value has not been stored yet.
+    """
+    class Meta:
+        abstract = True
+
+    # (field, clean field) pairs
+    CLEAN_FIELDS = (('name', 'clean_name'), ('address', 'clean_address'))
+
+    clean_name = models.TextField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='The name as it is compared by the matching process.')
+    clean_address = models.TextField(
+        null=True,
+        blank=True,
+        editable=False,
+        help_text='The address as it is compared by the matching process.')
+
+    def set_clean_fields(self):
+        for field, clean_field in self.CLEAN_FIELDS:
+            setattr(self, clean_field,
+                    clean(getattr(self, field) or '') or '')
+
+    def get_clean_value(self, field):
+        """
+        Returns:
+        The value of the field passed through `clean`, read from the stored
+        clean field if it has been set.
+        """
+        stored = getattr(self, 'clean_{}'.format(field))
+        if stored is None:
+            return clean(getattr(self, field) or '')
+        return stored or None
+
+    def save(self, *args, **kwargs):
+        self.set_clean_fields()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields).union(
+                clean_field for field, clean_field in self.CLEAN_FIELDS
+                if field in update_fields)
+        super(CleanFieldsMixin, self).save(*args, **kwargs)
+
+
 class PPEMixin(models.Model):
     class Meta:
         abstract = True
@@ -500,7 +609,7 @@ class PPEMixin(models.Model):
         return (self.ppe_website is not None and self.ppe_website != '')
 
 
-class FacilityListItem(PPEMixin):
+class FacilityListItem(CleanFieldsMixin, PPEMixin):
     """
     Data, metadata, and workflow status and results for a single line from a
     facility list file.
@@ -552,6 +661,8 @@ class FacilityListItem(PPEMixin):
         indexes = [
             models.Index(fields=['source', 'row_index'],
                          name='api_fli_facility_list_row_idx'),
+            models.Index(fields=['source', 'fingerprint'],
+                         name='api_fli_source_fingerprint_idx'),
         ]
 
     source = models.ForeignKey(
@@ -568,6 +679,14 @@ class FacilityListItem(PPEMixin):
         null=False,
         blank=False,
         help_text='The full, unparsed CSV line as it appeared in the file.')
+    fingerprint = models.CharField(
+        max_length=32,
+        null=True,
+        editable=False,
+        help_text=('A hash of the raw data and the positions of the parsed '
+                   'columns in the list header. Rows of a replacing list '
+                   'reuse the results of rows of the replaced list with the '
+                   'same fingerprint.'))
     status = models.CharField(
         max_length=200,
         null=False,
@@ -583,10 +702,12 @@ class FacilityListItem(PPEMixin):
         null=True,
         help_text=('When background processing of this item finished. '
                    'Items awaiting or in process will have a null value.'))
-    processing_results = postgres.JSONField(
+    legacy_processing_results = postgres.JSONField(
         default=list,
+        editable=False,
+        db_column='processing_results',
         help_text=('Diagnostic details logged by background processing '
-                   'including details returned from the geocoder.'))
+                   'before they were recorded as processing events.'))
     name = models.CharField(
         max_length=200,
         null=False,
@@ -624,9 +745,284 @@ class FacilityListItem(PPEMixin):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    # The computed `processing_results`, or None if they have not been loaded
+    _processing_results = None
+    # The number of `processing_results` that are already stored
+    _saved_processing_result_count = 0
+
     def __str__(self):
         return 'FacilityListItem {id} - {status}'.format(**self.__dict__)
 
+    @property
+    def processing_results(self):
+        """
+        Diagnostic details logged by background processing including details
+        returned from the geocoder. The list is computed from the legacy
+        results column, the `ProcessingEvent`s of the item and the events
+        recorded for every item of its list. Results appended to the list are
+        inserted as events when the item is saved.
+        """
+        if self._processing_results is None:
+            load_processing_results([self])
+        return self._processing_results
+
+    @processing_results.setter
+    def processing_results(self, value):
+        # Assigned results are all inserted as events when the item is saved
+        self._processing_results = list(value)
+        self._saved_processing_result_count = 0
+
+    def save(self, *args, **kwargs):
+        super(FacilityListItem, self).save(*args, **kwargs)
+        save_processing_events([self])
+
+    def refresh_from_db(self, *args, **kwargs):
+        super(FacilityListItem, self).refresh_from_db(*args, **kwargs)
+        self._processing_results = None
+        self._saved_processing_result_count = 0
+
+
+class ProcessingPayload(models.Model):
+    """
+    A large value from a processing result, such as a full geocoder response,
+    stored compressed. Results with the same value share a payload.
+    """
+    # The keys of processing results whose values may be stored as payloads
+    FIELDS = ('data',)
+
+    # Values are only stored as payloads if their JSON encoding is at least
+    # this many bytes
+    MIN_SIZE = 512
+
+    key = models.CharField(
+        max_length=64,
+        unique=True,
+        editable=False,
+        help_text='A hash of the JSON encoded value.')
+    data = models.BinaryField(
+        editable=False,
+        help_text='The zlib compressed, JSON encoded value.')
+    size = models.IntegerField(
+        editable=False,
+        help_text='The size of the uncompressed value in bytes.')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def get_value(self):
+        return json.loads(zlib.decompress(bytes(self.data)).decode('utf-8'))
+
+    def __str__(self):
+        return 'ProcessingPayload {id} - {size} bytes'.format(**self.__dict__)
+
+
+class ProcessingEvent(models.Model):
+    """
+    A processing result of a single `FacilityListItem` or, if the item is
+    null, of every item in the list of the source. Events are only inserted,
+    never updated, so recording a result does not rewrite the item.
+    """
+    facility_list_item = models.ForeignKey(
+        'FacilityListItem',
+        null=True,
+        on_delete=models.CASCADE,
+        help_text='The item that was processed.')
+    source = models.ForeignKey(
+        'Source',
+        null=True,
+        on_delete=models.CASCADE,
+        help_text=('The source of the list whose items were all processed, '
+                   'if the event is not for a single item.'))
+    action = models.CharField(
+        max_length=200,
+        help_text='The processing action.')
+    started_at = models.DateTimeField(
+        null=True,
+        help_text='When the action started.')
+    finished_at = models.DateTimeField(
+        null=True,
+        help_text='When the action finished.')
+    error = models.NullBooleanField(
+        help_text='Whether the action failed.')
+    data = postgres.JSONField(
+        default=dict,
+        help_text='The other details of the result.')
+    payload = models.ForeignKey(
+        'ProcessingPayload',
+        null=True,
+        on_delete=models.PROTECT,
+        help_text='A large value of the result stored separately.')
+    payload_field = models.CharField(
+        max_length=200,
+        null=True,
+        help_text='The key of the result whose value is the payload.')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def to_result(self, include_payload=True):
+        """
+        Returns:
+        The dict that was recorded in `processing_results`. If
+        `include_payload` is False, the payload value is left out.
+        """
+        result = dict(self.data)
+        result['action'] = self.action
+        if self.error is not None:
+            result['error'] = self.error
+        for name in ('started_at', 'finished_at'):
+            value = getattr(self, name)
+            if value is not None:
+                result[name] = str(value.astimezone(timezone.utc)
+                                   .replace(tzinfo=None))
+        if include_payload and self.payload_id is not None:
+            result[self.payload_field] = self.payload.get_value()
+        return result
+
+    def __str__(self):
+        return 'ProcessingEvent {id} - {action}'.format(**self.__dict__)
+
+
+def _parse_result_time(value):
+    # Results record naive UTC times formatted with `str`. Values that would
+    # not be formatted the same way when read back are kept in `data`.
+    if not isinstance(value, str):
+        return None
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None or str(parsed) != value:
+        return None
+    return parsed.replace(tzinfo=timezone.utc)
+
+
+def make_processing_event(result, payloads, item_id=None, source_id=None):
+    """
+    Build, but do not save, the `ProcessingEvent` for a processing result.
+
+    Arguments:
+    result -- A processing result dict.
+    payloads -- A dict to which the JSON encoding of a large value is added,
+                keyed by its `ProcessingPayload` key. The key is also set as
+                the `payload_key` attribute of the event.
+    item_id -- The ID of the `FacilityListItem` that was processed.
+    source_id -- The ID of the `Source` of the list that was processed, if the
+                 result is for all of its items.
+    """
+    data = dict(result)
+    event = ProcessingEvent(facility_list_item_id=item_id,
+                            source_id=source_id,
+                            action=data.pop('action', ''))
+    if isinstance(data.get('error'), bool):
+        event.error = data.pop('error')
+    for name in ('started_at', 'finished_at'):
+        value = _parse_result_time(data.get(name))
+        if value is not None:
+            setattr(event, name, value)
+            del data[name]
+    event.payload_key = None
+    for name in ProcessingPayload.FIELDS:
+        if name not in data:
+            continue
+        encoded = json.dumps(data[name], sort_keys=True)
+        if len(encoded) >= ProcessingPayload.MIN_SIZE:
+            event.payload_key = hashlib.sha256(
+                encoded.encode('utf-8')).hexdigest()
+            event.payload_field = name
+            payloads[event.payload_key] = encoded
+            del data[name]
+            break
+    event.data = data
+    return event
+
+
+def insert_processing_events(events, payloads):
+    """
+    Insert events built by `make_processing_event`, and the payloads they
+    refer to that are not already stored.
+    """
+    if len(payloads) > 0:
+        ProcessingPayload.objects.bulk_create(
+            [ProcessingPayload(key=key,
+                               data=zlib.compress(encoded.encode('utf-8')),
+                               size=len(encoded.encode('utf-8')))
+             for key, encoded in payloads.items()],
+            ignore_conflicts=True)
+        payload_ids = dict(ProcessingPayload.objects
+                           .filter(key__in=list(payloads.keys()))
+                           .values_list('key', 'id'))
+        for event in events:
+            if event.payload_key is not None:
+                event.payload_id = payload_ids[event.payload_key]
+    ProcessingEvent.objects.bulk_create(events, batch_size=1000)
+
+
+def save_processing_events(items):
+    """
+    Insert the results appended to the `processing_results` of each of the
+    saved items since they were loaded or last saved as `ProcessingEvent`s.
+    Used instead of saving the items when they are updated in bulk.
+    """
+    events = []
+    payloads = {}
+    for item in items:
+        results = item._processing_results
+        if results is None:
+            continue
+        for result in results[item._saved_processing_result_count:]:
+            events.append(
+                make_processing_event(result, payloads, item_id=item.id))
+        item._saved_processing_result_count = len(results)
+    if len(events) > 0:
+        insert_processing_events(events, payloads)
+
+
+def record_list_processing_result(source, result):
+    """
+    Record a processing result for every item in the list of a source with a
+    single `ProcessingEvent`.
+    """
+    payloads = {}
+    insert_processing_events(
+        [make_processing_event(result, payloads, source_id=source.id)],
+        payloads)
+
+
+def load_processing_results(items):
+    """
+    Compute the `processing_results` of the items that have not been loaded
+    with a single query. Items are processed in batches, so loading the
+    results before appending to them avoids a query per item.
+    """
+    pending = [item for item in items if item._processing_results is None]
+    if len(pending) == 0:
+        return
+
+    items_by_id = {}
+    items_by_source_id = defaultdict(list)
+    for item in pending:
+        item._processing_results = copy.deepcopy(
+            item.legacy_processing_results)
+        if item.id is not None:
+            items_by_id[item.id] = item
+            items_by_source_id[item.source_id].append(item)
+
+    if len(items_by_id) > 0:
+        events = (ProcessingEvent.objects
+                  .filter(Q(facility_list_item_id__in=list(items_by_id))
+                          | Q(facility_list_item__isnull=True,
+                              source_id__in=list(items_by_source_id)))
+                  .select_related('payload')
+                  .order_by('id'))
+        for event in events:
+            result = event.to_result()
+            if event.facility_list_item_id is not None:
+                items_by_id[event.facility_list_item_id] \
+                    ._processing_results.append(result)
+            else:
+                for item in items_by_source_id[event.source_id]:
+                    item._processing_results.append(copy.deepcopy(result))
+
+    for item in pending:
+        item._saved_processing_result_count = len(item._processing_results)
+
 
 class FacilityClaim(models.Model):
     """
@@ -1148,6 +1544,52 @@ class FacilityClaimReviewNote(models.Model):
     history = HistoricalRecords()
 
 
+def user_can_see_contributor_detail(user):
+    if user is not None and not user.is_anonymous:
+        return user.can_view_full_contrib_details
+    return True
+
+
+def group_match_sources(matches, user_can_see_detail):
+    """
+    Group the matches to a facility by contributor. When the viewer can see
+    contributor details, the sources of contributors with at least one
+    displayable association are listed individually. All other contributors
+    are reduced to a count of their contributor type, e.g. "2 Brands".
+
+    Arguments:
+    matches (iterable) -- `FacilityMatch` objects for a single facility.
+    user_can_see_detail (bool) -- Whether contributor details may be shown.
+
+    Returns:
+    A list of `Source` objects followed by anonymized contributor strings.
+    """
+    sorted_matches = sorted(matches, key=lambda m: m.source.contributor.id)
+
+    sources = []
+    anonymous_sources = []
+    for contributor, matches in groupby(sorted_matches,
+                                        lambda m: m.source.contributor):
+        # Convert the groupby result to a list to we can iterate over it
+        # multiple times
+        matches = list(matches)
+        should_display_associations = \
+            any([m.should_display_association for m in matches])
+        if user_can_see_detail and should_display_associations:
+            sources.extend(
+                [m.source
+                 for m in matches
+                 if m.should_display_association])
+        else:
+            anonymous_sources.append(contributor.contrib_type)
+
+    anonymous_sources = [
+        Contributor.prefix_with_count(name, len(list(x)))
+        for name, x in groupby(sorted(anonymous_sources))
+    ]
+    return sources + anonymous_sources
+
+
 class FacilityManager(models.Manager):
     def filter_by_query_params(self, params):
         """
@@ -1161,92 +1603,13 @@ class FacilityManager(models.Manager):
         Returns:
         A queryset on the Facility model
         """
-
-        free_text_query = params.get(FacilitiesQueryParams.Q, None)
-
-        name = params.get(FacilitiesQueryParams.NAME, None)
-
-        contributors = params.getlist(FacilitiesQueryParams.CONTRIBUTORS)
-
-        lists = params.getlist(FacilitiesQueryParams.LISTS)
-
-        contributor_types = params \
-            .getlist(FacilitiesQueryParams.CONTRIBUTOR_TYPES)
-
-        countries = params.getlist(FacilitiesQueryParams.COUNTRIES)
-
-        combine_contributors = params.get(
-            FacilitiesQueryParams.COMBINE_CONTRIBUTORS, '')
-
-        boundary = params.get(
-            FacilitiesQueryParams.BOUNDARY, None
-        )
-
-        # The `ppe` query argument is defined as an optional boolean at the
-        # swagger level which is the built in field type option that most
-        # closely matches our desired behavior. Our intended use of the
-        # argument is conditionally "switch on" a special section of filter
-        # logic. To support that behavior we consider a missing value or any
-        # value than the string "true" to be `False`.
-        ppe = (True if params.get(FacilitiesQueryParams.PPE, '') == 'true'
-               else False)
-
-        facilities_qs = FacilityIndex.objects.all()
-
-        if free_text_query is not None:
-            if switch_is_active('ppe'):
-                facilities_qs = facilities_qs \
-                    .filter(Q(name__icontains=free_text_query) |
-                            Q(id__icontains=free_text_query) |
-                            Q(ppe__icontains=free_text_query))
-            else:
-                facilities_qs = facilities_qs \
-                    .filter(Q(name__icontains=free_text_query) |
-                            Q(id__icontains=free_text_query))
-
-        # `name` is deprecated in favor of `q`. We keep `name` available for
-        # backward compatibility.
-        if name is not None:
-            facilities_qs = facilities_qs.filter(Q(name__icontains=name) |
-                                                 Q(id__icontains=name))
-
-        if countries is not None and len(countries):
-            facilities_qs = facilities_qs \
-                .filter(country_code__in=countries)
-
-        if len(contributor_types):
-            facilities_qs = facilities_qs \
-                .filter(contrib_types__overlap=contributor_types)
-
-        if len(contributors):
-            if combine_contributors.upper() == 'AND':
-                facilities_qs = facilities_qs.filter(
-                    contributors__contains=contributors)
-            else:
-                facilities_qs = facilities_qs.filter(
-                    contributors__overlap=contributors)
-
-        if len(lists):
-            facilities_qs = facilities_qs.filter(lists__overlap=lists)
-
-        if boundary is not None:
-            facilities_qs = facilities_qs.filter(
-                location__within=GEOSGeometry(boundary)
-            )
-
-        if ppe:
-            # Include a facility if any of the PPE fields have a non-empty
-            # value.
-            facilities_qs = facilities_qs.filter(~Q(ppe=''))
-
-        facility_ids = facilities_qs.values_list('id', flat=True)
-        facilities_qs = Facility.objects.filter(id__in=facility_ids)
-
-        print(facilities_qs.query)
-        return facilities_qs
+        facility_ids = FacilityIndex.objects \
+            .filter_by_query_params(params) \
+            .values_list('id', flat=True)
+        return self.get_queryset().filter(id__in=facility_ids)
 
 
-class Facility(PPEMixin):
+class Facility(IndexedFieldsMixin, CleanFieldsMixin, PPEMixin):
     """
     An official OAR facility. Search results are returned from this table.
     """
@@ -1306,6 +1669,9 @@ class Facility(PPEMixin):
     history = HistoricalRecords()
     objects = FacilityManager()
 
+    INDEXED_FIELDS = ('name', 'country_code', 'location', 'ppe_product_types',
+                      'ppe_contact_phone', 'ppe_contact_email', 'ppe_website')
+
     def __str__(self):
         return '{name} ({id})'.format(**self.__dict__)
 
@@ -1375,42 +1741,48 @@ class Facility(PPEMixin):
                                 FacilityMatch.MERGED])
 
     def sources(self, user=None):
-        sorted_matches = sorted(
-            self.complete_matches()
-                .exclude(facility_list_item__source__contributor=None)
-                .prefetch_related(
-                    'facility_list_item__source__contributor'
-                ),
-            key=lambda m: m.source.contributor.id
-        )
+        matches = self.complete_matches() \
+            .exclude(facility_list_item__source__contributor=None) \
+            .prefetch_related('facility_list_item__source__contributor')
+        return group_match_sources(matches,
+                                   user_can_see_contributor_detail(user))
 
-        if user is not None and not user.is_anonymous:
-            user_can_see_detail = user.can_view_full_contrib_details
-        else:
-            user_can_see_detail = True
-
-        sources = []
-        anonymous_sources = []
-        for contributor, matches in groupby(sorted_matches,
-                                            lambda m: m.source.contributor):
-            # Convert the groupby result to a list to we can iterate over it
-            # multiple times
-            matches = list(matches)
-            should_display_associations = \
-                any([m.should_display_association for m in matches])
-            if user_can_see_detail and should_display_associations:
-                sources.extend(
-                    [m.source
-                     for m in matches
-                     if m.should_display_association])
-            else:
-                anonymous_sources.append(contributor.contrib_type)
+    @staticmethod
+    def sources_by_facility(facility_ids, user=None):
+        """
+        Build the `sources` list of several facilities at once. The matches,
+        sources, contributors, contributor admins and lists are fetched in a
+        single query regardless of the number of facilities.
 
-        anonymous_sources = [
-            Contributor.prefix_with_count(name, len(list(x)))
-            for name, x in groupby(sorted(anonymous_sources))
-        ]
-        return sources + anonymous_sources
+        Arguments:
+        facility_ids (list) -- The IDs of the facilities.
+        user (User) -- The user viewing the facilities, which determines
+                       whether contributors are anonymized.
+
+        Returns:
+        A dict mapping each facility ID to the list that `sources` would
+        return for that facility.
+        """
+        matches = FacilityMatch.objects \
+            .filter(facility_id__in=facility_ids,
+                    status__in=[FacilityMatch.AUTOMATIC,
+                                FacilityMatch.CONFIRMED,
+                                FacilityMatch.MERGED]) \
+            .exclude(facility_list_item__source__contributor=None) \
+            .select_related(
+                'facility_list_item__source__contributor__admin',
+                'facility_list_item__source__facility_list')
+
+        matches_by_facility = defaultdict(list)
+        for match in matches:
+            matches_by_facility[match.facility_id].append(match)
+
+        user_can_see_detail = user_can_see_contributor_detail(user)
+        return {
+            facility_id: group_match_sources(
+                matches_by_facility[facility_id], user_can_see_detail)
+            for facility_id in facility_ids
+        }
 
     def get_created_from_match(self):
         return self.facilitymatch_set.filter(
@@ -1513,7 +1885,164 @@ class Facility(PPEMixin):
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
-        index_facilities([instance.id])
+        if not kwargs.get('created') and not instance.indexed_fields_changed:
+            return
+        instance.reset_indexed_fields()
+        update_facility_index([instance.id])
+
+
+OAR_ID_PREFIX = re.compile(r'^([A-Z]{2})[0-9][0-9A-Z]*$')
+
+
+def get_oar_id_prefix(query):
+    """
+    Returns:
+    The query normalized to upper case with spaces and hyphens removed if it
+    looks like the start of an OAR ID, i.e. a country code followed by the
+    digits of the creation date, otherwise None.
+    """
+    prefix = query.upper().replace('-', '').replace(' ', '')
+    match = OAR_ID_PREFIX.match(prefix)
+    if match is None or len(prefix) > 15 \
+            or match.group(1) not in COUNTRY_NAMES:
+        return None
+    return prefix
+
+
+def get_free_text_filter(query, include_ppe=False):
+    """
+    Build a filter matching facilities whose name, OAR ID or, optionally, PPE
+    details contain the query. Every part of the filter can be answered from
+    an index: the name, ppe and id columns have trigram indexes, and an OAR ID
+    prefix is matched with `startswith` so that the primary key index can be
+    used even when the query is shorter than a trigram.
+    """
+    filter = Q(name__icontains=query)
+    if include_ppe:
+        filter |= Q(ppe__icontains=query)
+
+    oar_id_prefix = get_oar_id_prefix(query)
+    if oar_id_prefix is not None:
+        filter |= Q(id__startswith=oar_id_prefix)
+    elif query.isalnum():
+        # OAR IDs only contain letters and numbers
+        filter |= Q(id__icontains=query)
+    return filter
+
+
+class FacilityIndexManager(models.Manager):
+    def filter_by_query_params(self, params):
+        """
+        Create a FacilityIndex queryset filtered by a list of request query
+        params. List, count, extent and tile queries can be answered from the
+        index without joining to the Facility table.
+
+        Arguments:
+        self (queryset) -- A queryset on the FacilityIndex model
+        params (dict) -- Request query parameters whose potential choices are
+                        enumerated in `api.constants.FacilitiesQueryParams`.
+
+        Returns:
+        A queryset on the FacilityIndex model
+        """
+
+        free_text_query = params.get(FacilitiesQueryParams.Q, None)
+
+        name = params.get(FacilitiesQueryParams.NAME, None)
+
+        contributors = params.getlist(FacilitiesQueryParams.CONTRIBUTORS)
+
+        lists = params.getlist(FacilitiesQueryParams.LISTS)
+
+        contributor_types = params \
+            .getlist(FacilitiesQueryParams.CONTRIBUTOR_TYPES)
+
+        countries = params.getlist(FacilitiesQueryParams.COUNTRIES)
+
+        combine_contributors = params.get(
+            FacilitiesQueryParams.COMBINE_CONTRIBUTORS, '')
+
+        boundary = params.get(
+            FacilitiesQueryParams.BOUNDARY, None
+        )
+
+        # The `ppe` query argument is defined as an optional boolean at the
+        # swagger level which is the built in field type option that most
+        # closely matches our desired behavior. Our intended use of the
+        # argument is conditionally "switch on" a special section of filter
+        # logic. To support that behavior we consider a missing value or any
+        # value than the string "true" to be `False`.
+        ppe = (True if params.get(FacilitiesQueryParams.PPE, '') == 'true'
+               else False)
+
+        facilities_qs = self.get_queryset()
+
+        if free_text_query is not None:
+            facilities_qs = facilities_qs.filter(
+                get_free_text_filter(free_text_query,
+                                     include_ppe=switch_is_active('ppe')))
+
+        # `name` is deprecated in favor of `q`. We keep `name` available for
+        # backward compatibility.
+        if name is not None:
+            facilities_qs = facilities_qs.filter(
+                get_free_text_filter(name, include_ppe=False))
+
+        if countries is not None and len(countries):
+            facilities_qs = facilities_qs \
+                .filter(country_code__in=countries)
+
+        if len(contributor_types):
+            facilities_qs = facilities_qs \
+                .filter(contrib_types__overlap=contributor_types)
+
+        if len(contributors):
+            if combine_contributors.upper() == 'AND':
+                facilities_qs = facilities_qs.filter(
+                    contributors__contains=contributors)
+            else:
+                facilities_qs = facilities_qs.filter(
+                    contributors__overlap=contributors)
+
+        if len(lists):
+            facilities_qs = facilities_qs.filter(lists__overlap=lists)
+
+        if boundary is not None:
+            facilities_qs = facilities_qs.filter(
+                location__within=GEOSGeometry(boundary)
+            )
+
+        if ppe:
+            # Include a facility if any of the PPE fields have a non-empty
+            # value.
+            facilities_qs = facilities_qs.filter(~Q(ppe=''))
+
+        return facilities_qs
+
+    def order_by_query_params(self, facilities_qs, params):
+        """
+        Order a FacilityIndex queryset returned by `filter_by_query_params`
+        for a list of results. Kept separate from the filters so that the
+        count, extent and tile queries built from them are not ranked.
+
+        Arguments:
+        facilities_qs (queryset) -- A queryset on the FacilityIndex model
+        params (dict) -- Request query parameters whose potential choices are
+                        enumerated in `api.constants.FacilitiesQueryParams`.
+
+        Returns:
+        A queryset on the FacilityIndex model ordered by relevance to the free
+        text query if `sort_by` is "relevance", otherwise by name.
+        """
+        free_text_query = params.get(FacilitiesQueryParams.Q, None)
+        sort_by = params.get(FacilitiesQueryParams.SORT_BY, None)
+        if (free_text_query is not None
+                and sort_by == FacilitiesSortBy.RELEVANCE):
+            return facilities_qs \
+                .annotate(search_rank=TrigramSimilarity(
+                    'name', free_text_query)) \
+                .order_by('-search_rank', 'name')
+        return facilities_qs.order_by('name')
 
 
 class FacilityIndex(models.Model):
@@ -1563,11 +2092,241 @@ class FacilityIndex(models.Model):
         editable=False,
         help_text='The related list if the type of the source is LIST.'))
 
+    objects = FacilityIndexManager()
+
     class Meta:
         indexes = [GinIndex(fields=['contrib_types', 'contributors', 'lists'])]
 
 
-class FacilityMatch(models.Model):
+class FacilityIndexQueue(models.Model):
+    """
+    The IDs of facilities whose `FacilityIndex` rows need to be rebuilt. Rows
+    are added when DEFER_FACILITY_INDEX is enabled and removed by the
+    `process_facility_index_queue` management command.
+    """
+    class Meta:
+        verbose_name_plural = 'facility index queue'
+
+    facility_id = models.CharField(
+        max_length=32,
+        null=False,
+        unique=True,
+        editable=False,
+        help_text='The OAR ID of a facility that needs to be reindexed.')
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{facility_id} ({created_at})'.format(**self.__dict__)
+
+
+class FacilityGridCell(models.Model):
+    """
+    A hexagonal cell of the grid drawn by the facilitygrid tile layer at a
+    specific zoom level. Cells are aligned to a global grid, so the same cell
+    is drawn by every tile that it overlaps.
+    """
+    # The highest zoom level at which the facilitygrid layer is displayed
+    MAX_ZOOM = 11
+    # Each tile is divided into 2 ** ZOOM_FACTOR cells horizontally
+    ZOOM_FACTOR = 3
+    # The width of the web mercator projection in meters
+    WORLD_WIDTH = 2 * 20037508.342789244
+
+    class Meta:
+        unique_together = ('zoom', 'x_index', 'y_index', 'is_offset')
+
+    zoom = models.IntegerField(null=False, editable=False)
+    x_index = models.IntegerField(
+        null=False,
+        editable=False,
+        help_text='The column of the cell in the global grid.')
+    y_index = models.IntegerField(
+        null=False,
+        editable=False,
+        help_text='The row pair of the cell in the global grid.')
+    is_offset = models.BooleanField(
+        null=False,
+        editable=False,
+        help_text=('Whether the cell is in the upper row of the pair, which '
+                   'is offset by half a cell width.'))
+    geom = gis_models.PolygonField(
+        srid=3857,
+        null=False,
+        editable=False,
+        help_text='The outline of the cell in web mercator.')
+    is_dirty = models.BooleanField(
+        null=False,
+        default=True,
+        help_text=('Whether the facilities in the cell have changed since the '
+                   'counts were last calculated.'))
+
+    @staticmethod
+    def width(zoom):
+        return FacilityGridCell.WORLD_WIDTH / (2 ** zoom) \
+            / (2 ** FacilityGridCell.ZOOM_FACTOR)
+
+    def __str__(self):
+        return '{zoom}/{x_index}/{y_index}/{is_offset}'.format(
+            **self.__dict__)
+
+
+class FacilityGridCount(models.Model):
+    """
+    The number of indexed facilities in a `FacilityGridCell`, either in total
+    or for a single country, contributor or contributor type.
+    """
+    ALL = 'all'
+    COUNTRY = 'country'
+    CONTRIBUTOR = 'contributor'
+    CONTRIBUTOR_TYPE = 'contributor_type'
+
+    DIMENSION_CHOICES = (
+        (ALL, ALL),
+        (COUNTRY, COUNTRY),
+        (CONTRIBUTOR, CONTRIBUTOR),
+        (CONTRIBUTOR_TYPE, CONTRIBUTOR_TYPE),
+    )
+
+    class Meta:
+        unique_together = ('cell', 'dimension', 'value')
+
+    cell = models.ForeignKey(
+        'FacilityGridCell',
+        null=False,
+        on_delete=models.CASCADE,
+        related_name='counts',
+        editable=False)
+    dimension = models.CharField(
+        max_length=20,
+        null=False,
+        choices=DIMENSION_CHOICES,
+        editable=False)
+    value = models.CharField(
+        max_length=200,
+        null=False,
+        blank=True,
+        editable=False,
+        help_text=('The country code, contributor ID or contributor type. '
+                   'Empty when the dimension is "all".'))
+    count = models.IntegerField(null=False, editable=False)
+
+
+class TileCacheEntry(models.Model):
+    """
+    A vector tile rendered by `get_tile`, stored so that requests that miss
+    the CDN do not need to render the tile again. Entries are only valid for
+    the tile cache key under which they were rendered and are evicted least
+    recently used first once the cache grows past TILE_CACHE_MAX_SIZE_IN_BYTES.
+    """
+    class Meta:
+        verbose_name_plural = 'tile cache entries'
+        indexes = [
+            models.Index(fields=['cache_key']),
+            models.Index(fields=['last_accessed_at']),
+        ]
+
+    key = models.CharField(
+        max_length=64,
+        null=False,
+        unique=True,
+        editable=False,
+        help_text=('A hash of the layer, tile coordinates, cache key and '
+                   'normalized query parameters.'))
+    cache_key = models.CharField(
+        max_length=100,
+        null=False,
+        editable=False,
+        help_text='The tile cache key at the time the tile was rendered.')
+    layer = models.CharField(max_length=20, null=False, editable=False)
+    z = models.IntegerField(null=False, editable=False)
+    x = models.IntegerField(null=False, editable=False)
+    y = models.IntegerField(null=False, editable=False)
+    tile = models.BinaryField(
+        null=True,
+        editable=False,
+        help_text='The tile bytes. Null if the query had no results.')
+    size = models.IntegerField(
+        null=False,
+        editable=False,
+        help_text='The size of the tile in bytes.')
+    hits = models.IntegerField(
+        null=False,
+        default=0,
+        editable=False,
+        help_text='The number of times the entry has been served.')
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{layer}/{z}/{x}/{y} ({cache_key})'.format(**self.__dict__)
+
+
+class GeocodingCacheEntry(models.Model):
+    """
+    A successful response from the Google Maps Geocoding API, stored so that
+    geocoding an address and country that have already been geocoded does
+    not send another request. Entries expire after GEOCODING_CACHE_TTL_IN_DAYS
+    and are evicted least recently used first once there are more than
+    GEOCODING_CACHE_MAX_ENTRIES.
+    """
+    class Meta:
+        verbose_name_plural = 'geocoding cache entries'
+        indexes = [
+            models.Index(fields=['created_at']),
+            models.Index(fields=['last_accessed_at']),
+        ]
+
+    key = models.CharField(
+        max_length=64,
+        null=False,
+        unique=True,
+        editable=False,
+        help_text='A hash of the normalized address and country code.')
+    address = models.TextField(
+        null=False,
+        editable=False,
+        help_text='The normalized address.')
+    country_code = models.CharField(
+        max_length=2,
+        null=False,
+        editable=False,
+        help_text='The ISO 3166-1 alpha-2 country code.')
+    result_count = models.IntegerField(
+        null=False,
+        editable=False,
+        help_text='The number of results in the response.')
+    geocoded_address = models.TextField(
+        null=True,
+        editable=False,
+        help_text='The formatted address of the first result.')
+    response = postgres.JSONField(
+        null=False,
+        editable=False,
+        help_text='The response payload.')
+    duration = models.IntegerField(
+        null=False,
+        editable=False,
+        help_text='The time taken by the request, in milliseconds.')
+    hits = models.IntegerField(
+        null=False,
+        default=0,
+        editable=False,
+        help_text='The number of times the entry has been used.')
+    misses = models.IntegerField(
+        null=False,
+        default=0,
+        editable=False,
+        help_text=('The number of times the address was requested from the '
+                   'API because it was not cached or its entry had '
+                   'expired.'))
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_accessed_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return '{address} ({country_code})'.format(**self.__dict__)
+
+
+class FacilityMatch(IndexedFieldsMixin, models.Model):
     """
     Matches between existing facilities and uploaded facility list items.
     """
@@ -1633,6 +2392,9 @@ class FacilityMatch(models.Model):
 
     history = HistoricalRecords()
 
+    INDEXED_FIELDS = ('facility_id', 'facility_list_item_id', 'status',
+                      'is_active')
+
     def __init__(self, *args, **kwargs):
         super(FacilityMatch, self).__init__(*args, **kwargs)
         self.__original_is_active = self.is_active
@@ -1660,7 +2422,18 @@ class FacilityMatch(models.Model):
     @staticmethod
     def post_save(sender, **kwargs):
         instance = kwargs.get('instance')
-        index_facilities([instance.facility.id])
+        if not kwargs.get('created') and not instance.indexed_fields_changed:
+            return
+        facility_ids = [instance.facility_id]
+        # When a match is moved to a different facility, the facility it was
+        # moved away from also needs to be reindexed
+        original_facility_id = \
+            instance._original_indexed_values['facility_id']
+        if original_facility_id not in (None, DEFERRED_FIELD,
+                                        instance.facility_id):
+            facility_ids.append(original_facility_id)
+        instance.reset_indexed_fields()
+        update_facility_index(facility_ids)
 
     def __str__(self):
         return '{0} - {1} - {2}'.format(self.facility_list_item, self.facility,
@@ -2219,13 +2992,42 @@ class ExtendedField(models.Model):
     history = HistoricalRecords()
 
 
+FACILITY_INDEX_COLUMNS = ('id', 'name', 'country_code', 'location',
+                          'contrib_types', 'contributors', 'lists', 'ppe')
+FACILITY_INDEX_ARRAY_COLUMNS = ('contrib_types', 'contributors', 'lists')
+
+
 @transaction.atomic
 def index_facilities(facility_ids=list):
     # If passed an empty array, create or update all existing facilities
     if len(facility_ids) == 0:
         print('Indexing all facilities...')
-        facility_ids = Facility.objects.all().values_list('id', flat=True)
+        mark_facility_grid_cells_dirty()
+        data = get_facility_index_data()
+        write_facility_index(data)
+        mark_facility_grid_cells_dirty()
+    else:
+        # Both the cells that facilities are moving out of and the cells that
+        # they are moving in to need to be recounted
+        mark_facility_grid_cells_dirty(facility_ids)
+        data = get_facility_index_data(facility_id__in=facility_ids)
+        write_facility_index(data, facility_ids=facility_ids)
+        mark_facility_grid_cells_dirty(facility_ids)
+
+
+def get_facility_index_data(**filters):
+    """
+    Build a queryset of `FacilityMatch` aggregates in the structure of
+    `FacilityIndex` rows, one per facility.
+
+    Arguments:
+    filters -- Keyword arguments passed to `FacilityMatch.objects.filter` to
+               select the facilities to include. All facilities are included
+               if omitted.
 
+    Returns:
+    A values queryset with one dict per facility.
+    """
     contrib_type = 'facility_list_item__source__contributor__contrib_type'
     contributor = 'facility_list_item__source__contributor'
     list = 'facility_list_item__source__facility_list_id'
@@ -2237,8 +3039,8 @@ def index_facilities(facility_ids=list):
               & Q(facility_list_item__source__is_public=True))
 
     # Create a list of dictionaries in the structure of FacilityIndexes
-    data = FacilityMatch.objects \
-                        .filter(facility_id__in=facility_ids) \
+    return FacilityMatch.objects \
+                        .filter(**filters) \
                         .annotate(name=F('facility__name'),
                                   country_code=F('facility__country_code'),
                                   location=F('facility__location')) \
@@ -2259,8 +3061,134 @@ def index_facilities(facility_ids=list):
                                              'facility__ppe_website',
                                              output_field=CharField()))
 
-    FacilityIndex.objects.filter(id__in=facility_ids).delete()
-    FacilityIndex.objects.bulk_create([FacilityIndex(**kv) for kv in data])
+
+def write_facility_index(data, facility_ids=None,
+                         table=FacilityIndex._meta.db_table):
+    """
+    Upsert the rows produced by `get_facility_index_data` into a facility
+    index table, then remove the rows for facilities that no longer have any
+    data to index. The CTE lets us do both in a single statement.
+
+    Arguments:
+    data -- A queryset returned by `get_facility_index_data`.
+    facility_ids -- The IDs of the facilities that `data` covers. Rows with
+                    these IDs that are not in `data` are deleted. If None,
+                    `data` is assumed to cover every facility and all other
+                    rows are deleted.
+    table -- The name of the table to write to. Defaults to the
+             `FacilityIndex` table.
+
+    Returns:
+    The number of rows inserted or updated.
+    """
+    data_sql, data_params = data.query.sql_with_params()
+
+    columns = ', '.join(
+        connection.ops.quote_name(c) for c in FACILITY_INDEX_COLUMNS)
+    # ArrayAgg returns NULL rather than an empty array when the filter
+    # excludes every row, but the array columns are not nullable
+    select_columns = ', '.join(
+        "COALESCE({0}, '{{}}')".format(connection.ops.quote_name(c))
+        if c in FACILITY_INDEX_ARRAY_COLUMNS
+        else connection.ops.quote_name(c)
+        for c in FACILITY_INDEX_COLUMNS)
+    updates = ', '.join(
+        '{0} = EXCLUDED.{0}'.format(connection.ops.quote_name(c))
+        for c in FACILITY_INDEX_COLUMNS if c != 'id')
+    upsert_sql = (
+        'WITH upserted AS ('
+        '  INSERT INTO {table} ({columns}) '
+        '  SELECT {select_columns} FROM ({data_sql}) AS data '
+        '  ON CONFLICT (id) DO UPDATE SET {updates} '
+        '  RETURNING id'
+        '), deleted AS ('
+        '  DELETE FROM {table} '
+        '  WHERE {delete_filter} id NOT IN (SELECT id FROM upserted)'
+        ') '
+        'SELECT COUNT(*) FROM upserted'
+    ).format(
+        table=connection.ops.quote_name(table),
+        columns=columns,
+        select_columns=select_columns,
+        data_sql=data_sql,
+        updates=updates,
+        delete_filter='' if facility_ids is None else 'id = ANY(%s) AND')
+
+    params = data_params if facility_ids is None else data_params + (
+        [str(id) for id in facility_ids],)
+
+    with connection.cursor() as cursor:
+        cursor.execute(upsert_sql, params)
+        return cursor.fetchone()[0]
+
+
+def mark_facility_grid_cells_dirty(facility_ids=None,
+                                   table=FacilityIndex._meta.db_table):
+    """
+    Flag the `FacilityGridCell` rows that contain the indexed locations of
+    the specified facilities so that their counts are recalculated by the
+    `refresh_facility_grid` management command. Cells that do not exist yet
+    are created.
+
+    Arguments:
+    facility_ids -- The IDs of the facilities to look up in the
+                    `FacilityIndex`. All facilities are included if None.
+    table -- The name of the facility index table to read the locations
+             from. Defaults to the `FacilityIndex` table.
+    """
+    zooms = range(FacilityGridCell.MAX_ZOOM + 1)
+    query = (
+        'INSERT INTO {cell_table} '
+        '  (zoom, x_index, y_index, is_offset, geom, is_dirty) '
+        'SELECT DISTINCT z.zoom, c.x_index, c.y_index, c.is_offset, '
+        '  hexgrid_cell_geom(z.width, c.x_index, c.y_index, c.is_offset), '
+        '  true '
+        'FROM {index_table} f '
+        'CROSS JOIN unnest(%s::int[], %s::float[]) AS z(zoom, width) '
+        'CROSS JOIN LATERAL hexgrid_cell('
+        '  z.width, '
+        '  ST_X(ST_Transform(f.location, 3857)), '
+        '  ST_Y(ST_Transform(f.location, 3857))) AS c '
+        '{where} '
+        'ON CONFLICT (zoom, x_index, y_index, is_offset) '
+        'DO UPDATE SET is_dirty = true'
+    ).format(cell_table=FacilityGridCell._meta.db_table,
+             index_table=connection.ops.quote_name(table),
+             where='' if facility_ids is None else 'WHERE f.id = ANY(%s)')
+    params = [list(zooms), [FacilityGridCell.width(z) for z in zooms]]
+    if facility_ids is not None:
+        params.append([str(id) for id in facility_ids])
+    with connection.cursor() as cursor:
+        cursor.execute(query, params)
+
+
+def enqueue_facility_index(facility_ids):
+    """
+    Add the specified facility IDs to the `FacilityIndexQueue` once the
+    current transaction commits. IDs that are already in the queue are
+    ignored, so repeated changes to a facility are coalesced into a single
+    reindex.
+    """
+    facility_ids = {str(id) for id in facility_ids}
+
+    def enqueue():
+        FacilityIndexQueue.objects.bulk_create(
+            [FacilityIndexQueue(facility_id=id) for id in facility_ids],
+            ignore_conflicts=True)
+
+    transaction.on_commit(enqueue)
+
+
+def update_facility_index(facility_ids):
+    """
+    Bring the `FacilityIndex` up to date for the specified facility IDs,
+    either immediately or, if DEFER_FACILITY_INDEX is enabled, by adding them
+    to the queue that is drained by `process_facility_index_queue`.
+    """
+    if getattr(settings, 'DEFER_FACILITY_INDEX', False):
+        enqueue_facility_index(facility_ids)
+    else:
+        index_facilities(facility_ids)
 
 
 post_save.connect(Facility.post_save, sender=Facility)
@@ -0,0 +1,182 @@
+import time
+
+from collections import Counter, defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from django.db import connections, transaction
+
+from api.concurrent_geocoding import geocode_list_items
+from api.mail import notify_facility_list_complete
+from api.matching import (match_facility_list_items,
+                          normalize_extended_facility_id)
+from api.models import Facility, FacilityListItem
+from api.processing import (parse_facility_list_items,
+                            save_match_details,
+                            save_match_details_in_bulk)
+
+MATCHABLE_STATUSES = (FacilityListItem.GEOCODED,
+                      FacilityListItem.GEOCODED_NO_RESULTS)
+
+
+def parse_and_geocode_items(item_ids, geocode_concurrency=1):
+    """
+    Parse and geocode a chunk of list items, recording the same processing
+    results as the parse and geocode actions of `batch_process`. Runs in the
+    worker processes of `run_pipeline`.
+
+    Returns:
+    The IDs of the items that are ready to be matched.
+    """
+    items = list(FacilityListItem.objects
+                 .filter(id__in=item_ids)
+                 .select_related('source__facility_list')
+                 .order_by('row_index'))
+    uploaded_items = [item for item in items
+                      if item.status == FacilityListItem.UPLOADED]
+    if len(uploaded_items) > 0:
+        with transaction.atomic():
+            parse_facility_list_items(
+                uploaded_items[0].source.facility_list, uploaded_items)
+
+    geocode_list_items(
+        [item for item in items if item.status == FacilityListItem.PARSED],
+        concurrency=geocode_concurrency)
+
+    return [item.id for item in items if item.status in MATCHABLE_STATUSES]
+
+
+def exclude_matches_to_list(match_results, facility_list):
+    """
+    Remove matches to facilities that were created from items in
+    `facility_list`. When a list is matched all at once these matches cannot
+    occur, because its facilities are only created once the matches are
+    saved, so they are removed to give the same results when the list is
+    matched in batches.
+    """
+    facility_ids = set(Facility.objects
+                       .filter(created_from__source=facility_list.source)
+                       .values_list('id', flat=True))
+    if len(facility_ids) == 0:
+        return
+    item_matches = match_results['item_matches']
+    for item_id in list(item_matches.keys()):
+        matches = [(facility_id, score)
+                   for facility_id, score in item_matches[item_id]
+                   if normalize_extended_facility_id(facility_id)
+                   not in facility_ids]
+        if len(matches) > 0:
+            item_matches[item_id] = matches
+        else:
+            del item_matches[item_id]
+
+
+def match_items_in_list(facility_list, item_ids, bulk=False):
+    """
+    Match a batch of geocoded items from a list and save the results.
+
+    Returns:
+    The number of items that were matched.
+    """
+    result = match_facility_list_items(facility_list, item_ids=item_ids)
+    exclude_matches_to_list(result, facility_list)
+    with transaction.atomic():
+        if bulk:
+            save_match_details_in_bulk(result)
+        else:
+            save_match_details(result)
+    return len(result['processed_list_item_ids'])
+
+
+def run_pipeline(facility_lists, workers=4, chunk_size=100,
+                 match_batch_size=1000, geocode_concurrency=4, bulk=False,
+                 notify=True, stdout=None):
+    """
+    Process facility lists through the parse, geocode, match and notify
+    steps without AWS Batch.
+
+    The items of each list are split into chunks of contiguous rows, which are
+    parsed and geocoded by a pool of worker processes, so that the geocoding
+    of early rows overlaps with the parsing of later rows. As chunks finish,
+    their items are matched in batches by this process, which keeps a single
+    gazetteer in memory. A list is matched in batches of at least
+    `match_batch_size` items, and the completion email is sent once all of
+    its items have been matched.
+
+    Arguments:
+    facility_lists -- The `FacilityList` objects to process.
+    workers -- The number of worker processes.
+    chunk_size -- The number of items parsed and geocoded by each task.
+    match_batch_size -- The minimum number of items matched at once, other
+                        than the last batch of each list.
+    geocode_concurrency -- The number of geocoding requests each worker sends
+                           in parallel.
+    bulk -- Save match results with `save_match_details_in_bulk`.
+    notify -- Send the list completion email.
+    stdout -- An optional stream to which progress is written.
+
+    Returns:
+    A Counter of the final item statuses across all lists.
+    """
+    def log(message):
+        if stdout is not None:
+            stdout.write(message)
+
+    started = time.monotonic()
+    lists_by_id = {}
+    chunks = []
+    for facility_list in facility_lists:
+        lists_by_id[facility_list.id] = facility_list
+        item_ids = list(facility_list.source.facilitylistitem_set
+                        .order_by('row_index')
+                        .values_list('id', flat=True))
+        for start in range(0, len(item_ids), chunk_size):
+            chunks.append(
+                (facility_list.id, item_ids[start:start + chunk_size]))
+
+    remaining_chunks = Counter(list_id for list_id, _ in chunks)
+    pending_item_ids = defaultdict(list)
+    item_count = sum(len(item_ids) for _, item_ids in chunks)
+
+    def finish_list(list_id):
+        facility_list = lists_by_id[list_id]
+        if len(pending_item_ids[list_id]) > 0:
+            match_items_in_list(facility_list,
+                                pending_item_ids.pop(list_id), bulk=bulk)
+        if notify:
+            notify_facility_list_complete(list_id)
+        log('Finished list {} ({:.1f}s)'.format(
+            list_id, time.monotonic() - started))
+
+    for list_id in lists_by_id:
+        if remaining_chunks[list_id] == 0:
+            finish_list(list_id)
+
+    # The worker processes must open their own connections rather than
+    # sharing the one inherited from this process
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(parse_and_geocode_items, item_ids,
+                            geocode_concurrency): list_id
+            for list_id, item_ids in chunks
+        }
+        for future in as_completed(futures):
+            list_id = futures[future]
+            pending_item_ids[list_id].extend(future.result())
+            remaining_chunks[list_id] -= 1
+
+            if remaining_chunks[list_id] == 0:
+                finish_list(list_id)
+            elif len(pending_item_ids[list_id]) >= match_batch_size:
+                matched = match_items_in_list(
+                    lists_by_id[list_id], pending_item_ids.pop(list_id),
+                    bulk=bulk)
+                log('Matched {} items from list {}'.format(matched, list_id))
+
+    statuses = Counter(FacilityListItem.objects
+                       .filter(source__facility_list__in=list(lists_by_id))
+                       .values_list('status', flat=True))
+    elapsed = time.monotonic() - started
+    log('Processed {} items in {:.1f}s ({:.1f} items/s)'.format(
+        item_count, elapsed, item_count / elapsed if elapsed > 0 else 0))
+    return statuses
@@ -1,21 +1,36 @@
 import copy
 import csv
+import hashlib
+import io
+import json
 import traceback
 import sys
 
 import xlrd
 
 from datetime import datetime
+from itertools import islice
 
 from django.conf import settings
 from django.contrib.gis.geos import Point
 from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import F, Q, QuerySet
+from django.utils import timezone
+from simple_history.utils import get_history_model_for_model
 
 from api.constants import CsvHeaderField, ProcessingAction
-from api.models import Facility, FacilityMatch, FacilityListItem
+from api.models import (Facility,
+                        FacilityMatch,
+                        FacilityListItem,
+                        load_processing_results,
+                        save_processing_events,
+                        update_facility_index)
 from api.countries import COUNTRY_CODES, COUNTRY_NAMES
 from api.geocoding import geocode_address
-from api.matching import normalize_extended_facility_id, clean
+from api.matching import normalize_extended_facility_id
+from api.oar_id import make_oar_id
+from api.xlsx import iter_xlsx_rows
 
 
 def _report_error_to_rollbar(file, request):
@@ -45,40 +60,149 @@ def get_excel_sheet(file, request):
                               'cannot be processed safely')
 
 
-def parse_excel(file, request):
-    try:
+def iter_excel_values(file, request):
+    """
+    Read the cell values of each row of the first sheet of an Excel file.
+    XLSX rows are streamed from the file. XLS files are read with xlrd, which
+    loads the whole sheet, but the rows are still returned one at a time.
+    """
+    if file.name.endswith('.xlsx'):
+        yield from iter_xlsx_rows(file)
+    else:
         sheet = get_excel_sheet(file, request)
+        for idx in range(sheet.nrows):
+            yield sheet.row_values(idx)
 
-        header = ','.join(sheet.row_values(0))
-        rows = ['"{}"'.format('","'.join(sheet.row_values(idx)))
-                for idx in range(1, sheet.nrows)]
 
-        return header, rows
+def _iter_excel_rows(values, file, request):
+    try:
+        for row_values in values:
+            yield '"{}"'.format('","'.join(row_values))
     except Exception:
         _report_error_to_rollbar(file, request)
         raise ValidationError('Error parsing Excel file')
 
 
-def parse_csv(file, request):
-    rows = []
+def parse_excel(file, request):
+    """
+    Read the header of an Excel file.
 
+    Returns:
+    A (header, rows) tuple where `rows` is a generator of the remaining rows
+    formatted as quoted CSV lines. The rows are read from the file as the
+    generator is consumed, and a ValidationError is raised from the generator
+    if a row cannot be read.
+    """
+    values = iter_excel_values(file, request)
     try:
-        header = file.readline().decode(encoding='utf-8-sig').rstrip()
-    except UnicodeDecodeError:
+        header = ','.join(next(values))
+    except Exception:
         _report_error_to_rollbar(file, request)
-        raise ValidationError('Unsupported file encoding. Please '
-                              'submit a UTF-8 CSV.')
+        raise ValidationError('Error parsing Excel file')
+
+    return header, _iter_excel_rows(values, file, request)
+
 
+def _iter_csv_rows(file, request):
+    # Iterating over an uploaded file starts again from the first line
     for idx, line in enumerate(file):
         if idx > 0:
             try:
-                rows.append(line.decode(encoding='utf-8-sig').rstrip())
+                yield line.decode(encoding='utf-8-sig').rstrip()
             except UnicodeDecodeError:
                 _report_error_to_rollbar(file, request)
                 raise ValidationError('Unsupported file encoding. Please '
                                       'submit a UTF-8 CSV.')
 
-    return header, rows
+
+def parse_csv(file, request):
+    """
+    Read the header of a CSV file.
+
+    Returns:
+    A (header, rows) tuple where `rows` is a generator of the remaining
+    lines. The lines are decoded as the generator is consumed, and a
+    ValidationError is raised from the generator if a line is not UTF-8.
+    """
+    try:
+        header = file.readline().decode(encoding='utf-8-sig').rstrip()
+    except UnicodeDecodeError:
+        _report_error_to_rollbar(file, request)
+        raise ValidationError('Unsupported file encoding. Please '
+                              'submit a UTF-8 CSV.')
+
+    return header, _iter_csv_rows(file, request)
+
+
+# The maximum number of rows written by each query issued by
+# `insert_facility_list_items`
+ITEM_INSERT_BATCH_SIZE = 5000
+
+ITEM_COPY_COLUMNS = ('source_id', 'row_index', 'raw_data', 'fingerprint',
+                     'status', 'processing_results', 'name', 'address',
+                     'country_code', 'created_at', 'updated_at')
+
+
+def _copy_facility_list_items(cursor, source, batch):
+    now = timezone.now()
+    buffer = io.StringIO()
+    # Quoting every value keeps empty strings from being read as NULL
+    writer = csv.writer(buffer, quoting=csv.QUOTE_ALL)
+    for row_index, raw_data, fingerprint in batch:
+        writer.writerow([source.id, row_index, raw_data, fingerprint,
+                         FacilityListItem.UPLOADED, '[]', '', '', '',
+                         now.isoformat(), now.isoformat()])
+    buffer.seek(0)
+    cursor.copy_expert(
+        'COPY {} ({}) FROM STDIN WITH (FORMAT csv)'.format(
+            FacilityListItem._meta.db_table, ', '.join(ITEM_COPY_COLUMNS)),
+        buffer)
+
+
+def insert_facility_list_items(source, rows,
+                               batch_size=ITEM_INSERT_BATCH_SIZE):
+    """
+    Create an UPLOADED `FacilityListItem`, with its fingerprint, for each row
+    of an uploaded file. Rows are consumed in batches of `batch_size`, so only
+    one batch is held in memory at a time. Batches are written with the
+    Postgres COPY command, or with `bulk_create` if the database does not
+    support it.
+
+    Arguments:
+    source -- The `Source` of the list to which the items belong.
+    rows -- An iterable of raw CSV lines in the order they appear in the file.
+    batch_size -- The maximum number of items written by each query.
+
+    Returns:
+    The number of items created.
+    """
+    header_mapping = get_header_mapping(source.facility_list.header)
+    rows = ((row_index, raw_data,
+             make_row_fingerprint(header_mapping, raw_data))
+            for row_index, raw_data in enumerate(rows))
+    count = 0
+    with connection.cursor() as cursor:
+        use_copy = (connection.vendor == 'postgresql'
+                    and hasattr(cursor, 'copy_expert'))
+        while True:
+            batch = list(islice(rows, batch_size))
+            if len(batch) == 0:
+                return count
+            if use_copy:
+                _copy_facility_list_items(cursor, source, batch)
+            else:
+                FacilityListItem.objects.bulk_create(
+                    [FacilityListItem(row_index=row_index,
+                                      raw_data=raw_data,
+                                      fingerprint=fingerprint,
+                                      source=source)
+                     for row_index, raw_data, fingerprint in batch])
+            count += len(batch)
+
+
+# The maximum number of rows written by each query issued by
+# `parse_facility_list_items` and `save_match_details_in_bulk`
+BULK_SAVE_BATCH_SIZE = 1000
 
 
 def parse_csv_line(line):
@@ -97,102 +221,459 @@ def get_country_code(country):
             'Could not find a country code for "{0}".'.format(country))
 
 
-def parse_facility_list_item(item):
-    started = str(datetime.utcnow())
-    if type(item) != FacilityListItem:
-        raise ValueError('Argument must be a FacilityListItem')
-    if item.status != FacilityListItem.UPLOADED:
-        raise ValueError('Items to be parsed must be in the UPLOADED status')
+def get_csv_column_indexes(header):
+    """
+    Map each lower case column name in a CSV header line to the index of its
+    first occurrence.
+    """
+    columns = {}
+    for index, field in enumerate(parse_csv_line(header)):
+        columns.setdefault(field.lower(), index)
+    return columns
+
+
+# The columns read by `apply_parsed_values`. Rows with the same raw data parse
+# to the same values if these columns are in the same positions.
+FINGERPRINT_COLUMNS = (CsvHeaderField.COUNTRY, CsvHeaderField.NAME,
+                       CsvHeaderField.ADDRESS, CsvHeaderField.LAT,
+                       CsvHeaderField.LNG, CsvHeaderField.PPE_PRODUCT_TYPES,
+                       CsvHeaderField.PPE_CONTACT_PHONE,
+                       CsvHeaderField.PPE_CONTACT_EMAIL,
+                       CsvHeaderField.PPE_WEBSITE)
+
+
+def get_header_mapping(header):
+    """
+    Describe the positions of the parsed columns in a list header.
+
+    Returns:
+    A string that is equal for two headers if their rows are parsed the same
+    way.
+    """
+    columns = get_csv_column_indexes(header)
+    return json.dumps([columns.get(field) for field in FINGERPRINT_COLUMNS])
+
+
+def make_row_fingerprint(header_mapping, raw_data):
+    """
+    Returns:
+    The value of `FacilityListItem.fingerprint` for a row of a list whose
+    header has the mapping returned by `get_header_mapping`.
+    """
+    return hashlib.md5('{}\n{}'.format(header_mapping, raw_data)
+                       .encode('utf-8')).hexdigest()
+
+
+# Fields that are not validated when an item is parsed
+PARSE_EXCLUDED_FIELDS = ('processing_started_at', 'processing_completed_at',
+                         'legacy_processing_results', 'geocoded_point',
+                         'facility')
+
+# Fields that may be changed when an item is parsed
+PARSED_FIELDS = ['country_code', 'name', 'address', 'geocoded_point',
+                 'geocoded_address', 'ppe_product_types', 'ppe_contact_phone',
+                 'ppe_contact_email', 'ppe_website', 'status',
+                 'clean_name', 'clean_address', 'updated_at']
+
+
+def apply_parsed_values(item, columns, started,
+                        lookup_country_code=get_country_code,
+                        excluded_fields=PARSE_EXCLUDED_FIELDS):
+    """
+    Set the fields of an item from its `raw_data`, validate them and record
+    the outcome in its `processing_results`.
+
+    Arguments:
+    item -- A `FacilityListItem`.
+    columns -- The column indexes returned by `get_csv_column_indexes` for the
+               header of the item's list.
+    started -- The time at which parsing started.
+    lookup_country_code -- The function used to convert the country column
+                           to a country code.
+    excluded_fields -- Fields that are not validated.
+    """
+    is_geocoded = False
+    values = parse_csv_line(item.raw_data)
+    if CsvHeaderField.COUNTRY in columns:
+        item.country_code = lookup_country_code(
+            values[columns[CsvHeaderField.COUNTRY]])
+    if CsvHeaderField.NAME in columns:
+        item.name = values[columns[CsvHeaderField.NAME]]
+    if CsvHeaderField.ADDRESS in columns:
+        item.address = values[columns[CsvHeaderField.ADDRESS]]
+    if CsvHeaderField.LAT in columns and CsvHeaderField.LNG in columns:
+        lat = float(values[columns[CsvHeaderField.LAT]])
+        lng = float(values[columns[CsvHeaderField.LNG]])
+        item.geocoded_point = Point(lng, lat)
+        is_geocoded = True
+
+    if CsvHeaderField.PPE_PRODUCT_TYPES in columns:
+        product_types = values[columns[CsvHeaderField.PPE_PRODUCT_TYPES]]
+        # The nested list comprehension ensures that we filter out
+        # whitespace-only values
+        item.ppe_product_types = \
+            [s for s in [s.strip() for s in product_types.split('|')] if s]
+    if CsvHeaderField.PPE_CONTACT_PHONE in columns:
+        item.ppe_contact_phone = values[
+            columns[CsvHeaderField.PPE_CONTACT_PHONE]]
+    if CsvHeaderField.PPE_CONTACT_EMAIL in columns:
+        item.ppe_contact_email = values[
+            columns[CsvHeaderField.PPE_CONTACT_EMAIL]]
+    if CsvHeaderField.PPE_WEBSITE in columns:
+        item.ppe_website = values[columns[CsvHeaderField.PPE_WEBSITE]]
+
     try:
-        is_geocoded = False
-        fields = [f.lower()
-                  for f in parse_csv_line(item.source.facility_list.header)]
-        values = parse_csv_line(item.raw_data)
-        if CsvHeaderField.COUNTRY in fields:
-            item.country_code = get_country_code(
-                values[fields.index(CsvHeaderField.COUNTRY)])
-        if CsvHeaderField.NAME in fields:
-            item.name = values[fields.index(CsvHeaderField.NAME)]
-        if CsvHeaderField.ADDRESS in fields:
-            item.address = values[fields.index(CsvHeaderField.ADDRESS)]
-        if CsvHeaderField.LAT in fields and CsvHeaderField.LNG in fields:
-            lat = float(values[fields.index(CsvHeaderField.LAT)])
-            lng = float(values[fields.index(CsvHeaderField.LNG)])
-            item.geocoded_point = Point(lng, lat)
-            is_geocoded = True
-
-        if CsvHeaderField.PPE_PRODUCT_TYPES in fields:
-            product_types = values[
-                fields.index(CsvHeaderField.PPE_PRODUCT_TYPES)]
-            # The nested list comprehension ensures that we filter out
-            # whitespace-only values
-            item.ppe_product_types = \
-                [s for s in [s.strip() for s in product_types.split('|')] if s]
-        if CsvHeaderField.PPE_CONTACT_PHONE in fields:
-            item.ppe_contact_phone = values[
-                fields.index(CsvHeaderField.PPE_CONTACT_PHONE)]
-        if CsvHeaderField.PPE_CONTACT_EMAIL in fields:
-            item.ppe_contact_email = values[
-                fields.index(CsvHeaderField.PPE_CONTACT_EMAIL)]
-        if CsvHeaderField.PPE_WEBSITE in fields:
-            item.ppe_website = values[
-                fields.index(CsvHeaderField.PPE_WEBSITE)]
-
-        try:
-            item.full_clean(exclude=('processing_started_at',
-                                     'processing_completed_at',
-                                     'processing_results', 'geocoded_point',
-                                     'facility'))
-            item.status = FacilityListItem.PARSED
-            item.processing_results.append({
-                'action': ProcessingAction.PARSE,
-                'started_at': started,
-                'error': False,
-                'finished_at': str(datetime.utcnow()),
-                'is_geocoded': is_geocoded,
-            })
-        except ValidationError as ve:
-            messages = []
-            for name, errors in ve.error_dict.items():
-                # We need to clear the invalid value so we can save the row
-                setattr(item, name, '')
-                error_str = ''.join(''.join(e.messages) for e in errors)
-                messages.append(
-                    'There is a problem with the {0}: {1}'.format(name,
-                                                                  error_str)
-                )
+        item.full_clean(exclude=excluded_fields)
+        item.status = FacilityListItem.PARSED
+        item.processing_results.append({
+            'action': ProcessingAction.PARSE,
+            'started_at': started,
+            'error': False,
+            'finished_at': str(datetime.utcnow()),
+            'is_geocoded': is_geocoded,
+        })
+    except ValidationError as ve:
+        messages = []
+        for name, errors in ve.error_dict.items():
+            # We need to clear the invalid value so we can save the row
+            setattr(item, name, '')
+            error_str = ''.join(''.join(e.messages) for e in errors)
+            messages.append(
+                'There is a problem with the {0}: {1}'.format(name,
+                                                              error_str)
+            )
 
-            # If there is a validation error on the `ppe_product_types` array
-            # field, `full_clean` appears to set it to an empty string which
-            # then causes `save` to raise an exception.
-            ppe_product_types_is_valid = (
-                item.ppe_product_types is None
-                or isinstance(item.ppe_product_types, list))
-            if not ppe_product_types_is_valid:
-                item.ppe_product_types = []
+        # If there is a validation error on the `ppe_product_types` array
+        # field, `full_clean` appears to set it to an empty string which
+        # then causes `save` to raise an exception.
+        ppe_product_types_is_valid = (
+            item.ppe_product_types is None
+            or isinstance(item.ppe_product_types, list))
+        if not ppe_product_types_is_valid:
+            item.ppe_product_types = []
 
-            item.status = FacilityListItem.ERROR_PARSING
-            item.processing_results.append({
-                'action': ProcessingAction.PARSE,
-                'started_at': started,
-                'error': True,
-                'message': '\n'.join(messages),
-                'trace': traceback.format_exc(),
-                'finished_at': str(datetime.utcnow()),
-            })
-    except Exception as e:
         item.status = FacilityListItem.ERROR_PARSING
         item.processing_results.append({
             'action': ProcessingAction.PARSE,
             'started_at': started,
             'error': True,
-            'message': str(e),
+            'message': '\n'.join(messages),
             'trace': traceback.format_exc(),
             'finished_at': str(datetime.utcnow()),
         })
 
 
-def geocode_facility_list_item(item):
+def record_parse_error(item, started, error):
+    item.status = FacilityListItem.ERROR_PARSING
+    item.processing_results.append({
+        'action': ProcessingAction.PARSE,
+        'started_at': started,
+        'error': True,
+        'message': str(error),
+        'trace': traceback.format_exc(),
+        'finished_at': str(datetime.utcnow()),
+    })
+
+
+def parse_facility_list_item(item):
+    started = str(datetime.utcnow())
+    if type(item) != FacilityListItem:
+        raise ValueError('Argument must be a FacilityListItem')
+    if item.status != FacilityListItem.UPLOADED:
+        raise ValueError('Items to be parsed must be in the UPLOADED status')
+    try:
+        columns = get_csv_column_indexes(item.source.facility_list.header)
+        apply_parsed_values(item, columns, started)
+    except Exception as e:
+        record_parse_error(item, started, e)
+
+
+# The match status given to the facility association reused from an item of
+# a replaced list, by the status of that item
+REUSED_MATCH_STATUSES = {
+    FacilityListItem.MATCHED: FacilityMatch.AUTOMATIC,
+    FacilityListItem.CONFIRMED_MATCH: FacilityMatch.CONFIRMED,
+}
+
+# Items of a replaced list in these statuses have been parsed and geocoded
+# successfully
+REUSABLE_STATUSES = (FacilityListItem.GEOCODED,
+                     FacilityListItem.GEOCODED_NO_RESULTS,
+                     FacilityListItem.POTENTIAL_MATCH,
+                     FacilityListItem.ERROR_MATCHING) \
+    + tuple(REUSED_MATCH_STATUSES.keys())
+
+# The fields copied from an item of a replaced list
+REUSED_FIELDS = ('country_code', 'name', 'address', 'geocoded_point',
+                 'geocoded_address', 'ppe_product_types', 'ppe_contact_phone',
+                 'ppe_contact_email', 'ppe_website')
+
+
+def find_reusable_items(facility_list, header_mapping, items):
+    """
+    Find the items of the list replaced by `facility_list` that have the same
+    fingerprint as each of `items` and whose parse and geocode results can be
+    reused. Items of the replaced list that were added before fingerprints
+    were recorded are compared by their raw data if the two lists have the
+    same header mapping.
+
+    Arguments:
+    facility_list -- The replacing `FacilityList`.
+    header_mapping -- The `get_header_mapping` value for its header.
+    items -- A list of UPLOADED `FacilityListItem` objects from the list.
+
+    Returns:
+    A dict of (item, active match) tuples keyed by the ID of the item they
+    can be reused for. The match is the `FacilityMatch` associating the item
+    of the replaced list with its facility, or None if the association cannot
+    be reused.
+    """
+    replaced = facility_list.replaces
+    if replaced is None or len(items) == 0:
+        return {}
+
+    replaced_mapping = get_header_mapping(replaced.header)
+    fingerprints = {
+        item.id: item.fingerprint or make_row_fingerprint(header_mapping,
+                                                          item.raw_data)
+        for item in items}
+    query = Q(fingerprint__in=set(fingerprints.values()))
+    if replaced_mapping == header_mapping:
+        query |= Q(fingerprint__isnull=True,
+                   raw_data__in=set(item.raw_data for item in items))
+
+    # When a fingerprint occurs more than once, prefer the replaced item in
+    # the same row, and otherwise the first one
+    candidates = {}
+    for candidate in (FacilityListItem.objects
+                      .filter(query,
+                              source__facility_list=replaced,
+                              status__in=REUSABLE_STATUSES)
+                      .order_by('-row_index')):
+        fingerprint = candidate.fingerprint or make_row_fingerprint(
+            replaced_mapping, candidate.raw_data)
+        candidates.setdefault(fingerprint, {})[candidate.row_index] = \
+            candidate
+        candidates[fingerprint][None] = candidate
+
+    reusable = {}
+    for item in items:
+        rows = candidates.get(fingerprints[item.id])
+        if rows is not None:
+            reusable[item.id] = rows.get(item.row_index, rows[None])
+    load_processing_results(list(reusable.values()))
+
+    matches = {
+        match.facility_list_item_id: match for match in
+        FacilityMatch.objects.filter(
+            facility_list_item__in=[
+                candidate for candidate in reusable.values()
+                if candidate.status in REUSED_MATCH_STATUSES
+                and candidate.facility_id is not None],
+            facility_id=F('facility_list_item__facility_id'),
+            is_active=True).exclude(
+                status__in=(FacilityMatch.PENDING, FacilityMatch.REJECTED))
+    }
+    return {item_id: (candidate, matches.get(candidate.id))
+            for item_id, candidate in reusable.items()}
+
+
+def reuse_item_results(item, replaced_item, match, started):
+    """
+    Copy the parsed and geocoded values of an item of a replaced list to an
+    item of the replacing list, and its facility if it has an active
+    automatic or confirmed `FacilityMatch`. Items that reuse a facility are
+    complete, and the others are ready to be matched.
+
+    Returns:
+    An unsaved `FacilityMatch` for the reused facility, or None.
+    """
+    for field in REUSED_FIELDS:
+        setattr(item, field, copy.copy(getattr(replaced_item, field)))
+    for result in replaced_item.processing_results:
+        if result.get('action') in (ProcessingAction.PARSE,
+                                    ProcessingAction.GEOCODE) \
+           and not result.get('error'):
+            item.processing_results.append(
+                dict(result, reused_from_item_id=replaced_item.id))
+
+    if match is None:
+        if item.geocoded_point is None:
+            item.status = FacilityListItem.GEOCODED_NO_RESULTS
+        else:
+            item.status = FacilityListItem.GEOCODED
+        return None
+
+    item.status = replaced_item.status
+    item.facility_id = replaced_item.facility_id
+    item.processing_results.append({
+        'action': ProcessingAction.MATCH,
+        'started_at': started,
+        'error': False,
+        'reused_from_item_id': replaced_item.id,
+        'finished_at': str(datetime.utcnow()),
+    })
+    return FacilityMatch(
+        facility_list_item=item,
+        facility_id=replaced_item.facility_id,
+        confidence=match.confidence,
+        status=REUSED_MATCH_STATUSES[replaced_item.status],
+        results=dict(match.results, reused_from_item_id=replaced_item.id))
+
+
+def save_reused_matches(matches, batch_size=BULK_SAVE_BATCH_SIZE):
+    """
+    Insert the matches returned by `reuse_item_results`, copying PPE values
+    to the matched facilities as `save_match_details_in_bulk` does, and
+    update the facility index.
+    """
+    if len(matches) == 0:
+        return
+    bulk_create_with_history(FacilityMatch, matches, batch_size=batch_size)
+
+    facilities = Facility.objects.in_bulk(
+        set(m.facility_id for m in matches))
+    facilities_to_update = {}
+    facility_history_records = []
+    for m in matches:
+        facility = facilities[m.facility_id]
+        if copy_ppe_to_matched_facility(m.facility_list_item, facility):
+            facility.updated_at = timezone.now()
+            facilities_to_update[facility.id] = facility
+    for facility in facilities_to_update.values():
+        facility_history_records.append(
+            make_history_record(facility, '~', facility.updated_at))
+    if len(facilities_to_update) > 0:
+        Facility.objects.bulk_update(
+            facilities_to_update.values(),
+            ['ppe_product_types', 'ppe_contact_phone', 'ppe_contact_email',
+             'ppe_website', 'updated_at'],
+            batch_size=batch_size)
+        get_history_model_for_model(Facility).objects.bulk_create(
+            facility_history_records, batch_size=batch_size)
+
+    update_facility_index(list(facilities.keys()))
+
+
+def parse_facility_list_items(facility_list, items,
+                              batch_size=BULK_SAVE_BATCH_SIZE):
+    """
+    Parse items from a list with the same outcome as calling
+    `parse_facility_list_item` on each item and saving it, but in a single
+    pass over the items. The list header is only parsed once, country codes
+    are looked up once per distinct value, the source shared by the items is
+    not validated again for every item, and the items are saved with one
+    query per batch.
+
+    If the list replaces another list, items with the same fingerprint as an
+    item of the replaced list reuse its parsed and geocoded values, and its
+    facility if it was matched automatically or confirmed, rather than being
+    parsed. See `reuse_item_results`.
+
+    Arguments:
+    facility_list -- The `FacilityList` to which the items belong.
+    items -- An iterable of `FacilityListItem` objects. Querysets are read
+             in chunks of `batch_size` rows rather than all at once.
+    batch_size -- The maximum number of items written by each query.
+
+    Returns:
+    A dict with the number of 'success' and 'failure' items, the number of
+    items that 'reused' the results of the replaced list and, of those, the
+    number of 'reused_matches', and a list of 'errors' messages for items
+    that could not be parsed at all.
+    """
+    result = {
+        'success': 0,
+        'failure': 0,
+        'reused': 0,
+        'reused_matches': 0,
+        'errors': [],
+    }
+
+    try:
+        columns = get_csv_column_indexes(facility_list.header)
+        header_error = None
+    except Exception as e:
+        columns = None
+        header_error = e
+
+    country_codes = {}
+
+    def lookup_country_code(country):
+        # Errors are not memoized, so a row with an unknown country gets the
+        # same error as when it is parsed on its own
+        if country not in country_codes:
+            country_codes[country] = get_country_code(country)
+        return country_codes[country]
+
+    excluded_fields = PARSE_EXCLUDED_FIELDS + ('source',)
+
+    header_mapping = None
+    if facility_list.replaces_id is not None and header_error is None:
+        header_mapping = get_header_mapping(facility_list.header)
+
+    if isinstance(items, QuerySet):
+        items = items.iterator(chunk_size=batch_size)
+    items = iter(items)
+
+    for batch in iter(lambda: list(islice(items, batch_size)), []):
+        uploaded = []
+        for item in batch:
+            if item.status == FacilityListItem.UPLOADED:
+                uploaded.append(item)
+            else:
+                result['errors'].append(
+                    'Items to be parsed must be in the UPLOADED status')
+                result['failure'] += 1
+
+        load_processing_results(uploaded)
+        reusable = {}
+        if header_mapping is not None:
+            reusable = find_reusable_items(facility_list, header_mapping,
+                                           uploaded)
+
+        reused_matches = []
+        for item in uploaded:
+            started = str(datetime.utcnow())
+            if item.id in reusable:
+                replaced_item, match = reusable[item.id]
+                reused_match = reuse_item_results(item, replaced_item, match,
+                                                  started)
+                result['reused'] += 1
+                if reused_match is not None:
+                    result['reused_matches'] += 1
+                    if facility_list.source.create:
+                        reused_matches.append(reused_match)
+            else:
+                try:
+                    if header_error is not None:
+                        raise header_error
+                    apply_parsed_values(
+                        item, columns, started,
+                        lookup_country_code=lookup_country_code,
+                        excluded_fields=excluded_fields)
+                except Exception as e:
+                    record_parse_error(item, started, e)
+
+            if item.status in FacilityListItem.ERROR_STATUSES:
+                result['failure'] += 1
+            else:
+                result['success'] += 1
+
+        now = timezone.now()
+        for item in uploaded:
+            item.set_clean_fields()
+            item.updated_at = now
+        with transaction.atomic():
+            FacilityListItem.objects.bulk_update(
+                uploaded, PARSED_FIELDS + ['facility'])
+            save_processing_events(uploaded)
+            save_reused_matches(reused_matches, batch_size=batch_size)
+
+    return result
+
+
+def geocode_facility_list_item(item, geocode=geocode_address):
     started = str(datetime.utcnow())
     if type(item) != FacilityListItem:
         raise ValueError('Argument must be a FacilityListItem')
@@ -200,7 +681,7 @@ def geocode_facility_list_item(item):
         raise ValueError('Items to be geocoded must be in the PARSED status')
     try:
         if item.geocoded_point is None:
-            data = geocode_address(item.address, item.country_code)
+            data = geocode(item.address, item.country_code)
             if data['result_count'] > 0:
                 item.status = FacilityListItem.GEOCODED
                 item.geocoded_point = Point(
@@ -288,8 +769,129 @@ def is_string_match(item, facility):
     True if the item is a string match to the facility
     """
     return (item.country_code == facility.country_code
-            and clean(item.name) == clean(facility.name)
-            and clean(item.address) == clean(facility.address))
+            and item.get_clean_value('name')
+            == facility.get_clean_value('name')
+            and item.get_clean_value('address')
+            == facility.get_clean_value('address'))
+
+
+def make_pending_match(item_id, facility_id, score, results):
+    return FacilityMatch(
+        facility_list_item_id=item_id,
+        facility_id=facility_id,
+        confidence=score,
+        status=FacilityMatch.PENDING,
+        results=results)
+
+
+def assign_automatic_match(item, matches, automatic_threshold):
+    """
+    Update the status of an item that has at least one gazetteer match, and
+    promote one of the matches to AUTOMATIC if it is clearly the best one.
+
+    Arguments:
+    item -- The `FacilityListItem` that was matched.
+    matches -- A list of unsaved, PENDING `FacilityMatch` instances for the
+               item, one per facility.
+    automatic_threshold -- The confidence above which a match may be made
+                           automatically.
+    """
+    item.status = FacilityListItem.POTENTIAL_MATCH
+    if len(matches) == 1:
+        if matches[0].confidence >= automatic_threshold:
+            matches[0].status = FacilityMatch.AUTOMATIC
+            matches[0].results['match_type'] = 'single_gazetteer_match'
+            item.status = FacilityListItem.MATCHED
+            item.facility = matches[0].facility
+    else:
+        quality_matches = [m for m in matches
+                           if m.confidence > automatic_threshold]
+        if len(quality_matches) == 1:
+            matches[0].status = FacilityMatch.AUTOMATIC
+            matches[0].results['match_type'] = \
+                'one_gazetteer_match_greater_than_threshold'
+            item.status = FacilityListItem.MATCHED
+            item.facility = matches[0].facility
+        elif len(quality_matches) > 1:
+            exact_matches = [m for m in quality_matches
+                             if is_string_match(item, m.facility)]
+            # We check == 1 because multiple exact matches should not
+            # happen. They are an indication of duplicate facility data
+            # that should be merged through moderation tools. Showing the
+            # multiple potential matches to the contributor increases the
+            # visibility of the issue.
+            if len(exact_matches) == 1:
+                exact_matches[0].status = FacilityMatch.AUTOMATIC
+                exact_matches[0].results['match_type'] = \
+                    'multiple_gazetteer_matches_with_one_exact_string_match' # NOQA
+                item.status = FacilityListItem.MATCHED
+                item.facility = exact_matches[0].facility
+
+
+def copy_ppe_to_matched_facility(item, facility):
+    """
+    Fill in any empty PPE fields on a facility from the values on an item
+    that was automatically matched to it.
+
+    Returns:
+    True if the facility was changed and needs to be saved.
+    """
+    should_update_ppe_product_types = (
+        item.has_ppe_product_types
+        and not facility.has_ppe_product_types)
+    if should_update_ppe_product_types:
+        facility.ppe_product_types = item.ppe_product_types
+
+    should_update_ppe_contact_phone = (
+        item.has_ppe_contact_phone
+        and not facility.has_ppe_contact_phone)
+    if should_update_ppe_contact_phone:
+        facility.ppe_contact_phone = item.ppe_contact_phone
+
+    should_update_ppe_contact_email = (
+        item.has_ppe_contact_email
+        and not facility.has_ppe_contact_email)
+    if should_update_ppe_contact_email:
+        facility.ppe_contact_email = item.ppe_contact_email
+
+    should_update_ppe_website = (
+        item.has_ppe_website
+        and not facility.has_ppe_website)
+    if should_update_ppe_website:
+        facility.ppe_website = item.ppe_website
+
+    return (should_update_ppe_product_types
+            or should_update_ppe_contact_phone
+            or should_update_ppe_contact_email
+            or should_update_ppe_website)
+
+
+def make_text_only_matches(item, facilities, results):
+    text_only_results = copy.deepcopy(results)
+    text_only_results['text_only_match'] = True
+    return [
+        FacilityMatch(
+            facility_list_item_id=item.id,
+            facility_id=facility.id,
+            confidence=0,
+            status=FacilityMatch.PENDING,
+            results=text_only_results)
+        for facility in facilities]
+
+
+def make_facility_from_item(item):
+    facility = Facility(name=item.name,
+                        address=item.address,
+                        country_code=item.country_code,
+                        location=item.geocoded_point,
+                        created_from=item,
+                        ppe_product_types=item.ppe_product_types,
+                        ppe_contact_phone=item.ppe_contact_phone,
+                        ppe_contact_email=item.ppe_contact_email,
+                        ppe_website=item.ppe_website)
+    # Facilities are inserted with `bulk_create`, which does not call `save`
+    facility.set_clean_fields()
+    return facility
 
 
 def save_match_details(match_results, text_only_matches=None):
@@ -322,50 +924,13 @@ def save_match_details(match_results, text_only_matches=None):
 
     automatic_threshold = results['automatic_threshold']
 
-    def make_pending_match(item_id, facility_id, score):
-        return FacilityMatch(
-            facility_list_item_id=item_id,
-            facility_id=facility_id,
-            confidence=score,
-            status=FacilityMatch.PENDING,
-            results=results)
-
     all_matches = []
     for item_id, matches in item_matches.items():
         item = FacilityListItem.objects.get(id=item_id)
-        item.status = FacilityListItem.POTENTIAL_MATCH
-        matches = [make_pending_match(item_id, facility_id, score.item())
+        matches = [make_pending_match(item_id, facility_id, score.item(),
+                                      results)
                    for facility_id, score in reduce_matches(matches)]
-
-        if len(matches) == 1:
-            if matches[0].confidence >= automatic_threshold:
-                matches[0].status = FacilityMatch.AUTOMATIC
-                matches[0].results['match_type'] = 'single_gazetteer_match'
-                item.status = FacilityListItem.MATCHED
-                item.facility = matches[0].facility
-        else:
-            quality_matches = [m for m in matches
-                               if m.confidence > automatic_threshold]
-            if len(quality_matches) == 1:
-                matches[0].status = FacilityMatch.AUTOMATIC
-                matches[0].results['match_type'] = \
-                    'one_gazetteer_match_greater_than_threshold'
-                item.status = FacilityListItem.MATCHED
-                item.facility = matches[0].facility
-            elif len(quality_matches) > 1:
-                exact_matches = [m for m in quality_matches
-                                 if is_string_match(item, m.facility)]
-                # We check == 1 because multiple exact matches should not
-                # happen. They are an indication of duplicate facility data
-                # that should be merged through moderation tools. Showing the
-                # multiple potential matches to the contributor increases the
-                # visibility of the issue.
-                if len(exact_matches) == 1:
-                    exact_matches[0].status = FacilityMatch.AUTOMATIC
-                    exact_matches[0].results['match_type'] = \
-                        'multiple_gazetteer_matches_with_one_exact_string_match' # NOQA
-                    item.status = FacilityListItem.MATCHED
-                    item.facility = exact_matches[0].facility
+        assign_automatic_match(item, matches, automatic_threshold)
 
         item.processing_results.append({
             'action': ProcessingAction.MATCH,
@@ -379,36 +944,7 @@ def save_match_details(match_results, text_only_matches=None):
             for m in matches:
                 m.save()
                 if m.status == FacilityMatch.AUTOMATIC:
-                    should_update_ppe_product_types = (
-                        item.has_ppe_product_types
-                        and not m.facility.has_ppe_product_types)
-                    if should_update_ppe_product_types:
-                        m.facility.ppe_product_types = item.ppe_product_types
-
-                    should_update_ppe_contact_phone = (
-                        item.has_ppe_contact_phone
-                        and not m.facility.has_ppe_contact_phone)
-                    if should_update_ppe_contact_phone:
-                        m.facility.ppe_contact_phone = item.ppe_contact_phone
-
-                    should_update_ppe_contact_email = (
-                        item.has_ppe_contact_email
-                        and not m.facility.has_ppe_contact_email)
-                    if should_update_ppe_contact_email:
-                        m.facility.ppe_contact_email = item.ppe_contact_email
-
-                    should_update_ppe_website = (
-                        item.has_ppe_website
-                        and not m.facility.has_ppe_website)
-                    if should_update_ppe_website:
-                        m.facility.ppe_website = item.ppe_website
-
-                    should_save_facility = (
-                        should_update_ppe_product_types
-                        or should_update_ppe_contact_phone
-                        or should_update_ppe_contact_email
-                        or should_update_ppe_website)
-                    if should_save_facility:
+                    if copy_ppe_to_matched_facility(item, m.facility):
                         m.facility.save()
 
         all_matches.extend(matches)
@@ -421,16 +957,8 @@ def save_match_details(match_results, text_only_matches=None):
             item.id in text_only_matches
             and len(text_only_matches[item.id]) > 0)
         if has_text_only_matches:
-            text_only_results = copy.deepcopy(results)
-            text_only_results['text_only_match'] = True
-            text_only_match_objects = [
-                FacilityMatch(
-                    facility_list_item_id=item.id,
-                    facility_id=facility.id,
-                    confidence=0,
-                    status=FacilityMatch.PENDING,
-                    results=text_only_results)
-                for facility in text_only_matches[item.id]]
+            text_only_match_objects = make_text_only_matches(
+                item, text_only_matches[item.id], results)
             if item.source.create:
                 for m in text_only_match_objects:
                     m.save()
@@ -456,18 +984,10 @@ def save_match_details(match_results, text_only_matches=None):
             })
         else:
             if item.source.create:
-                facility = Facility(name=item.name,
-                                    address=item.address,
-                                    country_code=item.country_code,
-                                    location=item.geocoded_point,
-                                    created_from=item,
-                                    ppe_product_types=item.ppe_product_types,
-                                    ppe_contact_phone=item.ppe_contact_phone,
-                                    ppe_contact_email=item.ppe_contact_email,
-                                    ppe_website=item.ppe_website)
+                facility = make_facility_from_item(item)
                 facility.save()
 
-                match = make_pending_match(item.id, facility.id, 1.0)
+                match = make_pending_match(item.id, facility.id, 1.0, results)
                 match.results['match_type'] = 'no_gazetteer_match'
                 match.status = FacilityMatch.AUTOMATIC
                 match.save()
@@ -483,3 +1003,240 @@ def save_match_details(match_results, text_only_matches=None):
         item.save()
 
     return all_matches
+
+
+def assign_oar_ids(facilities):
+    """
+    Set a new, unused OAR ID on each of the specified unsaved facilities. This
+    does the same work as `Facility.save` but checks all of the candidate IDs
+    with a single query rather than one query per facility.
+    """
+    pending = list(facilities)
+    assigned_ids = set()
+    while len(pending) > 0:
+        candidates = {}
+        for facility in pending:
+            new_id = make_oar_id(facility.country_code)
+            if new_id not in assigned_ids and new_id not in candidates:
+                candidates[new_id] = facility
+        existing_ids = set(Facility
+                           .objects
+                           .filter(id__in=candidates.keys())
+                           .values_list('id', flat=True))
+        for new_id, facility in candidates.items():
+            if new_id not in existing_ids:
+                facility.id = new_id
+                assigned_ids.add(new_id)
+        pending = [f for f in pending if f.id == '']
+
+
+def make_history_record(instance, history_type, history_date):
+    """
+    Build, but do not save, the django-simple-history record that would be
+    written by `HistoricalRecords.post_save` if `instance` were saved.
+    """
+    history_model = get_history_model_for_model(type(instance))
+    return history_model(
+        history_date=history_date,
+        history_type=history_type,
+        history_user=getattr(instance, '_history_user', None),
+        history_change_reason=getattr(instance, 'changeReason', None),
+        **{field.attname: getattr(instance, field.attname)
+           for field in instance._meta.fields
+           if field.name not in history_model._history_excluded_fields})
+
+
+def bulk_create_with_history(model, objs, batch_size=BULK_SAVE_BATCH_SIZE):
+    """
+    Insert `objs` with `bulk_create` and write the same "created" history
+    records that saving each instance individually would have written.
+    Unlike `simple_history.utils.bulk_create_with_history`, the change reason
+    is left null to match the records written by `save`.
+    """
+    objs = model.objects.bulk_create(objs, batch_size=batch_size)
+    history_date = timezone.now()
+    history_records = [make_history_record(obj, '+', history_date)
+                       for obj in objs]
+    history_model = get_history_model_for_model(model)
+    history_model.objects.bulk_create(history_records, batch_size=batch_size)
+    return objs
+
+
+def save_match_details_in_bulk(match_results, text_only_matches=None,
+                               batch_size=BULK_SAVE_BATCH_SIZE):
+    """
+    Save the results of a call to match_facility_list_items with the same
+    outcome as `save_match_details`, but using a constant number of queries
+    per batch of rows rather than several queries per item.
+
+    Items and matched facilities are fetched up front, new facilities and
+    matches are inserted with `bulk_create` (new facilities are assigned OAR
+    IDs before they are inserted), and item status and processing results
+    are written with `bulk_update`. Because `bulk_create` and `bulk_update`
+    do not send `post_save`, the history records that saving each instance
+    would have written are created explicitly and the `FacilityIndex` is
+    updated with a single call to `update_facility_index` at the end.
+
+    Should be called in a transaction to ensure that all the updates are
+    applied atomically.
+
+    Arguments:
+    See `save_match_details`.
+    batch_size -- The maximum number of rows written by each query.
+
+    Returns:
+    The list of `FacilityMatch` objects created
+    """
+    if text_only_matches is None:
+        text_only_matches = {}
+    processed_list_item_ids = match_results['processed_list_item_ids']
+    item_matches = match_results['item_matches']
+    results = match_results['results']
+    started = match_results['started']
+    finished = match_results['finished']
+
+    automatic_threshold = results['automatic_threshold']
+
+    items = {
+        str(item.id): item for item in
+        FacilityListItem
+        .objects
+        .filter(id__in=processed_list_item_ids)
+        .select_related('source')
+        .order_by('id')
+    }
+    load_processing_results(items.values())
+
+    matched_facility_ids = {
+        normalize_extended_facility_id(facility_id)
+        for matches in item_matches.values()
+        for facility_id, _ in matches}
+    facilities = Facility.objects.in_bulk(matched_facility_ids)
+
+    all_matches = []
+    matches_to_create = []
+    facilities_to_update = {}
+    facility_history_records = []
+    new_facility_matches = []
+    indexed_facility_ids = set()
+
+    for item_id, matches in item_matches.items():
+        item = items[str(item_id)]
+        matches = [make_pending_match(item.id, facility_id, score.item(),
+                                      results)
+                   for facility_id, score in reduce_matches(matches)]
+        for m in matches:
+            m.facility = facilities[m.facility_id]
+        assign_automatic_match(item, matches, automatic_threshold)
+
+        item.processing_results.append({
+            'action': ProcessingAction.MATCH,
+            'started_at': started,
+            'error': False,
+            'finished_at': finished
+        })
+
+        # `save_match_details` serializes the shared `results` dictionary
+        # when each match is saved. Take a copy now so that the value written
+        # for these matches is not affected by later items.
+        for m in matches:
+            m.results = dict(m.results)
+
+        if item.source.create:
+            matches_to_create.extend(matches)
+            for m in matches:
+                indexed_facility_ids.add(m.facility_id)
+                if m.status == FacilityMatch.AUTOMATIC:
+                    if copy_ppe_to_matched_facility(item, m.facility):
+                        m.facility.updated_at = timezone.now()
+                        facilities_to_update[m.facility.id] = m.facility
+                        facility_history_records.append(
+                            make_history_record(m.facility, '~',
+                                                m.facility.updated_at))
+
+        all_matches.extend(matches)
+
+    for item_id, item in items.items():
+        if item_id in item_matches:
+            continue
+        has_text_only_matches = (
+            item.id in text_only_matches
+            and len(text_only_matches[item.id]) > 0)
+        if has_text_only_matches:
+            text_only_match_objects = make_text_only_matches(
+                item, text_only_matches[item.id], results)
+            if item.source.create:
+                matches_to_create.extend(text_only_match_objects)
+                indexed_facility_ids.update(
+                    m.facility_id for m in text_only_match_objects)
+            all_matches.extend(text_only_match_objects)
+
+            item.status = FacilityListItem.POTENTIAL_MATCH
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': False,
+                'text_only_match': True,
+                'finished_at': finished
+            })
+        elif item.status == FacilityListItem.GEOCODED_NO_RESULTS:
+            item.status = FacilityListItem.ERROR_MATCHING
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': True,
+                'message': ('No match to an existing facility and cannot '
+                            'create a new facility without a geocode result'),
+                'finished_at': finished
+            })
+        else:
+            if item.source.create:
+                facility = make_facility_from_item(item)
+                match = make_pending_match(item.id, None, 1.0, results)
+                match.results['match_type'] = 'no_gazetteer_match'
+                match.results = dict(match.results)
+                match.status = FacilityMatch.AUTOMATIC
+                new_facility_matches.append((item, facility, match))
+            item.status = FacilityListItem.MATCHED
+            item.processing_results.append({
+                'action': ProcessingAction.MATCH,
+                'started_at': started,
+                'error': False,
+                'finished_at': finished
+            })
+
+    new_facilities = [facility for (_, facility, _) in new_facility_matches]
+    assign_oar_ids(new_facilities)
+    bulk_create_with_history(Facility, new_facilities, batch_size=batch_size)
+    for item, facility, match in new_facility_matches:
+        match.facility = facility
+        item.facility = facility
+        matches_to_create.append(match)
+        indexed_facility_ids.add(facility.id)
+
+    bulk_create_with_history(FacilityMatch, matches_to_create,
+                             batch_size=batch_size)
+
+    if len(facilities_to_update) > 0:
+        Facility.objects.bulk_update(
+            facilities_to_update.values(),
+            ['ppe_product_types', 'ppe_contact_phone', 'ppe_contact_email',
+             'ppe_website', 'updated_at'],
+            batch_size=batch_size)
+        get_history_model_for_model(Facility).objects.bulk_create(
+            facility_history_records, batch_size=batch_size)
+        indexed_facility_ids.update(facilities_to_update.keys())
+
+    now = timezone.now()
+    for item in items.values():
+        item.updated_at = now
+    FacilityListItem.objects.bulk_update(
+        items.values(),
+        ['status', 'facility', 'updated_at'],
+        batch_size=batch_size)
+    save_processing_events(items.values())
+
+    if len(indexed_facility_ids) > 0:
+        update_facility_index(list(indexed_facility_ids))
+
+    return all_matches
@@ -9,7 +9,8 @@ from urllib.parse import quote
 
 from django.db import connection
 from django.db.models import Func, F
-from api.models import HistoricalFacility, FacilityListItem
+from api.models import (HistoricalFacility, FacilityListItem,
+                        ProcessingEvent)
 from api.constants import ProcessingAction, DateFormats
 
 _root = os.path.abspath(os.path.dirname(__file__))
@@ -44,30 +45,52 @@ def monthly_promoted_name_and_address():
             sort_by_first_column(data.items())]
 
 
-def geocoding_time_without_queue(date_format):
-    temp_data = dict()
-
-    start_date = datetime.now(tz=timezone.utc) - relativedelta(months=4)
-    processing_results = FacilityListItem.objects.filter(
+def get_geocode_results(start_date):
+    """
+    Returns:
+    A generator of (created_at, result) tuples with the geocode processing
+    results of the items created since `start_date`, read from both the
+    legacy results column and the processing events. Payloads are not loaded.
+    """
+    listitems = FacilityListItem.objects.filter(
         created_at__gte=start_date,
-        processing_results__contains=[{"action": "geocode"}]
+        legacy_processing_results__contains=[{"action": "geocode"}]
     ).annotate(pr_element=Func(
-        F('processing_results'),
+        F('legacy_processing_results'),
         function='jsonb_array_elements')
-    ).values_list('pr_element', flat=True)
-
-    for r in processing_results:
+    ).values_list('created_at', 'pr_element')
+    for (created_at, r) in listitems:
         if r['action'] == ProcessingAction.GEOCODE:
-            try:
-                started = try_parsing_date(r['started_at'])
-                finished = try_parsing_date(r['finished_at'])
-                date = started.strftime(date_format)
-                time = finished - started
-                counts = temp_data.get(date, (0, 0))
-                temp_data[date] = (counts[0] + 1,
-                                   counts[1] + time.total_seconds())
-            except ValueError:
-                pass
+            yield created_at, r
+
+    events = ProcessingEvent.objects.filter(
+        facility_list_item__created_at__gte=start_date,
+        action=ProcessingAction.GEOCODE
+    ).values_list('facility_list_item__created_at', 'started_at',
+                  'finished_at', 'error', 'data')
+    for (created_at, started_at, finished_at, error, data) in events:
+        event = ProcessingEvent(action=ProcessingAction.GEOCODE,
+                                started_at=started_at,
+                                finished_at=finished_at, error=error,
+                                data=data)
+        yield created_at, event.to_result(include_payload=False)
+
+
+def geocoding_time_without_queue(date_format):
+    temp_data = dict()
+
+    start_date = datetime.now(tz=timezone.utc) - relativedelta(months=4)
+    for (_, r) in get_geocode_results(start_date):
+        try:
+            started = try_parsing_date(r['started_at'])
+            finished = try_parsing_date(r['finished_at'])
+            date = started.strftime(date_format)
+            time = finished - started
+            counts = temp_data.get(date, (0, 0))
+            temp_data[date] = (counts[0] + 1,
+                               counts[1] + time.total_seconds())
+        except ValueError:
+            pass
     data = dict()
     for d, c in temp_data.items():
         data[d] = c[1] / c[0]
@@ -87,23 +110,17 @@ def weekly_geocoding_time_without_queue():
 def geocoding_time_with_queue(date_format):
     temp_data = dict()
     start_date = datetime.now(tz=timezone.utc) - relativedelta(months=4)
-    listitems = FacilityListItem.objects.filter(
-        created_at__gte=start_date,
-        processing_results__contains=[{"action": "geocode"}]
-    ).order_by('-created_at').values_list('created_at', 'processing_results')
-    for (created_at, processing_results) in listitems:
-        for r in processing_results:
-            if r['action'] == ProcessingAction.GEOCODE:
-                try:
-                    finished = try_parsing_date(r['finished_at']).replace(
-                        tzinfo=pytz.UTC)
-                    date = created_at.strftime(date_format)
-                    time = finished - created_at
-                    counts = temp_data.get(date, (0, 0))
-                    temp_data[date] = (counts[0] + 1,
-                                       counts[1] + time.total_seconds())
-                except ValueError:
-                    pass
+    for (created_at, r) in get_geocode_results(start_date):
+        try:
+            finished = try_parsing_date(r['finished_at']).replace(
+                tzinfo=pytz.UTC)
+            date = created_at.strftime(date_format)
+            time = finished - created_at
+            counts = temp_data.get(date, (0, 0))
+            temp_data[date] = (counts[0] + 1,
+                               counts[1] + time.total_seconds())
+        except ValueError:
+            pass
     data = dict()
     for d, c in temp_data.items():
         data[d] = c[1] / c[0]
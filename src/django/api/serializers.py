@@ -8,8 +8,9 @@ from django.db import transaction
 from django.contrib.auth.forms import PasswordResetForm
 from django.contrib.auth import password_validation
 from django.urls import reverse
-from django.db.models import Count
+from django.db.models import Count, Manager
 from rest_framework.serializers import (CharField,
+                                        ChoiceField,
                                         DecimalField,
                                         EmailField,
                                         IntegerField,
@@ -20,7 +21,8 @@ from rest_framework.serializers import (CharField,
                                         ValidationError,
                                         Serializer,
                                         URLField)
-from rest_framework_gis.serializers import GeoFeatureModelSerializer
+from rest_framework_gis.serializers import (GeoFeatureModelListSerializer,
+                                            GeoFeatureModelSerializer)
 from rest_auth.serializers import (PasswordResetSerializer,
                                    PasswordResetConfirmSerializer)
 from allauth.account.utils import setup_user_email
@@ -42,6 +44,7 @@ from api.models import (FacilityList,
                         EmbedConfig,
                         EmbedField,
                         NonstandardField)
+from api.constants import FacilitiesSortBy
 from api.countries import COUNTRY_NAMES, COUNTRY_CHOICES
 from api.processing import get_country_code
 from api.helpers import prefix_a_an
@@ -58,6 +61,12 @@ def _get_parent_company(claim):
     }
 
 
+def get_serializer_user(serializer):
+    request = serializer.context.get('request') \
+        if serializer.context is not None else None
+    return request.user if request is not None else None
+
+
 def is_embed_mode_active(serializer):
     request = serializer.context.get('request') \
         if serializer.context is not None else None
@@ -444,6 +453,9 @@ class FacilityQueryParamsSerializer(Serializer):
     pageSize = IntegerField(required=False)
     boundary = CharField(required=False)
     ppe = BooleanField(default=False, required=False)
+    sort_by = ChoiceField(
+        choices=[FacilitiesSortBy.NAME, FacilitiesSortBy.RELEVANCE],
+        required=False)
 
 
 class FacilityListQueryParamsSerializer(Serializer):
@@ -468,11 +480,32 @@ class FacilityListItemsQueryParamsSerializer(Serializer):
                         item, ', '.join(valid_statuses)))
 
 
+class FacilityFeatureListSerializer(GeoFeatureModelListSerializer):
+    """
+    Loads the contributors of every facility in the list with a fixed number
+    of queries, rather than several queries per facility, before serializing
+    the facilities.
+    """
+    def to_representation(self, data):
+        facilities = list(data.all() if isinstance(data, Manager) else data)
+        if is_embed_mode_active(self.child):
+            self.child.sources_by_facility = None
+        else:
+            self.child.sources_by_facility = Facility.sources_by_facility(
+                [facility.id for facility in facilities],
+                user=get_serializer_user(self.child))
+        return super(FacilityFeatureListSerializer, self) \
+            .to_representation(facilities)
+
+
 class FacilitySerializer(GeoFeatureModelSerializer):
     oar_id = SerializerMethodField()
     country_name = SerializerMethodField()
     contributors = SerializerMethodField()
 
+    # Set by `FacilityFeatureListSerializer` to a dict of sources by ID
+    sources_by_facility = None
+
     class Meta:
         model = Facility
         fields = ('id', 'name', 'address', 'country_code', 'location',
@@ -480,6 +513,7 @@ class FacilitySerializer(GeoFeatureModelSerializer):
                   'ppe_product_types', 'ppe_contact_phone',
                   'ppe_contact_email', 'ppe_website', 'is_closed')
         geo_field = 'location'
+        list_serializer_class = FacilityFeatureListSerializer
 
     # Added to ensure including the OAR ID in the geojson properties map
     def get_oar_id(self, facility):
@@ -504,13 +538,14 @@ class FacilitySerializer(GeoFeatureModelSerializer):
             return {
                 'name': source,
             }
-        request = self.context.get('request') \
-            if self.context is not None else None
-        user = request.user if request is not None else None
+        if self.sources_by_facility is not None \
+                and facility.id in self.sources_by_facility:
+            sources = self.sources_by_facility[facility.id]
+        else:
+            sources = facility.sources(user=get_serializer_user(self))
         distinct_names = []
         distinct_sources = []
-        formatted_sources = [
-            format_source(source) for source in facility.sources(user=user)]
+        formatted_sources = [format_source(source) for source in sources]
         for formatted_source in formatted_sources:
             if formatted_source['name'] not in distinct_names:
                 distinct_names.append(formatted_source['name'])
@@ -1051,7 +1086,8 @@ class FacilityListItemSerializer(ModelSerializer):
     class Meta:
         model = FacilityListItem
         exclude = ('created_at', 'updated_at', 'geocoded_point',
-                   'geocoded_address', 'processing_results', 'facility')
+                   'geocoded_address', 'legacy_processing_results', 'facility',
+                   'clean_name', 'clean_address')
 
     def get_matches(self, facility_list_item):
         return FacilityMatchSerializer(
@@ -1,14 +1,25 @@
+import copy
+import dedupe
 import json
 import numpy as np
 import os
+import psycopg2
+import tempfile
+import threading
+import time
 import xlrd
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from io import StringIO
+from unittest import mock
 from dateutil.relativedelta import relativedelta
 
 from django.core import mail
+from django.core.management import call_command
+from django.db import connection, transaction
 from django.core.files.uploadedfile import SimpleUploadedFile
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 from django.contrib import auth
 from django.conf import settings
@@ -32,23 +43,75 @@ from api.models import (Facility, FacilityList, FacilityListItem,
                         RequestLog, DownloadLog, FacilityLocation, Source,
                         ApiLimit, ApiBlock, ContributorNotifications,
                         EmbedConfig, EmbedField, NonstandardField,
-                        FacilityActivityReport)
+                        FacilityActivityReport, FacilityIndex,
+                        FacilityIndexQueue, TileCacheEntry, Version,
+                        FacilityGridCell, FacilityGridCount,
+                        GeocodingCacheEntry, ProcessingEvent,
+                        ProcessingPayload, get_oar_id_prefix,
+                        mark_facility_grid_cells_dirty,
+                        record_list_processing_result)
 from api.oar_id import make_oar_id, validate_oar_id
-from api.matching import match_facility_list_items, GazetteerCache
+from api.xlsx import iter_xlsx_rows
+from api.gazetteer_shards import SHARED_SHARD, ShardedGazetteer
+from api.helpers import clean
+from api.matching import (match_facility_list_items,
+                          match_items,
+                          group_duplicate_items,
+                          GazetteerCache,
+                          GAZETTEER_COMPACTION_LOCK_ID,
+                          get_canonical_items,
+                          get_messy_items_for_training,
+                          get_messy_items_from_facility_list,
+                          filter_matches_to_existing_facilities,
+                          write_gazetteer_snapshot,
+                          get_gazetteer_matches,
+                          GazetteerCacheTimeoutError,
+                          NoCanonicalRecordsError)
+from api.matcher_service import (MatcherAction,
+                                 MatcherError,
+                                 MatcherServer,
+                                 MatcherServiceError,
+                                 request_matches)
 from api.processing import (parse_facility_list_item,
+                            parse_facility_list_items,
+                            insert_facility_list_items,
+                            get_header_mapping,
+                            make_row_fingerprint,
                             geocode_facility_list_item,
                             reduce_matches, is_string_match,
-                            save_match_details)
-from api.geocoding import (create_geocoding_params,
+                            save_match_details,
+                            save_match_details_in_bulk)
+from api.concurrent_geocoding import (TokenBucket,
+                                      geocode_list_items,
+                                      request_geocoding_with_retries)
+from api.geocoding import (GeocodingRequestError,
+                           create_geocoding_params,
+                           evict_geocoding_cache,
                            format_geocoded_address_data,
-                           geocode_address)
+                           geocode_address,
+                           get_geocoding_cache_summary,
+                           get_geocoding_response,
+                           make_memoized_geocoder)
 from api.test_data import parsed_city_hall_data
 from api.permissions import referring_host_is_allowed, referring_host
 from api.serializers import (ApprovedFacilityClaimSerializer,
                              FacilityCreateBodySerializer,
-                             FacilityListSerializer)
+                             FacilityListSerializer,
+                             FacilitySerializer)
 from api.limits import check_api_limits, get_end_of_year
 from api.close_list import close_list
+from api.aws_batch import get_array_chunk_size
+from api.pipeline import exclude_matches_to_list, parse_and_geocode_items
+from api.tile_cache import delete_stale_tiles, evict_tiles, flush_tile_hits
+from api.facility_grid import (build_facility_grid,
+                               get_facility_grid_filter,
+                               get_precomputed_facility_grid_vector_tile,
+                               refresh_facility_grid)
+from api.facility_index import (get_index_definitions,
+                                rebuild_facility_index)
+from api.management.commands.process_facility_index_queue import \
+    process_queue_batch
+from oar.settings import getenv_bool
 
 
 class FacilityListCreateTest(APITestCase):
@@ -557,6 +620,197 @@ class GeocodingTest(TestCase):
         )
 
 
+class GeocodingCacheTest(TestCase):
+    def setUp(self):
+        self.data = parsed_city_hall_data['full_response']
+        patcher = mock.patch('api.geocoding.requests.get')
+        self.mock_get = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.mock_get.return_value.status_code = 200
+        self.mock_get.return_value.json.return_value = self.data
+
+    def test_repeated_address_is_not_requested_again(self):
+        first = geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        second = geocode_address('  1400 jfk blvd,   Philadelphia ', 'us')
+        self.assertEqual(first, second)
+        self.assertEqual(1, self.mock_get.call_count)
+        entry = GeocodingCacheEntry.objects.get()
+        self.assertEqual('1400 jfk blvd, philadelphia', entry.address)
+        self.assertEqual(1, entry.hits)
+
+    def test_different_country_is_requested(self):
+        get_geocoding_response('1400 JFK Blvd, Philadelphia', 'US')
+        get_geocoding_response('1400 JFK Blvd, Philadelphia', 'CA')
+        self.assertEqual(2, self.mock_get.call_count)
+
+    def test_expired_entries_are_replaced(self):
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        GeocodingCacheEntry.objects.update(
+            created_at=timezone.now() - timedelta(
+                days=settings.GEOCODING_CACHE_TTL_IN_DAYS + 1))
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        self.assertEqual(2, self.mock_get.call_count)
+        self.assertEqual(1, GeocodingCacheEntry.objects.count())
+
+    def test_errors_are_not_cached(self):
+        self.mock_get.return_value.json.return_value = {
+            'status': 'OVER_QUERY_LIMIT', 'results': []}
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        self.assertEqual(0, GeocodingCacheEntry.objects.count())
+
+    def test_least_recently_used_entries_are_evicted(self):
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1401 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        evict_geocoding_cache(1, settings.GEOCODING_CACHE_TTL_IN_DAYS)
+        self.assertEqual('1400 jfk blvd, philadelphia',
+                         GeocodingCacheEntry.objects.get().address)
+
+    def test_summary_reports_saved_requests(self):
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        summary = get_geocoding_cache_summary()
+        self.assertEqual(1, summary['entries'])
+        self.assertEqual(2, summary['hits'])
+        self.assertEqual(1, summary['misses'])
+        self.assertAlmostEqual(2 / 3, summary['hit_rate'])
+
+    def test_summary_counts_requests_for_expired_entries_as_misses(self):
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        GeocodingCacheEntry.objects.update(
+            created_at=timezone.now() - timedelta(
+                days=settings.GEOCODING_CACHE_TTL_IN_DAYS + 1))
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        summary = get_geocoding_cache_summary()
+        self.assertEqual(1, summary['entries'])
+        self.assertEqual(2, summary['hits'])
+        self.assertEqual(2, summary['misses'])
+        self.assertAlmostEqual(0.5, summary['hit_rate'])
+
+    @override_settings(GEOCODING_CACHE_MAX_ENTRIES=0)
+    def test_cache_can_be_disabled(self):
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        geocode_address('1400 JFK Blvd, Philadelphia', 'US')
+        self.assertEqual(2, self.mock_get.call_count)
+        self.assertEqual(0, GeocodingCacheEntry.objects.count())
+
+
+class StubGeocodingSession(object):
+    """
+    Answers geocoding requests with the given (status code, data) responses
+    in order, repeating the last one, and records the requested addresses.
+    """
+    def __init__(self, responses):
+        self.responses = list(responses)
+        self.addresses = []
+        self.lock = threading.Lock()
+
+    def get(self, url, params):
+        with self.lock:
+            self.addresses.append(params['address'])
+            status_code, data = self.responses.pop(0) \
+                if len(self.responses) > 1 else self.responses[0]
+        response = mock.Mock(status_code=status_code)
+        response.json.return_value = data
+        return response
+
+
+class ConcurrentGeocodingTest(TestCase):
+    def setUp(self):
+        self.data = parsed_city_hall_data['full_response']
+        facility_list = FacilityList.objects.create(
+            header='address,country,name')
+        self.source = Source.objects.create(source_type=Source.LIST,
+                                            facility_list=facility_list)
+
+    def create_items(self, addresses):
+        return [FacilityListItem.objects.create(
+                    row_index=row_index,
+                    raw_data='',
+                    status=FacilityListItem.PARSED,
+                    name='Name',
+                    address=address,
+                    country_code='US',
+                    source=self.source)
+                for row_index, address in enumerate(addresses)]
+
+    def test_items_are_geocoded_and_saved(self):
+        session = StubGeocodingSession([(200, self.data)])
+        items = self.create_items(['1400 JFK Blvd', '1400 jfk blvd',
+                                   '1 Penn Sq'])
+        result = geocode_list_items(items, concurrency=4, rate=0,
+                                    batch_size=2, session=session)
+        self.assertEqual(3, result['success'])
+        self.assertEqual(0, result['failure'])
+        self.assertEqual(2, len(session.addresses))
+        for item in FacilityListItem.objects.filter(source=self.source):
+            self.assertEqual(FacilityListItem.GEOCODED, item.status)
+            self.assertIsNotNone(item.geocoded_point)
+            self.assertEqual(ProcessingAction.GEOCODE,
+                             item.processing_results[-1]['action'])
+
+    def test_cached_addresses_are_not_requested(self):
+        session = StubGeocodingSession([(200, self.data)])
+        geocode_list_items(self.create_items(['1400 JFK Blvd']),
+                           rate=0, session=session)
+        geocode_list_items(self.create_items(['1400 JFK Blvd']),
+                           rate=0, session=session)
+        self.assertEqual(1, len(session.addresses))
+
+    def test_failed_requests_set_error_status(self):
+        session = StubGeocodingSession([(400, {})])
+        [item] = self.create_items(['1400 JFK Blvd'])
+        result = geocode_list_items([item], rate=0, session=session)
+        self.assertEqual(1, result['failure'])
+        item.refresh_from_db()
+        self.assertEqual(FacilityListItem.ERROR_GEOCODING, item.status)
+
+    def test_items_with_invalid_status_are_not_saved(self):
+        session = StubGeocodingSession([(200, self.data)])
+        [item] = self.create_items(['1400 JFK Blvd'])
+        FacilityListItem.objects.filter(id=item.id).update(
+            status=FacilityListItem.UPLOADED)
+        item.refresh_from_db()
+        result = geocode_list_items([item], rate=0, session=session)
+        self.assertEqual(1, result['failure'])
+        self.assertEqual(1, len(result['errors']))
+        self.assertEqual(0, len(session.addresses))
+
+    def test_over_query_limit_is_retried(self):
+        session = StubGeocodingSession([
+            (200, {'status': 'OVER_QUERY_LIMIT', 'results': []}),
+            (200, self.data)])
+        data, _ = request_geocoding_with_retries(
+            '1400 JFK Blvd', 'US', session, TokenBucket(0), backoff=0)
+        self.assertEqual(self.data, data)
+        self.assertEqual(2, len(session.addresses))
+
+    def test_server_errors_are_retried(self):
+        session = StubGeocodingSession([(503, {})])
+        with self.assertRaises(GeocodingRequestError):
+            request_geocoding_with_retries(
+                '1400 JFK Blvd', 'US', session, TokenBucket(0),
+                max_retries=2, backoff=0)
+        self.assertEqual(3, len(session.addresses))
+
+    def test_client_errors_are_not_retried(self):
+        session = StubGeocodingSession([(400, {})])
+        with self.assertRaises(GeocodingRequestError):
+            request_geocoding_with_retries(
+                '1400 JFK Blvd', 'US', session, TokenBucket(0), backoff=0)
+        self.assertEqual(1, len(session.addresses))
+
+    def test_token_bucket_limits_rate(self):
+        bucket = TokenBucket(100, capacity=1)
+        started = time.monotonic()
+        for _ in range(11):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+
 class FacilityListItemGeocodingTest(ProcessingTestCase):
     def test_invalid_argument_raises_error(self):
         with self.assertRaises(ValueError) as cm:
@@ -1237,7 +1491,7 @@ def junk_chars(string):
     return 'AA' + string + 'YY'
 
 
-class DedupeMatchingTests(TestCase):
+class DedupeMatchingTestCase(TestCase):
     fixtures = ['users', 'contributors', 'facility_lists', 'sources',
                 'facility_list_items', 'facilities', 'facility_matches']
 
@@ -1266,6 +1520,8 @@ class DedupeMatchingTests(TestCase):
             list_item.save()
         return facility_list
 
+
+class DedupeMatchingTests(DedupeMatchingTestCase):
     def test_matches(self):
         facility = Facility.objects.first()
         facility_list = self.create_list([
@@ -1384,6 +1640,127 @@ class DedupeMatchingTests(TestCase):
             address='123 Main Street')
         self.assertFalse(is_string_match(item, facility))
 
+    def test_filter_matches_to_existing_facilities(self):
+        [first, second] = Facility.objects.all()[:2]
+        results = [
+            [(('1', first.id), 0.9),
+             (('1', '{}_MATCH-1'.format(second.id)), 0.8)],
+            [(('2', 'US2020052YDVKBQ'), 0.7),
+             (('2', second.id), 0.6)],
+        ]
+        with self.assertNumQueries(2):
+            filtered = list(
+                filter_matches_to_existing_facilities(results, chunk_size=3))
+        self.assertEqual([
+            ('1', first.id, 0.9),
+            ('1', '{}_MATCH-1'.format(second.id), 0.8),
+            ('2', second.id, 0.6),
+        ], filtered)
+
+
+class SaveMatchDetailsInBulkTest(DedupeMatchingTestCase):
+    class Rollback(Exception):
+        pass
+
+    def summarize(self, facility_list, save, match_results):
+        summary = {}
+        history_before = (Facility.history.count(),
+                          FacilityMatch.history.count())
+        try:
+            with transaction.atomic():
+                save(copy.deepcopy(match_results))
+                items = facility_list.source.facilitylistitem_set \
+                    .order_by('row_index')
+                summary['items'] = [
+                    (i.row_index, i.status,
+                     i.facility is not None
+                     and i.facility.created_from_id == i.id,
+                     [r['action'] for r in i.processing_results])
+                    for i in items]
+                summary['matches'] = sorted(
+                    (m.facility_list_item.row_index, m.status,
+                     str(m.confidence), m.results.get('match_type'))
+                    for m in FacilityMatch.objects.filter(
+                        facility_list_item__in=items))
+                summary['history'] = (
+                    Facility.history.count() - history_before[0],
+                    FacilityMatch.history.count() - history_before[1])
+                summary['indexed'] = all(
+                    FacilityIndex.objects.filter(id=i.facility_id).exists()
+                    for i in items if i.facility_id is not None)
+                raise self.Rollback()
+        except self.Rollback:
+            pass
+        return summary
+
+    def test_bulk_save_is_equivalent_to_save(self):
+        facilities = list(Facility.objects.all()[:2])
+        facility_list = self.create_list(
+            [(f.country_code, f.name, f.address) for f in facilities]
+            + [('US', 'Azavea', '990 Spring Garden St.')])
+        facility_list.source.facilitylistitem_set \
+            .filter(name='Azavea') \
+            .update(geocoded_point=Point(-75.15, 39.96))
+        match_results = match_facility_list_items(facility_list)
+
+        expected = self.summarize(
+            facility_list, save_match_details, match_results)
+        actual = self.summarize(
+            facility_list, save_match_details_in_bulk, match_results)
+
+        self.assertEqual(expected, actual)
+        self.assertTrue(actual['indexed'])
+
+
+class GazetteerSnapshotTests(TestCase):
+    fixtures = ['users', 'contributors', 'facility_lists', 'sources',
+                'facility_list_items', 'facilities', 'facility_matches']
+
+    def setUp(self):
+        self.snapshot_dir = tempfile.TemporaryDirectory()
+        self.snapshot_path = os.path.join(self.snapshot_dir.name,
+                                          'gazetteer.snapshot')
+        gazetteer, facility_version, match_version = \
+            GazetteerCache.build_gazetteer()
+        self.header = write_gazetteer_snapshot(
+            gazetteer, facility_version, match_version, self.snapshot_path)
+
+    def tearDown(self):
+        GazetteerCache._gazetter = None
+        GazetteerCache._facility_version = None
+        GazetteerCache._match_version = None
+        self.snapshot_dir.cleanup()
+
+    def test_loads_snapshot_instead_of_training(self):
+        with override_settings(GAZETTEER_SNAPSHOT_PATH=self.snapshot_path):
+            with mock.patch.object(GazetteerCache,
+                                   '_rebuild_gazetteer') as rebuild:
+                gazetteer = GazetteerCache.get_latest()
+                rebuild.assert_not_called()
+        self.assertIsNotNone(gazetteer)
+        self.assertEqual(self.header['facility_version'],
+                         GazetteerCache._facility_version)
+        self.assertEqual(self.header['match_version'],
+                         GazetteerCache._match_version)
+
+    def test_replays_history_after_snapshot(self):
+        facility = Facility.objects.first()
+        facility.name = 'Renamed after snapshot'
+        facility.save()
+        with override_settings(GAZETTEER_SNAPSHOT_PATH=self.snapshot_path):
+            GazetteerCache.get_latest()
+        self.assertGreater(GazetteerCache._facility_version,
+                           self.header['facility_version'])
+
+    def test_rebuilds_when_snapshot_is_unreadable(self):
+        with open(self.snapshot_path, 'wb') as f:
+            f.write(b'not a snapshot')
+        with override_settings(GAZETTEER_SNAPSHOT_PATH=self.snapshot_path):
+            with mock.patch.object(GazetteerCache,
+                                   '_rebuild_gazetteer') as rebuild:
+                GazetteerCache.get_latest()
+                rebuild.assert_called_once()
+
 
 class OarIdTests(TestCase):
 
@@ -7040,3 +7417,1459 @@ class ContributorFieldsApiTest(APITestCase):
         self.assertEquals(None, field['value'])
         self.assertEquals('ExtraTwo', field_two['label'])
         self.assertEquals(None, field_two['value'])
+
+
+class FacilityIndexQueueTest(FacilityAPITestCaseBase):
+    def test_index_is_updated_when_indexed_field_changes(self):
+        self.facility.name = 'Renamed'
+        self.facility.save()
+        index = FacilityIndex.objects.get(id=self.facility.id)
+        self.assertEqual('Renamed', index.name)
+        self.assertEqual([self.contributor.id], index.contributors)
+
+    def test_inactive_match_is_removed_from_index(self):
+        self.match.is_active = False
+        self.match.save()
+        index = FacilityIndex.objects.get(id=self.facility.id)
+        self.assertEqual([], index.contributors)
+        self.assertEqual([], index.lists)
+
+    def test_unchanged_save_does_not_reindex(self):
+        facility = Facility.objects.get(id=self.facility.id)
+        match = FacilityMatch.objects.get(id=self.match.id)
+        with mock.patch('api.models.index_facilities') as mock_index:
+            facility.address = 'New Address'
+            facility.save()
+            match.confidence = 0.9
+            match.save()
+            self.contributor.description = 'Updated'
+            self.contributor.save()
+            mock_index.assert_not_called()
+
+    @override_settings(DEFER_FACILITY_INDEX=True)
+    def test_deferred_changes_are_queued_and_processed(self):
+        with mock.patch('api.models.transaction.on_commit',
+                        side_effect=lambda f: f()):
+            self.facility.name = 'First'
+            self.facility.save()
+            self.facility.name = 'Second'
+            self.facility.save()
+
+        self.assertEqual(
+            [self.facility.id],
+            list(FacilityIndexQueue.objects.values_list(
+                'facility_id', flat=True)))
+        self.assertEqual(
+            'Name', FacilityIndex.objects.get(id=self.facility.id).name)
+
+        self.assertEqual(1, process_queue_batch(10))
+        self.assertEqual(0, FacilityIndexQueue.objects.count())
+        self.assertEqual(
+            'Second', FacilityIndex.objects.get(id=self.facility.id).name)
+
+
+class RebuildFacilityIndexTest(FacilityAPITestCaseBase):
+    def setUp(self):
+        super(RebuildFacilityIndexTest, self).setUp()
+        self.other_list_item = FacilityListItem \
+            .objects \
+            .create(name='Other',
+                    address='Other Address',
+                    country_code='US',
+                    row_index=2,
+                    geocoded_point=Point(1, 1),
+                    status=FacilityListItem.CONFIRMED_MATCH,
+                    source=self.source)
+        self.other_facility = Facility \
+            .objects \
+            .create(name='Other',
+                    address='Other Address',
+                    country_code='US',
+                    location=Point(1, 1),
+                    created_from=self.other_list_item)
+        FacilityMatch \
+            .objects \
+            .create(status=FacilityMatch.CONFIRMED,
+                    facility=self.other_facility,
+                    facility_list_item=self.other_list_item,
+                    confidence=0.9,
+                    results='')
+
+    def test_rebuild_in_chunks(self):
+        FacilityIndex.objects.filter(id=self.facility.id).update(name='Stale')
+        rows = rebuild_facility_index(chunk_size=1)
+        self.assertEqual(2, rows)
+        self.assertEqual(2, FacilityIndex.objects.count())
+        self.assertEqual(
+            'Name', FacilityIndex.objects.get(id=self.facility.id).name)
+        self.assertEqual(
+            [self.contributor.id],
+            FacilityIndex.objects.get(id=self.other_facility.id).contributors)
+
+    def test_rebuild_keeps_indexes(self):
+        table = FacilityIndex._meta.db_table
+        before = sorted(name for name, _, _ in get_index_definitions(table))
+        rebuild_facility_index(chunk_size=1)
+        after = sorted(name for name, _, _ in get_index_definitions(table))
+        self.assertEqual(before, after)
+
+    def test_rebuild_marks_cells_of_moved_facilities_dirty(self):
+        mark_facility_grid_cells_dirty()
+        FacilityGridCell.objects.update(is_dirty=False)
+        FacilityIndex.objects.filter(id=self.other_facility.id).update(
+            location=Point(50, 50))
+        rebuild_facility_index(chunk_size=1)
+        dirty = FacilityGridCell.objects.filter(
+            is_dirty=True, zoom=FacilityGridCell.MAX_ZOOM)
+        # The cells of the stale and the rebuilt locations
+        self.assertEqual(2, dirty.count())
+        self.assertTrue(FacilityGridCell.objects.filter(
+            is_dirty=False).exists())
+
+
+@override_settings(ALLOWED_HOSTS=['testserver', '.allowed.org'])
+@override_switch('vector_tile', active=True)
+class TileCacheTest(FacilityAPITestCaseBase):
+    def setUp(self):
+        super(TileCacheTest, self).setUp()
+        # Discard the hits of other tests and restart the flush interval
+        flush_tile_hits()
+
+    def get_tile(self, params={}):
+        path = reverse('tile', kwargs={
+            'layer': 'facilities',
+            'cachekey': '1567700347-1-95f951f7',
+            'z': 0, 'x': 0, 'y': 0,
+            'ext': 'pbf',
+        })
+        return self.client.get(path, params,
+                               HTTP_REFERER='http://allowed.org/')
+
+    def test_second_request_is_a_hit(self):
+        first = self.get_tile()
+        second = self.get_tile()
+        self.assertEqual('MISS', first['X-Tile-Cache'])
+        self.assertEqual('HIT', second['X-Tile-Cache'])
+        self.assertEqual(first.content, second.content)
+        # Hits are counted in memory until they are flushed
+        self.assertEqual(0, TileCacheEntry.objects.get().hits)
+        flush_tile_hits()
+        self.assertEqual(1, TileCacheEntry.objects.get().hits)
+
+    def test_params_are_normalized(self):
+        self.get_tile({'countries': ['US', 'CN'], 'name': ''})
+        response = self.get_tile({'countries': ['CN', 'US']})
+        self.assertEqual('HIT', response['X-Tile-Cache'])
+
+    def test_changing_cache_key_invalidates_entries(self):
+        self.get_tile()
+        Version.objects.create(name='tile_version', version=1)
+        response = self.get_tile()
+        self.assertEqual('MISS', response['X-Tile-Cache'])
+        self.assertEqual(2, TileCacheEntry.objects.count())
+        self.assertEqual(
+            1, delete_stale_tiles(Facility.current_tile_cache_key()))
+        self.assertEqual(1, TileCacheEntry.objects.count())
+
+    def test_least_recently_used_entries_are_evicted(self):
+        self.get_tile()
+        self.get_tile({'countries': 'US'})
+        self.get_tile()
+        flush_tile_hits()
+        evict_tiles(TileCacheEntry.objects.latest('last_accessed_at').size)
+        self.assertEqual(1, TileCacheEntry.objects.count())
+        self.assertEqual(1, TileCacheEntry.objects.get().hits)
+
+    def test_tiles_are_not_stored_while_index_updates_are_queued(self):
+        FacilityIndexQueue.objects.create(facility_id=self.facility.id)
+        self.get_tile()
+        self.assertEqual(0, TileCacheEntry.objects.count())
+        FacilityIndexQueue.objects.all().delete()
+        self.get_tile()
+        self.assertEqual(1, TileCacheEntry.objects.count())
+
+    @override_settings(TILE_CACHE_MAX_SIZE_IN_BYTES=0)
+    def test_cache_can_be_disabled(self):
+        self.get_tile()
+        self.assertEqual('MISS', self.get_tile()['X-Tile-Cache'])
+        self.assertEqual(0, TileCacheEntry.objects.count())
+
+
+class FacilityGridTest(FacilityAPITestCaseBase):
+    def get_counts(self, dimension):
+        return list(FacilityGridCount.objects
+                    .filter(cell__zoom=FacilityGridCell.MAX_ZOOM,
+                            dimension=dimension)
+                    .values_list('value', 'count'))
+
+    def test_get_facility_grid_filter(self):
+        self.assertEqual(('all', ['']),
+                         get_facility_grid_filter(QueryDict('embed=1')))
+        self.assertEqual(('country', ['US', 'CN']),
+                         get_facility_grid_filter(
+                             QueryDict('countries=US&countries=CN&q=')))
+        self.assertEqual(('contributor', ['1']),
+                         get_facility_grid_filter(
+                             QueryDict('contributors=1')))
+        self.assertIsNone(get_facility_grid_filter(
+            QueryDict('contributors=1&contributors=2')))
+        self.assertIsNone(get_facility_grid_filter(
+            QueryDict('countries=US&contributors=1')))
+        self.assertIsNone(get_facility_grid_filter(QueryDict('q=shirts')))
+
+    def test_build_counts_facilities(self):
+        build_facility_grid()
+        self.assertEqual(
+            FacilityGridCell.MAX_ZOOM + 1,
+            FacilityGridCell.objects.filter(is_dirty=False).count())
+        self.assertEqual([('', 1)], self.get_counts('all'))
+        self.assertEqual([('US', 1)], self.get_counts('country'))
+        self.assertEqual([(str(self.contributor.id), 1)],
+                         self.get_counts('contributor'))
+        self.assertEqual([(Contributor.OTHER_CONTRIB_TYPE, 1)],
+                         self.get_counts('contributor_type'))
+
+    def test_precomputed_tile(self):
+        params = QueryDict('countries=US')
+        self.assertIsNone(get_precomputed_facility_grid_vector_tile(
+            params, 'facilitygrid', 0, 0, 0))
+        build_facility_grid()
+        self.assertIsNotNone(get_precomputed_facility_grid_vector_tile(
+            params, 'facilitygrid', 0, 0, 0))
+        self.assertIsNone(get_precomputed_facility_grid_vector_tile(
+            QueryDict('q=Name'), 'facilitygrid', 0, 0, 0))
+
+    def test_changed_facilities_are_recounted(self):
+        build_facility_grid()
+        old_cell = FacilityGridCell.objects.get(zoom=FacilityGridCell.MAX_ZOOM)
+
+        self.facility.location = Point(10, 10)
+        self.facility.save()
+        self.assertEqual(2, FacilityGridCell.objects.filter(
+            zoom=FacilityGridCell.MAX_ZOOM, is_dirty=True).count())
+        self.assertIsNone(get_precomputed_facility_grid_vector_tile(
+            QueryDict(), 'facilitygrid', 0, 0, 0))
+
+        refresh_facility_grid()
+        new_cell = FacilityGridCell.objects.get(zoom=FacilityGridCell.MAX_ZOOM)
+        self.assertNotEqual(old_cell.id, new_cell.id)
+        self.assertEqual([('', 1)], self.get_counts('all'))
+
+
+class FacilityIndexQueryTest(FacilityAPITestCaseBase):
+    def test_filter_by_query_params_returns_index_rows(self):
+        queryset = FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=US'))
+        self.assertEqual([self.facility.id],
+                         list(queryset.values_list('id', flat=True)))
+        queryset = FacilityIndex.objects.filter_by_query_params(
+            QueryDict('countries=CN'))
+        self.assertEqual(0, queryset.count())
+
+    def test_list_serializes_page_of_facilities(self):
+        response = self.client.get('/api/facilities/?countries=US')
+        self.assertEqual(200, response.status_code)
+        data = json.loads(response.content)
+        self.assertEqual(1, data['count'])
+        self.assertEqual(self.facility.id, data['features'][0]['id'])
+        self.assertEqual('Address',
+                         data['features'][0]['properties']['address'])
+        self.assertEqual([0.0, 0.0, 0.0, 0.0], data['extent'])
+
+    @override_settings(QUERY_INSTRUMENTATION=True)
+    def test_queries_are_logged_when_enabled(self):
+        with self.assertLogs('api.instrumentation', level='INFO') as logs:
+            self.client.get('/api/facilities/')
+        self.assertTrue(any('facilities list' in message
+                            for message in logs.output))
+
+
+class FacilityFreeTextSearchTest(FacilityAPITestCaseBase):
+    def setUp(self):
+        super(FacilityFreeTextSearchTest, self).setUp()
+        FacilityIndex.objects.create(
+            id='US2021001ABCDEF', name='Other Names Factory',
+            country_code='US', location=Point(1, 1), contrib_types=[],
+            contributors=[], lists=[], ppe='')
+
+    def search(self, query_string):
+        return list(FacilityIndex.objects
+                    .filter_by_query_params(QueryDict(query_string))
+                    .values_list('id', flat=True))
+
+    def test_get_oar_id_prefix(self):
+        self.assertEqual('US2019', get_oar_id_prefix('us-2019'))
+        self.assertEqual('CN2019067X1K', get_oar_id_prefix('CN2019067X1K'))
+        self.assertIsNone(get_oar_id_prefix('shirts'))
+        self.assertIsNone(get_oar_id_prefix('XX2019'))
+        self.assertIsNone(get_oar_id_prefix('US2019067X1K87E2'))
+
+    def test_search_by_oar_id_prefix(self):
+        self.assertEqual(['US2021001ABCDEF'], self.search('q=us2021001'))
+
+    def test_search_by_oar_id_substring(self):
+        self.assertEqual(['US2021001ABCDEF'], self.search('q=abcdef'))
+
+    def test_search_by_name(self):
+        self.assertEqual(['US2021001ABCDEF'], self.search('q=factory'))
+
+    def test_sort_by_relevance(self):
+        params = QueryDict('q=name&sort_by=relevance')
+        ids = list(FacilityIndex.objects.order_by_query_params(
+            FacilityIndex.objects.filter_by_query_params(params), params)
+            .values_list('id', flat=True))
+        self.assertEqual([self.facility.id, 'US2021001ABCDEF'], ids)
+        response = self.client.get(
+            '/api/facilities/?q=name&sort_by=relevance')
+        self.assertEqual(200, response.status_code)
+        features = json.loads(response.content)['features']
+        self.assertEqual(self.facility.id, features[0]['id'])
+
+    @override_settings(ALLOWED_HOSTS=['testserver', '.allowed.org'])
+    @override_switch('vector_tile', active=True)
+    def test_tiles_ignore_sort_by_relevance(self):
+        for layer in ('facilities', 'facilitygrid'):
+            path = reverse('tile', kwargs={
+                'layer': layer,
+                'cachekey': '1567700347-1-95f951f7',
+                'z': 0, 'x': 0, 'y': 0,
+                'ext': 'pbf',
+            })
+            response = self.client.get(
+                path, {'q': 'name', 'sort_by': 'relevance'},
+                HTTP_REFERER='http://allowed.org/')
+            self.assertEqual(200, response.status_code)
+
+
+class FacilityListContributorsTest(FacilityAPITestCaseBase):
+    def create_matched_facility(self, index, is_public=True):
+        contributor = Contributor \
+            .objects \
+            .create(admin=User.objects.create(
+                        email='contributor{}@example.com'.format(index)),
+                    name='contributor {}'.format(index),
+                    contrib_type=Contributor.OTHER_CONTRIB_TYPE)
+        facility_list = FacilityList \
+            .objects \
+            .create(header='header',
+                    file_name='list{}'.format(index),
+                    name='List {}'.format(index))
+        source = Source \
+            .objects \
+            .create(facility_list=facility_list,
+                    source_type=Source.LIST,
+                    is_active=True,
+                    is_public=is_public,
+                    contributor=contributor)
+        list_item = FacilityListItem \
+            .objects \
+            .create(name='Item {}'.format(index),
+                    address='Address',
+                    country_code='US',
+                    row_index=1,
+                    geocoded_point=Point(0, 0),
+                    status=FacilityListItem.CONFIRMED_MATCH,
+                    source=source)
+        facility = Facility \
+            .objects \
+            .create(name='Name {}'.format(index),
+                    address='Address',
+                    country_code='US',
+                    location=Point(0, 0),
+                    created_from=list_item)
+        FacilityMatch \
+            .objects \
+            .create(status=FacilityMatch.AUTOMATIC,
+                    facility=facility,
+                    facility_list_item=list_item,
+                    confidence=0.85,
+                    results='')
+        # Also match the facility to the list of the base test case
+        other_item = FacilityListItem \
+            .objects \
+            .create(name='Item {}'.format(index),
+                    address='Address',
+                    country_code='US',
+                    row_index=index + 1,
+                    geocoded_point=Point(0, 0),
+                    status=FacilityListItem.CONFIRMED_MATCH,
+                    source=self.source,
+                    facility=facility)
+        FacilityMatch \
+            .objects \
+            .create(status=FacilityMatch.CONFIRMED,
+                    facility=facility,
+                    facility_list_item=other_item,
+                    confidence=0.85,
+                    results='')
+        return facility
+
+    def count_list_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/facilities/')
+        self.assertEqual(200, response.status_code)
+        return len(context.captured_queries)
+
+    def test_query_count_does_not_grow_with_page_size(self):
+        self.create_matched_facility(1)
+        # Make one request first so that anything cached by the first request
+        # is not included in the count
+        self.count_list_queries()
+        expected_count = self.count_list_queries()
+        for index in range(2, 10):
+            self.create_matched_facility(index, is_public=index % 2 == 0)
+        self.assertEqual(expected_count, self.count_list_queries())
+
+    def test_contributors_match_single_facility_serialization(self):
+        self.create_matched_facility(1)
+        self.create_matched_facility(2, is_public=False)
+        response = self.client.get('/api/facilities/')
+        features = json.loads(response.content)['features']
+        self.assertEqual(3, len(features))
+        for feature in features:
+            facility = Facility.objects.get(id=feature['id'])
+            self.assertEqual(
+                FacilitySerializer(facility).data['properties'][
+                    'contributors'],
+                feature['properties']['contributors'])
+
+    def test_private_contributors_are_anonymized(self):
+        facility = self.create_matched_facility(1, is_public=False)
+        response = self.client.get('/api/facilities/')
+        features = json.loads(response.content)['features']
+        [feature] = [f for f in features if f['id'] == facility.id]
+        self.assertIn({'name': 'One Other'},
+                      feature['properties']['contributors'])
+
+    def test_contributors_are_empty_in_embed_mode(self):
+        self.create_matched_facility(1)
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get('/api/facilities/?embed=1')
+        features = json.loads(response.content)['features']
+        self.assertTrue(all(f['properties']['contributors'] == []
+                            for f in features))
+        self.assertFalse(any('api_facilitymatch' in q['sql']
+                             for q in context.captured_queries))
+
+
+class BatchProcessChunkTest(TestCase):
+    def setUp(self):
+        facility_list = FacilityList.objects.create(
+            header='address,country,name', file_name='one', name='List')
+        self.source = Source.objects.create(source_type=Source.LIST,
+                                            facility_list=facility_list)
+        for row_index in range(5):
+            FacilityListItem.objects.create(
+                row_index=row_index,
+                raw_data='"{} Main St",us,Factory'.format(row_index),
+                status=FacilityListItem.UPLOADED,
+                source=self.source)
+
+    def get_parsed_row_indexes(self):
+        return list(FacilityListItem.objects
+                    .filter(source=self.source,
+                            status=FacilityListItem.PARSED)
+                    .order_by('row_index')
+                    .values_list('row_index', flat=True))
+
+    def test_array_child_processes_chunk_of_rows(self):
+        with mock.patch.dict(os.environ, {'AWS_BATCH_JOB_ARRAY_INDEX': '1',
+                                          'BATCH_ARRAY_CHUNK_SIZE': '2'}):
+            call_command('batch_process', action='parse',
+                         list_id=self.source.facility_list.id,
+                         stdout=StringIO())
+        self.assertEqual([2, 3], self.get_parsed_row_indexes())
+
+    def test_array_child_processes_single_row_without_chunk_size(self):
+        with mock.patch.dict(os.environ, {'AWS_BATCH_JOB_ARRAY_INDEX': '3'}):
+            call_command('batch_process', action='parse',
+                         list_id=self.source.facility_list.id,
+                         stdout=StringIO())
+        self.assertEqual([3], self.get_parsed_row_indexes())
+
+    @override_settings(BATCH_CHUNK_SIZE=0, BATCH_MAX_ARRAY_SIZE=100)
+    def test_array_chunk_size_is_derived_from_row_count(self):
+        self.assertEqual(25, get_array_chunk_size(10))
+        self.assertEqual(50, get_array_chunk_size(5000))
+        with override_settings(BATCH_CHUNK_SIZE=10):
+            self.assertEqual(10, get_array_chunk_size(5000))
+            self.assertEqual(20, get_array_chunk_size(200000))
+
+
+class PipelineTest(TestCase):
+    def setUp(self):
+        facility_list = FacilityList.objects.create(
+            header='address,country,name', file_name='one', name='List')
+        self.facility_list = facility_list
+        self.source = Source.objects.create(source_type=Source.LIST,
+                                            facility_list=facility_list)
+        self.items = [
+            FacilityListItem.objects.create(
+                row_index=row_index,
+                raw_data='"{} Main St",us,Factory'.format(row_index),
+                status=FacilityListItem.UPLOADED,
+                source=self.source)
+            for row_index in range(3)]
+
+    def test_parse_and_geocode_items(self):
+        session = StubGeocodingSession(
+            [(200, parsed_city_hall_data['full_response'])])
+        with mock.patch('api.concurrent_geocoding.create_geocoding_session',
+                        return_value=session):
+            item_ids = parse_and_geocode_items(
+                [item.id for item in self.items[:2]])
+        self.assertEqual(sorted(item.id for item in self.items[:2]),
+                         sorted(item_ids))
+        for item in FacilityListItem.objects.filter(id__in=item_ids):
+            self.assertEqual(FacilityListItem.GEOCODED, item.status)
+            self.assertEqual(
+                [ProcessingAction.PARSE, ProcessingAction.GEOCODE],
+                [r['action'] for r in item.processing_results])
+        self.assertEqual(
+            FacilityListItem.UPLOADED,
+            FacilityListItem.objects.get(id=self.items[2].id).status)
+
+    def test_messy_items_can_be_limited_to_ids(self):
+        FacilityListItem.objects.filter(source=self.source).update(
+            status=FacilityListItem.GEOCODED)
+        messy = get_messy_items_from_facility_list(
+            self.facility_list, item_ids=[self.items[1].id])
+        self.assertEqual([str(self.items[1].id)], list(messy.keys()))
+
+    def test_matches_to_facilities_from_the_same_list_are_excluded(self):
+        facility = Facility.objects.create(
+            name='Factory', address='0 Main St', country_code='US',
+            location=Point(0, 0), created_from=self.items[0])
+        other_id = 'US2020052YDVKBQ'
+        result = {
+            'item_matches': {
+                str(self.items[1].id): [(facility.id, 0.9),
+                                        (other_id, 0.8)],
+                str(self.items[2].id): [
+                    ('{}_MATCH-1'.format(facility.id), 0.9)],
+            }
+        }
+        exclude_matches_to_list(result, self.facility_list)
+        self.assertEqual(
+            {str(self.items[1].id): [(other_id, 0.8)]},
+            result['item_matches'])
+
+
+class ParseFacilityListItemsTest(TestCase):
+    def setUp(self):
+        self.rows = [
+            '"1 Main St",us,Factory,masks|gloves,555-1234,a@example.com',
+            '"2 Main St",narnia,Factory,,,',
+            '"3 Main St",us,Factory,,,not-an-email',
+            '"4 Main St",us',
+            '"5 Main St",United States,Factory,,,',
+        ]
+        self.header = ('address,country,name,ppe_product_types,'
+                       'ppe_contact_phone,ppe_contact_email')
+
+    def create_items(self, file_name):
+        facility_list = FacilityList.objects.create(
+            header=self.header, file_name=file_name, name=file_name)
+        source = Source.objects.create(source_type=Source.LIST,
+                                       facility_list=facility_list)
+        for row_index, row in enumerate(self.rows):
+            FacilityListItem.objects.create(
+                row_index=row_index, raw_data=row,
+                status=FacilityListItem.UPLOADED, source=source)
+        return facility_list
+
+    def get_parsed_values(self, facility_list):
+        def result_without_times(result):
+            return {k: v for k, v in result.items()
+                    if k not in ('started_at', 'finished_at', 'trace')}
+
+        return [
+            (item.status, item.name, item.address, item.country_code,
+             item.ppe_product_types, item.ppe_contact_phone,
+             item.ppe_contact_email,
+             [result_without_times(r) for r in item.processing_results])
+            for item in FacilityListItem.objects
+            .filter(source__facility_list=facility_list)
+            .order_by('row_index')]
+
+    def test_results_match_parsing_each_item(self):
+        single_list = self.create_items('single')
+        for item in FacilityListItem.objects.filter(
+                source__facility_list=single_list):
+            parse_facility_list_item(item)
+            item.save()
+
+        bulk_list = self.create_items('bulk')
+        result = parse_facility_list_items(
+            bulk_list,
+            FacilityListItem.objects.filter(source__facility_list=bulk_list),
+            batch_size=2)
+
+        self.assertEqual(2, result['success'])
+        self.assertEqual(3, result['failure'])
+        self.assertEqual(self.get_parsed_values(single_list),
+                         self.get_parsed_values(bulk_list))
+
+    def test_query_count_does_not_grow_with_rows(self):
+        facility_list = self.create_items('bulk')
+        items = list(FacilityListItem.objects.filter(
+            source__facility_list=facility_list))
+        with self.assertNumQueries(1):
+            parse_facility_list_items(facility_list, items)
+
+    def test_items_not_uploaded_are_skipped(self):
+        facility_list = self.create_items('bulk')
+        FacilityListItem.objects.filter(row_index=0).update(
+            status=FacilityListItem.PARSED)
+        result = parse_facility_list_items(
+            facility_list,
+            FacilityListItem.objects.filter(
+                source__facility_list=facility_list))
+        self.assertEqual(
+            ['Items to be parsed must be in the UPLOADED status'],
+            result['errors'])
+
+
+class StreamingUploadTest(APITestCase):
+    def setUp(self):
+        self.email = 'test@example.com'
+        self.password = 'password'
+        self.user = User(email=self.email)
+        self.user.set_password(self.password)
+        self.user.save()
+        self.contributor = Contributor.objects.create(name='Test User',
+                                                      admin=self.user)
+        self.client.login(email=self.email, password=self.password)
+
+        facility_list = FacilityList.objects.create(
+            header='country,name,address', file_name='one', name='one')
+        self.source = Source.objects.create(source_type=Source.LIST,
+                                            facility_list=facility_list)
+
+    def test_inserts_items_in_batches(self):
+        rows = ['US,Factory {},{} Main St'.format(i, i) for i in range(5)]
+        rows += ['', 'US,"Quoted, ""name""","1 Main St\nSuite 2"']
+        count = insert_facility_list_items(self.source, iter(rows),
+                                           batch_size=2)
+        self.assertEqual(len(rows), count)
+
+        items = FacilityListItem.objects.filter(
+            source=self.source).order_by('row_index')
+        self.assertEqual(list(range(len(rows))),
+                         [item.row_index for item in items])
+        self.assertEqual(rows, [item.raw_data for item in items])
+        for item in items:
+            self.assertEqual(FacilityListItem.UPLOADED, item.status)
+            self.assertEqual([], item.processing_results)
+            self.assertIsNotNone(item.created_at)
+
+    def test_inserts_nothing_for_empty_rows(self):
+        self.assertEqual(0, insert_facility_list_items(self.source, []))
+        self.assertFalse(
+            FacilityListItem.objects.filter(source=self.source).exists())
+
+    def test_xlsx_rows_match_xlrd(self):
+        path = ('/usr/local/src/api/management/commands/facility_lists/'
+                '12.xlsx')
+        with open(path, 'rb') as xlsx:
+            sheet = xlrd.open_workbook(file_contents=xlsx.read(),
+                                       on_demand=True).sheet_by_index(0)
+            xlsx.seek(0)
+            rows = list(iter_xlsx_rows(xlsx))
+        self.assertEqual([sheet.row_values(idx) for idx in range(sheet.nrows)],
+                         rows)
+
+    def test_invalid_encoding_in_body_rolls_back_upload(self):
+        previous_list_count = FacilityList.objects.all().count()
+        csv_file = SimpleUploadedFile(
+            'facilities.csv',
+            b'country,name,address\nUS,Factory,1 Main St\nUS,\xff,2 Main St',
+            content_type='text/csv')
+        response = self.client.post(reverse('facility-list-list'),
+                                    {'file': csv_file},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(FacilityList.objects.all().count(),
+                         previous_list_count)
+        self.assertFalse(FacilityListItem.objects.filter(
+            source__contributor=self.contributor).exists())
+
+    def test_upload_inserts_items_in_file_order(self):
+        rows = ['US,Factory {},{} Main St'.format(i, i) for i in range(20)]
+        csv_file = SimpleUploadedFile(
+            'facilities.csv',
+            '\n'.join(['country,name,address'] + rows).encode(),
+            content_type='text/csv')
+        response = self.client.post(reverse('facility-list-list'),
+                                    {'file': csv_file},
+                                    format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        items = FacilityListItem.objects.filter(
+            source__facility_list_id=response.json()['id']).order_by(
+            'row_index')
+        self.assertEqual(rows, [item.raw_data for item in items])
+
+
+class ReplacementListReuseTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test@example.com')
+        self.contributor = Contributor.objects.create(
+            admin=self.user, name='test contributor')
+        self.replaced_list = FacilityList.objects.create(
+            header='country,name,address', file_name='one', name='one')
+        self.replaced_source = Source.objects.create(
+            source_type=Source.LIST, facility_list=self.replaced_list,
+            contributor=self.contributor)
+
+        self.matched_item = self.create_replaced_item(
+            0, 'US,Factory A,1 Main St', FacilityListItem.MATCHED)
+        self.facility = Facility.objects.create(
+            name='Factory A', address='1 Main St', country_code='US',
+            location=Point(1, 1), created_from=self.matched_item)
+        self.matched_item.facility = self.facility
+        self.matched_item.save()
+        FacilityMatch.objects.create(
+            facility_list_item=self.matched_item, facility=self.facility,
+            status=FacilityMatch.AUTOMATIC, confidence=1,
+            results={'match_type': 'no_gazetteer_match'})
+
+        self.potential_item = self.create_replaced_item(
+            1, 'US,Factory B,2 Main St', FacilityListItem.POTENTIAL_MATCH)
+
+        self.replaced_source.is_active = False
+        self.replaced_source.save()
+
+    def create_replaced_item(self, row_index, raw_data, status):
+        name, address = raw_data.split(',')[1:]
+        return FacilityListItem.objects.create(
+            source=self.replaced_source, row_index=row_index,
+            raw_data=raw_data, status=status, country_code='US', name=name,
+            address=address, geocoded_point=Point(row_index, row_index),
+            geocoded_address=address.upper(),
+            processing_results=[
+                {'action': ProcessingAction.PARSE, 'error': False},
+                {'action': ProcessingAction.GEOCODE, 'error': False,
+                 'data': {'status': 'OK'}},
+            ])
+
+    def create_replacing_list(self, header, rows):
+        facility_list = FacilityList.objects.create(
+            header=header, file_name='two', name='two',
+            replaces=self.replaced_list)
+        source = Source.objects.create(
+            source_type=Source.LIST, facility_list=facility_list,
+            contributor=self.contributor)
+        insert_facility_list_items(source, rows)
+        return facility_list
+
+    def get_items(self, facility_list):
+        return list(FacilityListItem.objects.filter(
+            source__facility_list=facility_list).order_by('row_index'))
+
+    def test_fingerprints_are_recorded_on_insert(self):
+        facility_list = self.create_replacing_list(
+            'country,name,address', ['US,Factory A,1 Main St'])
+        self.assertEqual(
+            make_row_fingerprint(get_header_mapping('country,name,address'),
+                                 'US,Factory A,1 Main St'),
+            self.get_items(facility_list)[0].fingerprint)
+
+    def test_unchanged_rows_reuse_results(self):
+        facility_list = self.create_replacing_list(
+            'country,name,address,extra',
+            ['US,Factory B,2 Main St',
+             'US,Factory A,1 Main St',
+             'US,Factory C,3 Main St'])
+        items = FacilityListItem.objects.filter(
+            source__facility_list=facility_list)
+        result = parse_facility_list_items(facility_list, items)
+
+        self.assertEqual(3, result['success'])
+        self.assertEqual(2, result['reused'])
+        self.assertEqual(1, result['reused_matches'])
+
+        potential, matched, changed = self.get_items(facility_list)
+        self.assertEqual(FacilityListItem.GEOCODED, potential.status)
+        self.assertEqual((1, 1), potential.geocoded_point.coords)
+        self.assertEqual('2 MAIN ST', potential.geocoded_address)
+        self.assertIsNone(potential.facility)
+        self.assertEqual(
+            [self.potential_item.id, self.potential_item.id],
+            [r['reused_from_item_id'] for r in potential.processing_results])
+
+        self.assertEqual(FacilityListItem.MATCHED, matched.status)
+        self.assertEqual(self.facility, matched.facility)
+        self.assertEqual(
+            [ProcessingAction.PARSE, ProcessingAction.GEOCODE,
+             ProcessingAction.MATCH],
+            [r['action'] for r in matched.processing_results])
+        match = FacilityMatch.objects.get(facility_list_item=matched)
+        self.assertEqual(FacilityMatch.AUTOMATIC, match.status)
+        self.assertEqual(self.facility, match.facility)
+        self.assertEqual(self.matched_item.id,
+                         match.results['reused_from_item_id'])
+
+        self.assertEqual(FacilityListItem.PARSED, changed.status)
+        self.assertIsNone(changed.geocoded_point)
+
+    def test_changed_header_mapping_prevents_reuse(self):
+        facility_list = self.create_replacing_list(
+            'name,country,address', ['US,Factory A,1 Main St'])
+        items = FacilityListItem.objects.filter(
+            source__facility_list=facility_list)
+        result = parse_facility_list_items(facility_list, items)
+
+        self.assertEqual(0, result['reused'])
+        self.assertFalse(FacilityMatch.objects.filter(
+            facility_list_item__source__facility_list=facility_list)
+            .exists())
+
+    def test_removed_items_do_not_reuse_facility(self):
+        FacilityMatch.objects.filter(
+            facility_list_item=self.matched_item).update(is_active=False)
+        facility_list = self.create_replacing_list(
+            'country,name,address', ['US,Factory A,1 Main St'])
+        items = FacilityListItem.objects.filter(
+            source__facility_list=facility_list)
+        result = parse_facility_list_items(facility_list, items)
+
+        self.assertEqual(1, result['reused'])
+        self.assertEqual(0, result['reused_matches'])
+        [item] = self.get_items(facility_list)
+        self.assertEqual(FacilityListItem.GEOCODED, item.status)
+        self.assertIsNone(item.facility)
+
+
+class DuplicateItemMatchingTest(FacilityAPITestCaseBase):
+    def setUp(self):
+        super(DuplicateItemMatchingTest, self).setUp()
+        self.messy = {
+            '1': {'country': 'us', 'name': 'factory', 'address': '1 main st'},
+            '2': {'country': 'us', 'name': 'other', 'address': '2 main st'},
+            '3': {'country': 'us', 'name': 'factory', 'address': '1 main st'},
+        }
+
+    def test_group_duplicate_items(self):
+        self.assertEqual({'1': ['1', '3'], '2': ['2']},
+                         group_duplicate_items(self.messy))
+
+    @mock.patch('api.matching.GazetteerCache.get_latest')
+    def test_duplicates_are_scored_once(self, get_latest):
+        gazetteer = mock.Mock()
+        gazetteer.match.return_value = iter(
+            [[(('1', self.facility.id), 0.9)]])
+        get_latest.return_value = gazetteer
+
+        result = match_items(self.messy)
+
+        [unique_messy] = gazetteer.match.call_args[0]
+        self.assertEqual(['1', '2'], sorted(unique_messy.keys()))
+        self.assertEqual(['1', '2', '3'],
+                         sorted(result['processed_list_item_ids']))
+        self.assertEqual({'1': [(self.facility.id, 0.9)],
+                          '3': [(self.facility.id, 0.9)]},
+                         dict(result['item_matches']))
+
+    def test_memoized_geocoder_geocodes_each_address_once(self):
+        geocode = mock.Mock(return_value={'result_count': 0})
+        memoized_geocode = make_memoized_geocoder(geocode)
+
+        memoized_geocode('1 Main St', 'US')
+        memoized_geocode('1  main st', 'us')
+        memoized_geocode('2 Main St', 'US')
+
+        self.assertEqual(2, geocode.call_count)
+
+
+class ProcessingEventTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(email='test@example.com')
+        self.contributor = Contributor.objects.create(
+            admin=self.user, name='test contributor')
+        self.list = FacilityList.objects.create(
+            header='country,name,address', file_name='one', name='one')
+        self.source = Source.objects.create(
+            source_type=Source.LIST, facility_list=self.list,
+            contributor=self.contributor)
+
+    def create_item(self, row_index, **kwargs):
+        return FacilityListItem.objects.create(
+            source=self.source, row_index=row_index,
+            raw_data='US,Factory,1 Main St',
+            status=FacilityListItem.UPLOADED, **kwargs)
+
+    def test_results_are_saved_as_events(self):
+        item = self.create_item(0)
+        started = str(datetime.utcnow())
+        item.processing_results.append({
+            'action': ProcessingAction.PARSE,
+            'started_at': started,
+            'error': False,
+            'finished_at': started,
+        })
+        item.save()
+        item.processing_results.append({
+            'action': ProcessingAction.GEOCODE,
+            'error': True,
+            'message': 'failed',
+        })
+        item.save()
+
+        self.assertEqual(2, ProcessingEvent.objects.filter(
+            facility_list_item=item).count())
+        self.assertEqual([], FacilityListItem.objects.get(
+            id=item.id).legacy_processing_results)
+        item.refresh_from_db()
+        self.assertEqual([
+            {'action': ProcessingAction.PARSE, 'started_at': started,
+             'error': False, 'finished_at': started},
+            {'action': ProcessingAction.GEOCODE, 'error': True,
+             'message': 'failed'},
+        ], item.processing_results)
+
+    def test_large_payloads_are_compressed_and_shared(self):
+        data = {'results': [{'formatted_address': 'x' * 1000}]}
+        for row_index in range(2):
+            self.create_item(row_index, processing_results=[{
+                'action': ProcessingAction.GEOCODE,
+                'error': False,
+                'data': data,
+            }])
+
+        self.assertEqual(1, ProcessingPayload.objects.count())
+        payload = ProcessingPayload.objects.get()
+        self.assertLess(len(bytes(payload.data)), payload.size)
+        self.assertEqual(data, payload.get_value())
+        for item in FacilityListItem.objects.all():
+            self.assertEqual(data, item.processing_results[0]['data'])
+
+    def test_list_results_are_recorded_once(self):
+        item = self.create_item(0, processing_results=[
+            {'action': ProcessingAction.PARSE, 'error': False}])
+        self.create_item(1)
+        record_list_processing_result(self.source, {
+            'action': ProcessingAction.SUBMIT_JOB,
+            'type': 'geocode',
+            'error': False,
+        })
+
+        self.assertEqual(1, ProcessingEvent.objects.filter(
+            facility_list_item__isnull=True).count())
+        for i in FacilityListItem.objects.all():
+            self.assertEqual(ProcessingAction.SUBMIT_JOB,
+                             i.processing_results[-1]['action'])
+        item.refresh_from_db()
+        self.assertEqual([ProcessingAction.PARSE, ProcessingAction.SUBMIT_JOB],
+                         [r['action'] for r in item.processing_results])
+
+    def test_legacy_results_are_listed_first(self):
+        item = self.create_item(0)
+        FacilityListItem.objects.filter(id=item.id).update(
+            legacy_processing_results=[
+                {'action': ProcessingAction.PARSE, 'error': False}])
+        item = FacilityListItem.objects.get(id=item.id)
+        item.processing_results.append(
+            {'action': ProcessingAction.GEOCODE, 'error': False})
+        item.save()
+
+        item = FacilityListItem.objects.get(id=item.id)
+        self.assertEqual([ProcessingAction.PARSE, ProcessingAction.GEOCODE],
+                         [r['action'] for r in item.processing_results])
+        self.assertEqual(1, ProcessingEvent.objects.count())
+
+    def test_list_items_load_errors_with_one_query(self):
+        for row_index in range(3):
+            self.create_item(row_index, status=FacilityListItem.ERROR_PARSING,
+                             processing_results=[{
+                                 'action': ProcessingAction.PARSE,
+                                 'error': True,
+                                 'message': 'failed {}'.format(row_index),
+                             }])
+        self.client.force_login(self.user)
+        path = '/api/facility-lists/{}/items/'.format(self.list.id)
+        for params in ({}, {'page': 1, 'pageSize': 20}):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(path, params)
+            self.assertEqual(200, response.status_code)
+            event_queries = [q for q in queries.captured_queries
+                             if 'api_processingevent' in q['sql']]
+            self.assertEqual(1, len(event_queries))
+            items = json.loads(response.content)
+            if 'results' in items:
+                items = items['results']
+            self.assertEqual(['failed 0', 'failed 1', 'failed 2'],
+                             [error for item in items
+                              for error in item['processing_errors']])
+
+
+class MatcherServiceTest(TestCase):
+    def setUp(self):
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.socket_dir.name, 'matcher.sock')
+        self.requests = []
+        self.delay = 0
+
+        def handle_match(request):
+            self.requests.append(request)
+            time.sleep(self.delay)
+            if 'missing' in request['messy']:
+                raise MatcherServiceError(MatcherError.NO_CANONICAL_RECORDS)
+            if 'blocked' in request['messy']:
+                raise MatcherServiceError(MatcherError.BLOCKING)
+            return {'matches': [[['1', 'US2021001ABCDEF', 0.9]]]}
+
+        self.server = MatcherServer(self.path, {
+            MatcherAction.MATCH: handle_match,
+        })
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.socket_dir.cleanup()
+
+    def test_request_matches(self):
+        messy = {'1': {'country': 'us', 'name': 'a', 'address': 'b'}}
+        results = request_matches(self.path, messy, 0.5, 1.0, 5)
+
+        self.assertEqual([[(('1', 'US2021001ABCDEF'), 0.9)]], results)
+        # Callers convert scores with `item`, as for gazetteer results
+        self.assertEqual(0.9, results[0][0][1].item())
+        self.assertEqual(messy, self.requests[0]['messy'])
+        self.assertEqual(0.5, self.requests[0]['gazetteer_threshold'])
+
+    def test_errors_are_raised_as_in_process(self):
+        with override_settings(MATCHER_SOCKET_PATH=self.path):
+            with self.assertRaises(NoCanonicalRecordsError):
+                get_gazetteer_matches({'missing': {}})
+
+    def test_timeout_raises_gazetteer_timeout(self):
+        self.delay = 0.5
+        with override_settings(MATCHER_SOCKET_PATH=self.path,
+                               MATCHER_TIMEOUT_IN_SECONDS=0.1):
+            with self.assertRaises(GazetteerCacheTimeoutError):
+                get_gazetteer_matches({'1': {}})
+
+    @override_settings(MATCHER_MAX_REQUEST_ITEMS=2)
+    def test_items_are_sent_in_bounded_requests(self):
+        messy = {str(i): {} for i in range(5)}
+        with override_settings(MATCHER_SOCKET_PATH=self.path):
+            results = get_gazetteer_matches(messy)
+        self.assertEqual([2, 2, 1],
+                         [len(r['messy']) for r in self.requests])
+        self.assertEqual(3, len(results))
+
+    @override_settings(MATCHER_MAX_REQUEST_ITEMS=1)
+    def test_blocking_fails_only_if_every_request_fails(self):
+        with override_settings(MATCHER_SOCKET_PATH=self.path):
+            self.assertEqual(
+                1, len(get_gazetteer_matches({'blocked': {}, '1': {}})))
+            with self.assertRaises(dedupe.core.BlockingError):
+                get_gazetteer_matches({'blocked': {}})
+
+    def send_concurrent_requests(self, path, count):
+        results = []
+
+        def send():
+            results.append(request_matches(
+                path, {'1': {'country': 'us', 'name': 'a', 'address': 'b'}},
+                0.5, 1.0, 5))
+
+        threads = [threading.Thread(target=send) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_more_clients_than_default_backlog(self):
+        self.delay = 0.01
+        results = self.send_concurrent_requests(self.path, 20)
+        self.assertEqual(20, len(results))
+        self.assertEqual(20, len(self.requests))
+
+    def test_clients_wait_when_backlog_is_full(self):
+        class SmallBacklogServer(MatcherServer):
+            request_queue_size = 1
+
+        self.delay = 0.01
+        path = os.path.join(self.socket_dir.name, 'small.sock')
+        server = SmallBacklogServer(path, dict(self.server.handlers))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            results = self.send_concurrent_requests(path, 10)
+        finally:
+            server.shutdown()
+            thread.join()
+            server.server_close()
+        self.assertEqual(10, len(results))
+
+    def test_unavailable_service_raises_gazetteer_timeout(self):
+        path = os.path.join(self.socket_dir.name, 'missing.sock')
+        with override_settings(MATCHER_SOCKET_PATH=path):
+            with self.assertRaises(GazetteerCacheTimeoutError):
+                get_gazetteer_matches({'1': {}})
+
+    @mock.patch('api.matching.GazetteerCache.get_latest')
+    def test_local_gazetteer_is_used_without_socket(self, get_latest):
+        get_latest.return_value.match.return_value = iter([])
+        with override_settings(MATCHER_SOCKET_PATH=None):
+            self.assertEqual([], list(get_gazetteer_matches({'1': {}})))
+        self.assertEqual([], self.requests)
+
+
+class GazetteerChangeNotificationTests(TestCase):
+    fixtures = ['users', 'contributors', 'facility_lists', 'sources',
+                'facility_list_items', 'facilities', 'facility_matches']
+
+    def setUp(self):
+        self.gazetteer = mock.Mock()
+        self.listener = mock.Mock(closed=False, notifies=[])
+        GazetteerCache._gazetter = self.gazetteer
+        GazetteerCache._facility_version = 0
+        GazetteerCache._match_version = 0
+        GazetteerCache._listener = self.listener
+        GazetteerCache._listener_pid = os.getpid()
+
+    def tearDown(self):
+        GazetteerCache._gazetter = None
+        GazetteerCache._facility_version = None
+        GazetteerCache._match_version = None
+        GazetteerCache._listener = None
+        GazetteerCache._listener_pid = None
+
+    def notify(self, **change):
+        self.listener.notifies.append(mock.Mock(payload=json.dumps(change)))
+
+    @override_settings(GAZETTEER_CHANGE_NOTIFICATIONS=True)
+    def test_no_pending_notifications_sends_no_queries(self):
+        with self.assertNumQueries(0):
+            self.assertEqual(self.gazetteer, GazetteerCache.get_latest())
+        self.gazetteer.index.assert_not_called()
+
+    @override_settings(GAZETTEER_CHANGE_NOTIFICATIONS=True)
+    def test_indexes_notified_facilities(self):
+        facility = Facility.objects.first()
+        self.notify(model='facility', id=facility.id, history_id=10,
+                    history_type='~')
+
+        with self.assertNumQueries(1):
+            GazetteerCache.get_latest()
+
+        self.gazetteer.index.assert_called_once_with({
+            facility.id: {
+                'country': clean(facility.country_code),
+                'name': facility.get_clean_value('name'),
+                'address': facility.get_clean_value('address'),
+            }})
+        self.assertEqual(10, GazetteerCache._facility_version)
+        self.assertEqual([], self.listener.notifies)
+
+    @override_settings(GAZETTEER_CHANGE_NOTIFICATIONS=True)
+    def test_lost_connection_scans_history(self):
+        self.listener.poll.side_effect = psycopg2.OperationalError()
+        facility = Facility.objects.first()
+        facility.name = 'Renamed'
+        facility.save()
+        match = FacilityMatch.objects.first()
+        match.status = FacilityMatch.CONFIRMED
+        match.save()
+
+        GazetteerCache.get_latest()
+
+        self.assertIsNone(GazetteerCache._listener)
+        self.assertEqual(
+            Facility.history.order_by('-history_id').first().history_id,
+            GazetteerCache._facility_version)
+        self.assertEqual(
+            FacilityMatch.history.order_by('-history_id').first().history_id,
+            GazetteerCache._match_version)
+
+
+class FakeGazetteerShard:
+    def __init__(self, canonical):
+        self.canonical = dict(canonical)
+        self.num_cores = 4
+
+    def index(self, data):
+        self.canonical.update(data)
+
+    def match(self, messy, threshold=0.5, n_matches=1, generator=False):
+        if len(self.canonical) == 0:
+            raise dedupe.core.BlockingError('No blocks')
+        return [[((messy_id, canon_id), 0.9)
+                 for canon_id, record in self.canonical.items()
+                 if record['name'] == values['name']]
+                for messy_id, values in messy.items()]
+
+
+class ShardedGazetteerTests(TestCase):
+    def setUp(self):
+        self.canonical = {
+            'US1': {'country': 'us', 'name': 'a', 'address': ''},
+            'CN1': {'country': 'cn', 'name': 'a', 'address': ''},
+            'IS1': {'country': 'is', 'name': 'a', 'address': ''},
+        }
+        self.shards = {
+            'us': FakeGazetteerShard({'US1': self.canonical['US1']}),
+            SHARED_SHARD: FakeGazetteerShard(
+                {'CN1': self.canonical['CN1'],
+                 'IS1': self.canonical['IS1']}),
+        }
+        self.gazetteer = ShardedGazetteer(
+            b'', self.shards, {'us': 'us'},
+            {'US1': 'us', 'CN1': SHARED_SHARD, 'IS1': SHARED_SHARD})
+
+    def matched_pairs(self, results):
+        return sorted((messy_id, canon_id) for cluster in results
+                      for (messy_id, canon_id), _ in cluster)
+
+    def test_records_are_matched_within_their_shard(self):
+        messy = {
+            '1': {'country': 'us', 'name': 'a', 'address': ''},
+            '2': {'country': 'is', 'name': 'a', 'address': ''},
+        }
+        results = self.gazetteer.match(messy, threshold=0.5, n_matches=None)
+        self.assertEqual([('1', 'US1'), ('2', 'CN1'), ('2', 'IS1')],
+                         self.matched_pairs(results))
+
+    def test_shards_are_matched_in_parallel(self):
+        messy = {
+            '1': {'country': 'us', 'name': 'a', 'address': ''},
+            '2': {'country': 'is', 'name': 'a', 'address': ''},
+        }
+        expected = self.matched_pairs(self.gazetteer.match(messy))
+        self.gazetteer.processes = 2
+        self.assertEqual(expected,
+                         self.matched_pairs(self.gazetteer.match(messy)))
+        # Workers do not change the shards of the parent
+        self.assertEqual(4, self.shards['us'].num_cores)
+
+    def test_index_updates_only_the_shard_of_the_record(self):
+        self.gazetteer.index(
+            {'US2': {'country': 'us', 'name': 'b', 'address': ''}})
+        self.assertIn('US2', self.shards['us'].canonical)
+        self.assertNotIn('US2', self.shards[SHARED_SHARD].canonical)
+        self.assertEqual('us', self.gazetteer.record_shards['US2'])
+
+    def test_records_moved_to_another_shard_are_not_matched(self):
+        # CN1 moved to the US, so its old values in the shared shard are
+        # stale
+        self.gazetteer.index(
+            {'CN1': {'country': 'us', 'name': 'c', 'address': ''}})
+        messy = {'1': {'country': 'cn', 'name': 'a', 'address': ''}}
+        self.assertEqual([('1', 'IS1')],
+                         self.matched_pairs(self.gazetteer.match(messy)))
+
+    def test_blocking_error_when_no_shard_can_block(self):
+        self.shards['us'].canonical = {}
+        with self.assertRaises(dedupe.core.BlockingError):
+            self.gazetteer.match(
+                {'1': {'country': 'us', 'name': 'a', 'address': ''}})
+        self.assertEqual(
+            [('2', 'CN1'), ('2', 'IS1')],
+            self.matched_pairs(self.gazetteer.match({
+                '1': {'country': 'us', 'name': 'a', 'address': ''},
+                '2': {'country': 'cn', 'name': 'a', 'address': ''},
+            })))
+
+
+class GazetteerCompactionTests(TestCase):
+    fixtures = ['users', 'contributors', 'facility_lists', 'sources',
+                'facility_list_items', 'facilities', 'facility_matches']
+
+    def setUp(self):
+        self.gazetteer = mock.Mock()
+        GazetteerCache._gazetter = self.gazetteer
+        GazetteerCache._facility_version = 0
+        GazetteerCache._match_version = 0
+        GazetteerCache._reset_compaction_state(datetime.utcnow())
+
+    def tearDown(self):
+        GazetteerCache._gazetter = None
+        GazetteerCache._facility_version = None
+        GazetteerCache._match_version = None
+        GazetteerCache._compaction_thread = None
+        GazetteerCache._compacted = None
+
+    def delete_facility(self):
+        facility = Facility.objects.first()
+        FacilityMatch.objects.filter(facility=facility).delete()
+        FacilityListItem.objects.filter(facility=facility).update(
+            facility=None)
+        facility.delete()
+
+    def test_deleted_facilities_are_counted_as_tombstones(self):
+        self.delete_facility()
+        GazetteerCache.get_latest()
+        self.assertGreater(GazetteerCache._tombstones, 0)
+
+    @override_settings(GAZETTEER_COMPACTION_TOMBSTONE_RATIO=0.0001)
+    def test_compacted_index_is_swapped_in(self):
+        compacted = mock.Mock()
+        self.delete_facility()
+        # The new index includes the deletion
+        versions = tuple(
+            model.history.order_by('-history_id')
+            .values_list('history_id', flat=True).first() or 0
+            for model in (Facility, FacilityMatch))
+        with mock.patch.object(GazetteerCache, 'build_gazetteer',
+                               return_value=(compacted,) + versions):
+            # Matching continues with the current index while the new one
+            # is built
+            self.assertEqual(self.gazetteer, GazetteerCache.get_latest())
+            GazetteerCache._compaction_thread.join()
+
+        self.assertEqual(compacted, GazetteerCache.get_latest())
+        self.assertEqual(0, GazetteerCache._tombstones)
+        self.assertIsNone(GazetteerCache._compacted)
+
+    @override_settings(GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS=1)
+    def test_old_index_is_compacted(self):
+        self.assertIsNone(GazetteerCache._get_compaction_reason())
+        GazetteerCache._indexed_at = datetime.utcnow() - timedelta(hours=2)
+        self.assertIsNotNone(GazetteerCache._get_compaction_reason())
+
+    def test_compaction_is_disabled_by_default(self):
+        GazetteerCache._tombstones = 1000000
+        GazetteerCache._indexed_at = datetime(2000, 1, 1)
+        self.assertIsNone(GazetteerCache._get_compaction_reason())
+
+    @override_settings(GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS=1)
+    def test_age_threshold_is_jittered(self):
+        GazetteerCache._age_jitter = 0.1
+        GazetteerCache._indexed_at = \
+            datetime.utcnow() - timedelta(minutes=65)
+        self.assertIsNone(GazetteerCache._get_compaction_reason())
+        GazetteerCache._indexed_at = \
+            datetime.utcnow() - timedelta(minutes=67)
+        self.assertIsNotNone(GazetteerCache._get_compaction_reason())
+
+    @override_settings(GAZETTEER_COMPACTION_TOMBSTONE_RATIO=0.0001)
+    def test_compaction_waits_for_another_process(self):
+        self.delete_facility()
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT pg_advisory_lock(%s)',
+                           [GAZETTEER_COMPACTION_LOCK_ID])
+        try:
+            with mock.patch.object(GazetteerCache,
+                                   'build_gazetteer') as build_gazetteer:
+                GazetteerCache.get_latest()
+                GazetteerCache._compaction_thread.join()
+                build_gazetteer.assert_not_called()
+        finally:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_unlock(%s)',
+                               [GAZETTEER_COMPACTION_LOCK_ID])
+        self.assertIsNone(GazetteerCache._compacted)
+        self.assertGreater(GazetteerCache._compaction_retry_at,
+                           datetime.utcnow())
+
+        # The next call does not start another attempt before the retry time
+        GazetteerCache.get_latest()
+        self.assertFalse(GazetteerCache._compaction_thread.is_alive())
+
+    @override_settings(GAZETTEER_COMPACTION_TOMBSTONE_RATIO=0.0001)
+    def test_newer_snapshot_is_loaded_instead_of_building(self):
+        compacted = mock.Mock()
+        created_at = datetime.utcnow() + timedelta(seconds=1)
+        header = {'created_at': str(created_at),
+                  'facility_version': 0,
+                  'match_version': 0}
+        self.delete_facility()
+        with tempfile.NamedTemporaryFile() as f, \
+                override_settings(GAZETTEER_SNAPSHOT_PATH=f.name), \
+                mock.patch('api.matching.read_gazetteer_snapshot_header',
+                           return_value=header), \
+                mock.patch('api.matching.read_gazetteer_snapshot',
+                           return_value=(header, compacted)), \
+                mock.patch.object(GazetteerCache,
+                                  'build_gazetteer') as build_gazetteer:
+            GazetteerCache.get_latest()
+            GazetteerCache._compaction_thread.join()
+            build_gazetteer.assert_not_called()
+
+        self.assertEqual(compacted, GazetteerCache.get_latest())
+        self.assertEqual(created_at, GazetteerCache._indexed_at)
+
+
+class CleanFieldsTest(TestCase):
+    fixtures = ['users', 'contributors', 'facility_lists', 'sources',
+                'facility_list_items', 'facilities', 'facility_matches']
+
+    def test_save_stores_clean_fields(self):
+        facility = Facility.objects.first()
+        facility.name = '"PANTS   AHOY"'
+        facility.save(update_fields=['name'])
+        facility = Facility.objects.get(id=facility.id)
+        self.assertEqual('pants ahoy', facility.clean_name)
+        self.assertEqual('pants ahoy', facility.get_clean_value('name'))
+
+    def test_unstored_values_are_cleaned_when_read(self):
+        facility = Facility.objects.first()
+        self.assertIsNone(facility.clean_name)
+        items = get_canonical_items()
+        self.assertEqual(clean(facility.name), items[facility.id]['name'])
+        self.assertEqual(clean(facility.country_code),
+                         items[facility.id]['country'])
+
+    def test_loaders_read_stored_values(self):
+        facility = Facility.objects.first()
+        Facility.objects.filter(id=facility.id).update(
+            clean_name='stored name', clean_address='')
+        items = get_canonical_items()
+        self.assertEqual('stored name', items[facility.id]['name'])
+        self.assertIsNone(items[facility.id]['address'])
+
+    def test_confirmed_matches_are_canonical(self):
+        items = get_canonical_items()
+        for match in FacilityMatch.objects.filter(
+                status=FacilityMatch.CONFIRMED):
+            key = '{}_MATCH-{}'.format(match.facility_id, match.id)
+            self.assertEqual(clean(match.facility_list_item.name),
+                             items[key]['name'])
+
+    def test_backfill_stores_missing_values(self):
+        call_command('backfill_clean_fields', batch_size=2, stdout=StringIO())
+        for model in (Facility, FacilityListItem):
+            self.assertFalse(model.objects.filter(
+                clean_name__isnull=True).exists())
+            for instance in model.objects.all():
+                self.assertEqual(clean(instance.name or '') or '',
+                                 instance.clean_name)
+                self.assertEqual(clean(instance.address or '') or '',
+                                 instance.clean_address)
+
+
+class GazetteerLoaderTest(TestCase):
+    fixtures = ['users', 'contributors', 'facility_lists', 'sources',
+                'facility_list_items', 'facilities', 'facility_matches']
+
+    def test_confirmed_matches_are_loaded_with_one_query(self):
+        FacilityMatch.objects.update(status=FacilityMatch.CONFIRMED)
+        # One query for the facilities and one for the confirmed matches
+        with self.assertNumQueries(2):
+            items = get_canonical_items()
+        self.assertEqual(
+            Facility.objects.count() + FacilityMatch.objects.count(),
+            len(items))
+
+    def test_training_items_are_sampled_by_id(self):
+        FacilityListItem.objects.filter(id__lte=10).update(
+            status=FacilityListItem.MATCHED)
+        items = get_messy_items_for_training(mod_factor=2)
+        self.assertEqual(set(['2', '4', '6', '8', '10']), set(items.keys()))
+
+
+class GetenvBoolTest(TestCase):
+    def test_only_true_values_enable_flags(self):
+        for value, expected in (('1', True), ('true', True), ('Yes', True),
+                                ('ON', True), ('', False), ('0', False),
+                                ('false', False), ('no', False)):
+            with mock.patch.dict(os.environ, {'TEST_FLAG': value}):
+                self.assertEqual(expected, getenv_bool('TEST_FLAG'))
+        with mock.patch.dict(os.environ, clear=True):
+            self.assertFalse(getenv_bool('TEST_FLAG'))
@@ -0,0 +1,245 @@
+import hashlib
+import json
+import threading
+import time
+
+from collections import Counter
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Sum
+from django.utils import timezone
+
+from api.models import Facility, FacilityIndexQueue, TileCacheEntry
+
+# Eviction runs after every EVICTION_INTERVAL entries are added rather than
+# after every insert
+EVICTION_INTERVAL = 100
+
+# The maximum number of entries rendered under previous cache keys that are
+# deleted each time eviction runs
+STALE_ENTRY_BATCH_SIZE = 1000
+
+# Hits are counted in memory and written to the entries together once there
+# are HIT_FLUSH_INTERVAL of them or HIT_FLUSH_INTERVAL_IN_SECONDS have passed,
+# so that serving a cached tile does not write to the database
+HIT_FLUSH_INTERVAL = 100
+HIT_FLUSH_INTERVAL_IN_SECONDS = 60
+
+# Hit and miss counts for the current process. The `tile_cache_stats`
+# management command reports the hits recorded on the stored entries, which
+# are shared by all processes.
+tile_cache_stats = Counter()
+
+# Hits that have not been written to the entries yet, keyed by entry key
+_pending_hits = Counter()
+_pending_hits_lock = threading.Lock()
+_last_flushed_at = time.monotonic()
+
+
+def make_tile_key(layer, z, x, y, params, cache_key):
+    """
+    Build a key that uniquely identifies a rendered tile. Query parameters are
+    normalized so that the order in which they, or repeated values, appear in
+    the request does not produce a different key.
+
+    Arguments:
+    layer (string) -- The name of the tile layer.
+    z (int) -- Zoom level.
+    x (int) -- X position of the tile.
+    y (int) -- Y position of the tile.
+    params (QueryDict) -- The request query parameters.
+    cache_key (string) -- The current tile cache key.
+
+    Returns:
+    A hex digest string.
+    """
+    normalized_params = sorted(
+        (name, sorted(set(values))) for name, values in params.lists()
+        if any(v != '' for v in values))
+    data = json.dumps([layer, z, x, y, cache_key, normalized_params])
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def flush_tile_hits():
+    """
+    Write the hits counted by this process to their entries with a single
+    query.
+
+    Returns:
+    The number of entries updated.
+    """
+    global _last_flushed_at
+    with _pending_hits_lock:
+        hits = dict(_pending_hits)
+        _pending_hits.clear()
+        _last_flushed_at = time.monotonic()
+    if len(hits) == 0:
+        return 0
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {} AS e SET hits = e.hits + h.count, '
+            '  last_accessed_at = %s '
+            'FROM unnest(%s::text[], %s::int[]) AS h(key, count) '
+            'WHERE e.key = h.key'.format(TileCacheEntry._meta.db_table),
+            [timezone.now(), list(hits.keys()), list(hits.values())])
+        return cursor.rowcount
+
+
+def record_tile_hit(key):
+    with _pending_hits_lock:
+        _pending_hits[key] += 1
+        should_flush = (
+            sum(_pending_hits.values()) >= HIT_FLUSH_INTERVAL
+            or time.monotonic() - _last_flushed_at
+            >= HIT_FLUSH_INTERVAL_IN_SECONDS)
+    if should_flush:
+        flush_tile_hits()
+
+
+def get_cached_tile(key, cache_key):
+    """
+    Fetch a cached tile and count the access.
+
+    Returns:
+    A (found, tile) tuple where `tile` is None if the cached query had no
+    results.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT tile FROM {} WHERE key = %s AND cache_key = %s'.format(
+                TileCacheEntry._meta.db_table),
+            [key, cache_key])
+        row = cursor.fetchone()
+    if row is None:
+        return False, None
+    record_tile_hit(key)
+    tile = row[0]
+    return True, (bytes(tile) if tile is not None else None)
+
+
+def set_cached_tile(key, cache_key, layer, z, x, y, tile):
+    """
+    Store a rendered tile and periodically remove entries rendered under other
+    cache keys and evict the least recently used entries if the cache is
+    larger than TILE_CACHE_MAX_SIZE_IN_BYTES.
+    """
+    now = timezone.now()
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'INSERT INTO {} '
+            '  (key, cache_key, layer, z, x, y, tile, size, hits, '
+            '   created_at, last_accessed_at) '
+            'VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 0, %s, %s) '
+            'ON CONFLICT (key) DO NOTHING '
+            'RETURNING id'.format(TileCacheEntry._meta.db_table),
+            [key, cache_key, layer, z, x, y, tile,
+             len(tile) if tile is not None else 0, now, now])
+        row = cursor.fetchone()
+    if row is not None and row[0] % EVICTION_INTERVAL == 0:
+        delete_stale_tiles(cache_key)
+        evict_tiles(settings.TILE_CACHE_MAX_SIZE_IN_BYTES)
+
+
+def delete_stale_tiles(cache_key, batch_size=STALE_ENTRY_BATCH_SIZE):
+    """
+    Delete up to `batch_size` entries rendered under cache keys other than
+    `cache_key`. They are never served, so they only need to be removed
+    to free space. Rows locked by another process are skipped.
+
+    Returns:
+    The number of entries deleted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM {table} WHERE id IN ('
+            '  SELECT id FROM {table} WHERE cache_key <> %s '
+            '  LIMIT %s FOR UPDATE SKIP LOCKED'
+            ')'.format(table=TileCacheEntry._meta.db_table),
+            [cache_key, batch_size])
+        return cursor.rowcount
+
+
+def evict_tiles(max_size):
+    """
+    Delete the least recently used entries until the total size of the cached
+    tiles is no more than `max_size` bytes. Rows locked by another process
+    are skipped, so concurrent evictions do not wait on each other.
+
+    Returns:
+    The number of entries deleted.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'DELETE FROM {table} WHERE id IN ('
+            '  SELECT id FROM {table} WHERE id IN ('
+            '    SELECT id FROM ('
+            '      SELECT id, SUM(size) OVER ('
+            '        ORDER BY last_accessed_at DESC, id DESC'
+            '      ) AS total_size FROM {table}'
+            '    ) AS sized WHERE total_size > %s'
+            '  ) FOR UPDATE SKIP LOCKED'
+            ')'.format(table=TileCacheEntry._meta.db_table),
+            [max_size])
+        return cursor.rowcount
+
+
+def get_or_render_tile(layer, z, x, y, params, render):
+    """
+    Return a tile from the cache, rendering and storing it on a miss. The
+    cache is bypassed if TILE_CACHE_MAX_SIZE_IN_BYTES is 0.
+
+    Arguments:
+    layer (string) -- The name of the tile layer.
+    z (int) -- Zoom level.
+    x (int) -- X position of the tile.
+    y (int) -- Y position of the tile.
+    params (QueryDict) -- The request query parameters.
+    render (function) -- Called with no arguments to render the tile on a
+                         miss. Returns the tile bytes or None if the query had
+                         no results.
+
+    Returns:
+    A (hit, tile) tuple.
+    """
+    if settings.TILE_CACHE_MAX_SIZE_IN_BYTES <= 0:
+        return False, render()
+
+    try:
+        cache_key = Facility.current_tile_cache_key()
+    except Facility.DoesNotExist:
+        return False, render()
+    key = make_tile_key(layer, z, x, y, params, cache_key)
+
+    found, tile = get_cached_tile(key, cache_key)
+    if found:
+        tile_cache_stats['hits'] += 1
+        return True, tile
+
+    tile_cache_stats['misses'] += 1
+    tile = render()
+    # While facility index updates are queued the tile may not include them,
+    # and draining the queue does not change the cache key
+    if not FacilityIndexQueue.objects.exists():
+        set_cached_tile(key, cache_key, layer, z, x, y, tile)
+    return False, tile
+
+
+def get_tile_cache_summary():
+    """
+    Returns:
+    A dict with the number of cached entries, their total size in bytes and
+    the total number of hits they have served.
+    """
+    flush_tile_hits()
+    summary = TileCacheEntry.objects.aggregate(
+        size=Sum('size'), hits=Sum('hits'))
+    return {
+        'entries': TileCacheEntry.objects.count(),
+        'size': summary['size'] or 0,
+        'hits': summary['hits'] or 0,
+    }
+
+
+def clear_tile_cache():
+    TileCacheEntry.objects.all().delete()
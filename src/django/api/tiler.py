@@ -2,13 +2,23 @@ import mercantile
 
 from django.contrib.gis.geos import Polygon
 from django.db import connection
+from django.db.models import OuterRef, Subquery
 
-from api.models import Facility
+from api.facility_grid import get_precomputed_facility_grid_vector_tile
+from api.models import Facility, FacilityIndex
 
 GRID_ZOOM_FACTOR = 3
 
 
 def get_facility_grid_vector_tile(params, layer, z, x, y):
+    tile = get_precomputed_facility_grid_vector_tile(params, layer, z, x, y)
+    if tile is not None:
+        return tile
+
+    return get_joined_facility_grid_vector_tile(params, layer, z, x, y)
+
+
+def get_joined_facility_grid_vector_tile(params, layer, z, x, y):
     xy_bounds = mercantile.xy_bounds(x, y, z)
 
     hex_width = abs(xy_bounds.right - xy_bounds.left) / (2 ** GRID_ZOOM_FACTOR)
@@ -29,7 +39,7 @@ def get_facility_grid_vector_tile(params, layer, z, x, y):
     hex_grid_idx_query = \
         'CREATE INDEX hex_grid_idx ON hex_grid USING gist (wgs84_geom)'
 
-    location_query, location_params = Facility \
+    location_query, location_params = FacilityIndex \
         .objects \
         .filter_by_query_params(params) \
         .values('location') \
@@ -57,7 +67,7 @@ def get_facility_grid_vector_tile(params, layer, z, x, y):
         '  ST_YMin(ST_Envelope(hex_grid.wgs84_geom)) as ymin, '
         '  ST_XMax(ST_Envelope(hex_grid.wgs84_geom)) as xmax, '
         '  ST_YMax(ST_Envelope(hex_grid.wgs84_geom)) as ymax '
-        'FROM hex_grid JOIN api_facility '
+        'FROM hex_grid JOIN api_facilityindex '
         '  ON ST_Contains(hex_grid.wgs84_geom, location) '
         ' {where_clause} '
         'GROUP BY hex_grid.mvt_geom, '
@@ -117,10 +127,15 @@ def get_facilities_vector_tile(params, layer, z, x, y):
         tile_bounds.east + ew_buffer,
         tile_bounds.north + ns_buffer))
 
-    query, params_for_sql = Facility \
+    # The address is the only field in the tile that is not in the index, so
+    # it is fetched only for the facilities within the tile
+    address = Facility.objects.filter(id=OuterRef('id')).values('address')
+
+    query, params_for_sql = FacilityIndex \
         .objects \
         .filter_by_query_params(params) \
         .filter(location__within=filter_polygon) \
+        .annotate(address=Subquery(address)) \
         .extra(
             select={
                 'location': mvt_geom_query.format(
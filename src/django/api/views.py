@@ -89,10 +89,12 @@ from api.models import (FacilityList,
                         EmbedConfig,
                         EmbedField,
                         NonstandardField,
-                        FacilityIndex)
+                        FacilityIndex,
+                        load_processing_results)
 from api.processing import (parse_csv_line,
                             parse_csv,
                             parse_excel,
+                            insert_facility_list_items,
                             get_country_code,
                             save_match_details,
                             reduce_matches)
@@ -133,6 +135,8 @@ from api.exceptions import BadRequestException
 from api.tiler import (get_facilities_vector_tile,
                        get_facility_grid_vector_tile)
 from api.renderers import MvtRenderer
+from api.tile_cache import get_or_render_tile
+from api.instrumentation import instrument_queries
 from api.facility_history import (create_facility_history_list,
                                   create_associate_match_change_reason,
                                   create_dissociate_match_change_reason)
@@ -662,6 +666,16 @@ class FacilitiesAPIFilterBackend(BaseFilterBackend):
                         'Pass a GeoJSON geometry to filter by '
                         'facilities within the boundaries of that geometry.')
                 ),
+                coreapi.Field(
+                    name='sort_by',
+                    location='query',
+                    type='string',
+                    required=False,
+                    description=(
+                        'Set this to "relevance" to order the results by '
+                        'the similarity of their names to `q` rather than '
+                        'alphabetically.')
+                ),
             ]
 
             if switch_is_active('ppe'):
@@ -857,28 +871,42 @@ class FacilitiesViewSet(mixins.ListModelMixin,
         if not params.is_valid():
             raise ValidationError(params.errors)
 
-        queryset = Facility \
-            .objects \
-            .filter_by_query_params(request.query_params) \
-            .order_by('name')
+        with instrument_queries('facilities list'):
+            # Filter, count and measure the extent of the results using only
+            # the index, and join to the facilities for the page of results
+            queryset = FacilityIndex \
+                .objects \
+                .filter_by_query_params(request.query_params)
 
-        page_queryset = self.paginate_queryset(queryset)
+            page_ids = self.paginate_queryset(
+                FacilityIndex
+                .objects
+                .order_by_query_params(queryset, request.query_params)
+                .values_list('id', flat=True))
 
-        extent = queryset.aggregate(Extent('location'))['location__extent']
+            extent = queryset.aggregate(
+                Extent('location'))['location__extent']
 
-        context = {'request': request}
+            context = {'request': request}
 
-        if page_queryset is not None:
-            serializer = FacilitySerializer(page_queryset, many=True,
-                                            context=context)
-            response = self.get_paginated_response(serializer.data)
-            response.data['extent'] = extent
-            return response
-
-        response_data = FacilitySerializer(queryset, many=True,
-                                           context=context).data
-        response_data['extent'] = extent
-        return Response(response_data)
+            if page_ids is not None:
+                facilities = Facility.objects.in_bulk(page_ids)
+                page_queryset = [facilities[id] for id in page_ids
+                                 if id in facilities]
+                serializer = FacilitySerializer(page_queryset, many=True,
+                                                context=context)
+                response = self.get_paginated_response(serializer.data)
+                response.data['extent'] = extent
+                return response
+
+            facilities = Facility \
+                .objects \
+                .filter(id__in=queryset.values('id')) \
+                .order_by('name')
+            response_data = FacilitySerializer(facilities, many=True,
+                                               context=context).data
+            response_data['extent'] = extent
+            return Response(response_data)
 
     def retrieve(self, request, pk=None):
         """
@@ -2559,11 +2587,9 @@ class FacilityListViewSet(viewsets.ModelViewSet):
                     replaced_source.is_active = False
                     replaced_source.save()
 
-        items = [FacilityListItem(row_index=idx,
-                                  raw_data=row,
-                                  source=source)
-                 for idx, row in enumerate(rows)]
-        FacilityListItem.objects.bulk_create(items)
+        # The rows are read from the file as they are inserted, so errors
+        # in the body of the file roll back the whole upload
+        insert_facility_list_items(source, rows)
 
         if ENVIRONMENT in ('Staging', 'Production'):
             submit_jobs(ENVIRONMENT, new_list)
@@ -2745,13 +2771,22 @@ class FacilityListViewSet(viewsets.ModelViewSet):
 
         queryset = queryset.order_by('row_index')
 
+        # Only the results of items with errors are serialized. Loading them
+        # together avoids a query per item.
         page_queryset = self.paginate_queryset(queryset)
         if page_queryset is not None:
+            load_processing_results(
+                [item for item in page_queryset
+                 if item.status in FacilityListItem.ERROR_STATUSES])
             serializer = FacilityListItemSerializer(page_queryset,
                                                     many=True)
             return self.get_paginated_response(serializer.data)
 
-        serializer = FacilityListItemSerializer(queryset, many=True)
+        items = list(queryset)
+        load_processing_results(
+            [item for item in items
+             if item.status in FacilityListItem.ERROR_STATUSES])
+        serializer = FacilityListItemSerializer(items, many=True)
         return Response(serializer.data)
 
     @transaction.atomic
@@ -3526,16 +3561,26 @@ def get_tile(request, layer, cachekey, z, x, y, ext):
     if not params.is_valid():
         raise ValidationError(params.errors)
 
-    try:
-        if layer == 'facilities':
-            tile = get_facilities_vector_tile(
-                request.query_params, layer, z, x, y)
-        elif layer == 'facilitygrid':
-            tile = get_facility_grid_vector_tile(
-                request.query_params, layer, z, x, y)
-        return Response(tile.tobytes())
-    except core_exceptions.EmptyResultSet:
-        return Response(None, status=status.HTTP_204_NO_CONTENT)
+    def render():
+        try:
+            if layer == 'facilities':
+                tile = get_facilities_vector_tile(
+                    request.query_params, layer, z, x, y)
+            elif layer == 'facilitygrid':
+                tile = get_facility_grid_vector_tile(
+                    request.query_params, layer, z, x, y)
+            return tile.tobytes()
+        except core_exceptions.EmptyResultSet:
+            return None
+
+    with instrument_queries('{} tile'.format(layer)):
+        hit, tile = get_or_render_tile(
+            layer, z, x, y, request.query_params, render)
+    headers = {'X-Tile-Cache': 'HIT' if hit else 'MISS'}
+    if tile is None:
+        return Response(None, status=status.HTTP_204_NO_CONTENT,
+                        headers=headers)
+    return Response(tile, headers=headers)
 
 
 class ApiBlockAutoSchema(AutoSchema):
@@ -0,0 +1,153 @@
+import re
+import zipfile
+
+from defusedxml.ElementTree import iterparse
+
+SHARED_STRINGS_PATH = 'xl/sharedStrings.xml'
+WORKBOOK_PATH = 'xl/workbook.xml'
+WORKBOOK_RELS_PATH = 'xl/_rels/workbook.xml.rels'
+
+CELL_REFERENCE = re.compile(r'^([A-Z]+)(\d*)$')
+
+
+def _local_name(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _get_column_index(reference):
+    match = CELL_REFERENCE.match(reference.upper())
+    if match is None:
+        raise ValueError('Invalid cell reference "{}"'.format(reference))
+    index = 0
+    for char in match.group(1):
+        index = index * 26 + ord(char) - ord('A') + 1
+    return index - 1
+
+
+def _get_text(element):
+    # Rich text is split into runs. Phonetic runs are not part of the value.
+    parts = []
+    for child in element:
+        name = _local_name(child.tag)
+        if name == 't':
+            parts.append(child.text or '')
+        elif name == 'r':
+            parts.extend(t.text or '' for t in child
+                         if _local_name(t.tag) == 't')
+    return ''.join(parts)
+
+
+def _get_first_sheet_path(archive):
+    targets = {}
+    for _, element in iterparse(archive.open(WORKBOOK_RELS_PATH)):
+        if _local_name(element.tag) == 'Relationship':
+            targets[element.get('Id')] = element.get('Target')
+
+    for _, element in iterparse(archive.open(WORKBOOK_PATH)):
+        if _local_name(element.tag) == 'sheet':
+            relationship_id = next(value for key, value
+                                   in element.attrib.items()
+                                   if _local_name(key) == 'id')
+            target = targets[relationship_id]
+            if target.startswith('/'):
+                return target[1:]
+            return 'xl/{}'.format(target)
+
+    raise ValueError('The workbook does not contain any sheets')
+
+
+def _read_shared_strings(archive):
+    if SHARED_STRINGS_PATH not in archive.namelist():
+        return []
+    strings = []
+    for _, element in iterparse(archive.open(SHARED_STRINGS_PATH)):
+        if _local_name(element.tag) == 'si':
+            strings.append(_get_text(element))
+            element.clear()
+    return strings
+
+
+def _get_cell_value(cell, shared_strings):
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        for child in cell:
+            if _local_name(child.tag) == 'is':
+                return _get_text(child)
+        return ''
+
+    value = None
+    for child in cell:
+        if _local_name(child.tag) == 'v':
+            value = child.text
+    if value is None:
+        return ''
+    if cell_type == 's':
+        return shared_strings[int(value)]
+    if cell_type == 'n':
+        return float(value)
+    if cell_type == 'b':
+        return int(value)
+    return value
+
+
+def iter_xlsx_rows(file):
+    """
+    Read the rows of the first sheet of an XLSX workbook one at a time rather
+    than loading the whole sheet into memory. Only the shared string table is
+    held in memory while the rows are read.
+
+    The values match those returned by `xlrd.sheet.Sheet.row_values`. Text
+    cells are strings, numeric cells are floats, boolean cells are integers
+    and empty cells are empty strings. Rows are padded to the width of the
+    sheet dimension, and rows missing from the sheet are returned as empty
+    rows.
+
+    Arguments:
+    file -- A seekable, binary file-like object.
+
+    Returns:
+    A generator of lists of cell values.
+    """
+    archive = zipfile.ZipFile(file)
+    sheet_path = _get_first_sheet_path(archive)
+    shared_strings = _read_shared_strings(archive)
+
+    column_count = 0
+    next_row_index = 0
+    sheet_data = None
+    for event, element in iterparse(archive.open(sheet_path),
+                                    events=('start', 'end')):
+        name = _local_name(element.tag)
+        if event == 'start':
+            if name == 'sheetData':
+                sheet_data = element
+            continue
+
+        if name == 'dimension':
+            last_cell = element.get('ref', '').split(':')[-1]
+            if last_cell != '':
+                column_count = _get_column_index(last_cell) + 1
+        elif name == 'row':
+            values = []
+            for cell in element:
+                if _local_name(cell.tag) != 'c':
+                    continue
+                reference = cell.get('r')
+                if reference is not None:
+                    index = _get_column_index(reference)
+                    values.extend([''] * (index - len(values)))
+                values.append(_get_cell_value(cell, shared_strings))
+            column_count = max(column_count, len(values))
+            values.extend([''] * (column_count - len(values)))
+
+            row_index = int(element.get('r', next_row_index + 1)) - 1
+            while next_row_index < row_index:
+                yield [''] * column_count
+                next_row_index += 1
+            yield values
+            next_row_index = row_index + 1
+
+            # Drop the rows that have been read so that the parsed tree does
+            # not grow with the size of the sheet
+            if sheet_data is not None:
+                sheet_data.clear()
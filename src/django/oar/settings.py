@@ -19,6 +19,15 @@ from corsheaders.defaults import default_headers
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
+
+def getenv_bool(name):
+    """
+    Read an opt-in flag from the environment. Only "1", "true", "yes" and
+    "on", in any case, turn it on, so that "false" or "0" leave it off.
+    """
+    return os.getenv(name, '').strip().lower() in ('1', 'true', 'yes', 'on')
+
+
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/2.0/howto/deployment/checklist/
 
@@ -257,9 +266,17 @@ LOGGING = {
             'handlers': ['console'],
             'level': os.getenv('DJANGO_LOG_LEVEL', 'INFO'),
         },
+        'api.instrumentation': {
+            'handlers': ['console'],
+            'level': 'INFO',
+        },
     },
 }
 
+# When set, the SQL and duration of the queries used to search and draw
+# facilities are logged by api.instrumentation
+QUERY_INSTRUMENTATION = getenv_bool('QUERY_INSTRUMENTATION')
+
 # Internationalization
 # https://docs.djangoproject.com/en/2.0/topics/i18n/
 
@@ -349,9 +366,92 @@ ECSMANAGE_ENVIRONMENTS = {
 }
 
 # Application settings
-MAX_UPLOADED_FILE_SIZE_IN_BYTES = 5242880
+# Uploaded lists are read and inserted in batches rather than all at once, so
+# the peak memory used by an upload does not grow with the size of the file.
+MAX_UPLOADED_FILE_SIZE_IN_BYTES = int(
+    os.getenv('MAX_UPLOADED_FILE_SIZE_IN_BYTES', 5242880))
 TILE_CACHE_MAX_AGE_IN_SECONDS = 60 * 60 * 24 * 365 # 1 year. Also in deployment/terraform/cdn.tf  # NOQA
 
+# The maximum total size of the rendered tiles stored in the database by
+# get_tile. Set to 0 to disable the server side tile cache.
+TILE_CACHE_MAX_SIZE_IN_BYTES = int(
+    os.getenv('TILE_CACHE_MAX_SIZE_IN_BYTES', 256 * 1024 * 1024))
+
+# Geocoding API responses are stored in the database and reused for requests
+# with the same normalized address and country code until they are
+# GEOCODING_CACHE_TTL_IN_DAYS old. The least recently used entries are evicted
+# once there are more than GEOCODING_CACHE_MAX_ENTRIES. Set it to 0 to disable
+# the geocoding cache.
+GEOCODING_CACHE_TTL_IN_DAYS = int(
+    os.getenv('GEOCODING_CACHE_TTL_IN_DAYS', 90))
+GEOCODING_CACHE_MAX_ENTRIES = int(
+    os.getenv('GEOCODING_CACHE_MAX_ENTRIES', 1000000))
+
+# Optional path to a trained and indexed gazetteer written by the
+# build_gazetteer_snapshot management command. When set, processes load the
+# snapshot on their first match instead of training a new gazetteer.
+GAZETTEER_SNAPSHOT_PATH = os.getenv('GAZETTEER_SNAPSHOT_PATH')
+
+# When set, the gazetteer keeps a separate index for each country with at
+# least GAZETTEER_SHARD_MIN_SIZE facilities and one shared index for the
+# others. The shards of a list are scored by GAZETTEER_MATCH_PROCESSES
+# processes, or one per CPU if it is 0.
+SHARDED_GAZETTEER = getenv_bool('SHARDED_GAZETTEER')
+GAZETTEER_SHARD_MIN_SIZE = int(os.getenv('GAZETTEER_SHARD_MIN_SIZE', 5000))
+GAZETTEER_MATCH_PROCESSES = int(os.getenv('GAZETTEER_MATCH_PROCESSES', 0))
+
+# Deleted and merged facilities and deactivated matches cannot be removed from
+# the gazetteer index. When their number passes
+# GAZETTEER_COMPACTION_TOMBSTONE_RATIO times the number of facilities, or the
+# index is older than GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS, a new index is
+# built in a background thread and swapped in. Only one process builds at a
+# time; when GAZETTEER_SNAPSHOT_PATH is set it writes a new snapshot there
+# that the other processes load instead of building. Set both to 0 to disable
+# compaction.
+GAZETTEER_COMPACTION_TOMBSTONE_RATIO = float(
+    os.getenv('GAZETTEER_COMPACTION_TOMBSTONE_RATIO', 0))
+GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS = float(
+    os.getenv('GAZETTEER_COMPACTION_MAX_AGE_IN_HOURS', 0))
+
+# Optional path to the Unix socket of the matcher service started by the
+# run_matcher_service management command. When set, processes send match
+# requests to the service, which holds the only gazetteer on the host, instead
+# of training and indexing their own. Requests that are not answered within
+# MATCHER_TIMEOUT_IN_SECONDS fail as matching errors. The items of a list are
+# sent in requests of at most MATCHER_MAX_REQUEST_ITEMS so that each request
+# is answered within the timeout, or in a single request if it is 0.
+MATCHER_SOCKET_PATH = os.getenv('MATCHER_SOCKET_PATH')
+MATCHER_TIMEOUT_IN_SECONDS = float(
+    os.getenv('MATCHER_TIMEOUT_IN_SECONDS', 30))
+MATCHER_MAX_REQUEST_ITEMS = int(os.getenv('MATCHER_MAX_REQUEST_ITEMS', 100))
+
+# When set, processes holding a gazetteer listen for the notifications sent by
+# the facility and facility match history triggers and index only the changed
+# records, rather than scanning the history tables before every match. The
+# history tables are still scanned after the listening connection is opened.
+GAZETTEER_CHANGE_NOTIFICATIONS = getenv_bool('GAZETTEER_CHANGE_NOTIFICATIONS')
+
+# When set, changes that affect the FacilityIndex add the facility IDs to a
+# queue instead of reindexing inside the request. The queue is drained by the
+# process_facility_index_queue management command.
+DEFER_FACILITY_INDEX = getenv_bool('DEFER_FACILITY_INDEX')
+
+# Each child of the AWS Batch array job that geocodes a list processes a
+# contiguous range of BATCH_CHUNK_SIZE rows. If it is 0, the chunk size is
+# chosen so that a list is split into no more than BATCH_MAX_ARRAY_SIZE
+# children.
+BATCH_CHUNK_SIZE = int(os.getenv('BATCH_CHUNK_SIZE', 0))
+BATCH_MAX_ARRAY_SIZE = int(os.getenv('BATCH_MAX_ARRAY_SIZE', 100))
+
+# The geocoding API endpoint. Can be pointed at the geocoding_stub_server
+# management command to benchmark geocoding without sending requests to Google.
+GEOCODING_API_URL = os.getenv(
+    'GEOCODING_API_URL', 'https://maps.googleapis.com/maps/api/geocode/json')
+
+# The maximum number of requests per second sent to the geocoding API when
+# geocoding list items concurrently with batch_process --concurrency
+GEOCODING_RATE_LIMIT = float(os.getenv('GEOCODING_RATE_LIMIT', 40))
+
 GOOGLE_SERVER_SIDE_API_KEY = os.getenv('GOOGLE_SERVER_SIDE_API_KEY')
 if GOOGLE_SERVER_SIDE_API_KEY is None:
     raise ImproperlyConfigured(